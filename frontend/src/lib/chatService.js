@@ -134,11 +134,14 @@ export class ChatService {
         };
       });
 
-      const response = await fetch(`https://abb-1-plti.onrender.com/api/v1/chat/sessions/${sessionId}/messages`, {
+      // Retries reuse the key, so the server answers them without a second AI call
+      const idempotencyKey = crypto.randomUUID();
+      const send = () => fetch(`https://abb-1-plti.onrender.com/api/v1/chat/sessions/${sessionId}/messages`, {
         method: 'POST',
         headers: {
           'Content-Type': 'application/json',
           'Authorization': `Bearer ${token}`,
+          'Idempotency-Key': idempotencyKey,
         },
         body: JSON.stringify({
           message,
@@ -146,40 +149,62 @@ export class ChatService {
         }),
       });
 
+      let response;
+      try {
+        response = await send();
+      } catch (networkError) {
+        // The request may have reached the server; retry once with the same key
+        response = await send();
+      }
+      if ([502, 503, 504].includes(response.status)) {
+        response = await send();
+      }
+
       if (!response.ok) {
         throw new Error(`HTTP error! status: ${response.status}`);
       }
 
       const data = await response.json();
+      return { content: this.parseReply(data.response), messageId: data.message_id || null };
+    } catch (error) {
+      console.error('Error sending message:', error);
+      throw error;
+    }
+  }
 
-      // Always parse the response content consistently
-      if (typeof data.response === 'string') {
-        try {
-          const parsed = JSON.parse(data.response);
-
-          // Response should always be an array due to response schema
-          if (Array.isArray(parsed)) {
-            const validResponses = parsed.every(item =>
-              item && typeof item === 'object' && item.type && item.content
-            );
-            if (validResponses) {
-              return { responses: parsed };
-            }
+  /**
+   * Normalize a reply from the send endpoint for ResponseRenderer
+   */
+  parseReply(reply) {
+    // Structured replies arrive as the item array itself
+    if (Array.isArray(reply)) {
+      return { responses: reply };
+    }
+
+    // Plain text, or a JSON string from older servers
+    if (typeof reply === 'string') {
+      try {
+        const parsed = JSON.parse(reply);
+
+        // Response should always be an array due to response schema
+        if (Array.isArray(parsed)) {
+          const validResponses = parsed.every(item =>
+            item && typeof item === 'object' && item.type && item.content
+          );
+          if (validResponses) {
+            return { responses: parsed };
           }
-        } catch (e) {
-          // Not JSON, return as text
         }
+      } catch (e) {
+        // Not JSON, return as text
       }
-
-      // Fallback to text response
-      return {
-        type: "text",
-        content: data.response || "No response received"
-      };
-    } catch (error) {
-      console.error('Error sending message:', error);
-      throw error;
     }
+
+    // Fallback to text response
+    return {
+      type: "text",
+      content: reply || "No response received"
+    };
   }
 
   /**
@@ -208,6 +233,35 @@ export class ChatService {
     }
   }
 
+  /**
+   * Send an accuracy rating for an assistant message (fire-and-forget).
+   * The server reads the question and answer from the session by message_id.
+   */
+  async sendFeedback(sessionId, assistantResponse, rating) {
+    if (!assistantResponse.message_id) return;
+    try {
+      const token = await this.getToken();
+      await fetch('https://abb-1-plti.onrender.com/api/v1/feedback', {
+        method: 'POST',
+        keepalive: true,
+        headers: {
+          'Content-Type': 'application/json',
+          'Authorization': `Bearer ${token}`,
+        },
+        body: JSON.stringify({
+          events: [{
+            session_id: sessionId,
+            message_id: assistantResponse.message_id,
+            rating,
+          }],
+        }),
+      });
+    } catch (error) {
+      // Feedback is best-effort and must never interrupt the chat
+      console.error('Error sending feedback:', error);
+    }
+  }
+
   /**
    * Delete a session via API
    */
@@ -51,11 +51,12 @@ export class LibraryService {
 
   /**
    * Get all library entries for the user
+   * (view 'summary' returns response_preview instead of the full answer)
    */
-  async getLibraryEntries(limit = 50) {
+  async getLibraryEntries(limit = 50, view = 'full') {
     try {
       const token = await this.getIdToken();
-      const response = await fetch(`${this.baseUrl}/entries?limit=${limit}`, {
+      const response = await fetch(`${this.baseUrl}/entries?limit=${limit}&view=${view}`, {
         method: 'GET',
         headers: {
           'Authorization': `Bearer ${token}`,
@@ -73,6 +74,30 @@ export class LibraryService {
     }
   }
 
+  /**
+   * Get one library entry including the full answer
+   */
+  async getLibraryEntry(entryId) {
+    try {
+      const token = await this.getIdToken();
+      const response = await fetch(`${this.baseUrl}/entries/${encodeURIComponent(entryId)}`, {
+        method: 'GET',
+        headers: {
+          'Authorization': `Bearer ${token}`,
+        },
+      });
+
+      if (!response.ok) {
+        throw new Error(`HTTP error! status: ${response.status}`);
+      }
+
+      return await response.json();
+    } catch (error) {
+      console.error('Error getting library entry:', error);
+      throw error;
+    }
+  }
+
   /**
    * Search through library entries
    */
@@ -130,6 +130,11 @@ export function Home() {
       const formattedMessages = sessionMessages.map((msg) => {
         let content = msg.content;
 
+        // Structured replies arrive as item arrays; normalize them like live replies
+        if (Array.isArray(content)) {
+          content = { responses: content };
+        }
+
         // If content is a string, try to parse it as JSON for structured responses
         if (typeof content === "string" && msg.role === "assistant") {
           try {
@@ -155,6 +160,7 @@ export function Home() {
           role: msg.role,
           content: content,
           timestamp: msg.timestamp,
+          message_id: msg.message_id,
         };
       });
 
@@ -226,6 +232,7 @@ export function Home() {
     try {
       if (!libraryService || !currentSessionId) return;
 
+      chatService?.sendFeedback(currentSessionId, assistantMessage, "accurate");
       await libraryService.saveToLibrary(
         userMessage,
         assistantMessage,
@@ -241,11 +248,8 @@ export function Home() {
   };
 
   const handleMarkInaccurate = (userMessage, assistantMessage) => {
-    // For now, just log. Could be extended to send feedback to improve the model
-    console.log("User marked as inaccurate:", {
-      userMessage,
-      assistantMessage,
-    });
+    if (!chatService || !currentSessionId) return;
+    chatService.sendFeedback(currentSessionId, assistantMessage, "inaccurate");
   };
 
   const handleLogout = async () => {
@@ -268,7 +272,7 @@ export function Home() {
     setMessages((prev) => [...prev, userMessage]);
     try {
       // Send message to backend - it will handle adding to Firestore
-      const assistantReply = await chatService.sendMessage(
+      const { content: assistantReply, messageId } = await chatService.sendMessage(
         currentSessionId,
         text,
         messages
@@ -282,6 +286,7 @@ export function Home() {
         role: "assistant",
         content: contentToStore,
         timestamp: new Date(),
+        message_id: messageId,
       };
       setMessages((prev) => [...prev, assistantMessage]);
 
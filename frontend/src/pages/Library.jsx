@@ -24,6 +24,9 @@ export function Library() {
   const [isLoading, setIsLoading] = useState(true);
   const [isSearching, setIsSearching] = useState(false);
   const [stats, setStats] = useState(null);
+  // Full answers fetched on demand, by entry_id
+  const [details, setDetails] = useState({});
+  const [expanded, setExpanded] = useState({});
 
   // Initialize library service
   useEffect(() => {
@@ -43,7 +46,7 @@ export function Library() {
   const loadLibraryData = async () => {
     try {
       setIsLoading(true);
-      const entriesData = await libraryService.getLibraryEntries();
+      const entriesData = await libraryService.getLibraryEntries(50, 'summary');
       setEntries(entriesData);
       
       // Calculate stats in frontend
@@ -92,7 +95,8 @@ export function Library() {
       const query = searchQuery.trim().toLowerCase();
       const filtered = entries.filter(entry => {
         const questionMatch = entry.user_question.toLowerCase().includes(query);
-        const responseMatch = entry.assistant_response.toLowerCase().includes(query);
+        const responseText = details[entry.entry_id]?.assistant_response || entry.response_preview || '';
+        const responseMatch = responseText.toLowerCase().includes(query);
         const tagsMatch = entry.tags.some(tag => tag.toLowerCase().includes(query));
         return questionMatch || responseMatch || tagsMatch;
       });
@@ -109,6 +113,22 @@ export function Library() {
     }
   };
 
+  const toggleEntry = async (entryId) => {
+    const isOpen = !expanded[entryId];
+    setExpanded(prev => ({ ...prev, [entryId]: isOpen }));
+    if (!isOpen || details[entryId]) {
+      return;
+    }
+
+    try {
+      const entry = await libraryService.getLibraryEntry(entryId);
+      setDetails(prev => ({ ...prev, [entryId]: entry }));
+    } catch (error) {
+      console.error('Error loading library entry:', error);
+      setExpanded(prev => ({ ...prev, [entryId]: false }));
+    }
+  };
+
   const clearSearch = () => {
     setSearchQuery('');
     setSearchResults(null);
@@ -269,6 +289,7 @@ export function Library() {
                         <path d="M12 12c2.21 0 4-1.79 4-4s-1.79-4-4-4-4 1.79-4 4 1.79 4 4 4zm0 2c-2.67 0-8 1.34-8 4v2h16v-2c0-2.66-5.33-4-8-4z"/>
                       </svg>
                       Added by {entry.user_name || 'Anonymous User'}
+                      {entry.save_count > 1 && ` · saved ${entry.save_count} times`}
                     </div>
                   </div>
                   <h3 className="text-lg font-medium text-gray-900 mb-3">
@@ -279,8 +300,20 @@ export function Library() {
                 <div className="bg-gray-50 rounded-lg p-4">
                   <h4 className="text-sm font-medium text-gray-700 mb-2">AI Response:</h4>
                   <p className="text-gray-900 whitespace-pre-wrap leading-relaxed">
-                    {entry.assistant_response}
+                    {expanded[entry.entry_id] && details[entry.entry_id]
+                      ? details[entry.entry_id].assistant_response
+                      : entry.response_preview}
                   </p>
+                  <Button
+                    variant="ghost"
+                    size="sm"
+                    onClick={() => toggleEntry(entry.entry_id)}
+                    className="mt-2 px-0 text-blue-600"
+                  >
+                    {!expanded[entry.entry_id]
+                      ? 'Show full answer'
+                      : details[entry.entry_id] ? 'Show less' : 'Loading...'}
+                  </Button>
                 </div>
                 
                 {entry.tags && entry.tags.length > 0 && (
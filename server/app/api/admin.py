@@ -0,0 +1,163 @@
+from fastapi import APIRouter, Depends, HTTPException, Query, status
+from fastapi.responses import PlainTextResponse, StreamingResponse
+from typing import Literal
+from datetime import datetime
+from starlette.concurrency import run_in_threadpool
+from app.core.dependencies import get_admin_user
+from app.models.feedback import QuestionFeedbackListResponse
+from app.models.usage import SessionUsage, UsageReport
+from app.services.feedback_service import feedback_service
+from app.services.bulk_transfer import export_gzip
+from app.services.gemini_service import gemini_service
+from app.services.library_service import library_service
+from app.services.metrics import metrics
+from app.services.profiler import profile_store
+from app.services.usage_service import usage_tracker
+
+router = APIRouter(prefix="/admin", tags=["admin"])
+
+@router.get("/metrics")
+async def get_metrics(admin_user: dict = Depends(get_admin_user)):
+    """
+    Snapshot of in-process service metrics for this worker
+    """
+    return metrics.snapshot()
+
+@router.get("/feedback/questions", response_model=QuestionFeedbackListResponse)
+async def get_question_feedback(
+    admin_user: dict = Depends(get_admin_user),
+    limit: int = 50
+):
+    """
+    Questions with the most answers rated inaccurate
+    """
+    try:
+        questions = await run_in_threadpool(feedback_service.get_question_feedback, limit)
+        return QuestionFeedbackListResponse(questions=questions, total=len(questions))
+    except Exception as e:
+        print(f"Error getting question feedback: {str(e)}")
+        raise HTTPException(
+            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
+            detail=f"Failed to get question feedback: {str(e)}"
+        )
+
+@router.get("/sessions/{session_id}/kb-context")
+async def get_session_kb_context(
+    session_id: str,
+    admin_user: dict = Depends(get_admin_user)
+):
+    """
+    KB context of one chat session on this worker (prompt tokens sent, and saved against attaching every retrieved passage)
+    """
+    stats = gemini_service.kb_context.session_stats(session_id)
+    if stats is None:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail="No KB context recorded for this session on this worker"
+        )
+    return {"session_id": session_id, **stats}
+
+@router.post("/library/dedup")
+async def dedupe_library(
+    admin_user: dict = Depends(get_admin_user),
+    dry_run: bool = False
+):
+    """
+    Merge exact and near-duplicate library entries into their oldest copy
+    (for large libraries run `python -m app.services.library_dedup backfill` instead)
+    """
+    try:
+        stats = await run_in_threadpool(library_service.dedupe_existing, dry_run)
+        return {"dry_run": dry_run, **stats}
+    except Exception as e:
+        print(f"Error deduplicating library: {str(e)}")
+        raise HTTPException(
+            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
+            detail=f"Failed to deduplicate library: {str(e)}"
+        )
+
+@router.get("/export/{collection}")
+async def export_collection(
+    collection: Literal["sessions", "library"],
+    admin_user: dict = Depends(get_admin_user)
+):
+    """
+    Stream chat sessions (with messages and archive buckets) or the library as gzip NDJSON.
+    The body is sent with Content-Encoding: gzip; save it unchanged (curl without --compressed)
+    to get a file for `python -m app.services.bulk_transfer import`.
+    """
+    timestamp = datetime.utcnow().strftime("%Y%m%dT%H%M%S")
+    return StreamingResponse(
+        export_gzip(collection),
+        media_type="application/x-ndjson",
+        headers={
+            # Already compressed; also keeps GZipMiddleware from compressing it again
+            "Content-Encoding": "gzip",
+            "Content-Disposition": f'attachment; filename="{collection}-{timestamp}.ndjson.gz"'
+        }
+    )
+
+@router.get("/usage", response_model=UsageReport)
+async def get_token_usage(
+    admin_user: dict = Depends(get_admin_user),
+    days: int = Query(7, ge=1, le=90),
+    limit: int = Query(50, ge=1, le=1000)
+):
+    """
+    Gemini token usage and estimated cost per user over the last days, by prompt section and request type
+    """
+    try:
+        return await run_in_threadpool(usage_tracker.get_report, days, limit)
+    except Exception as e:
+        print(f"Error getting token usage: {str(e)}")
+        raise HTTPException(
+            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
+            detail=f"Failed to get token usage: {str(e)}"
+        )
+
+@router.get("/usage/sessions/{session_id}", response_model=SessionUsage)
+async def get_session_token_usage(
+    session_id: str,
+    admin_user: dict = Depends(get_admin_user)
+):
+    """
+    Gemini token usage of one chat session (flushed totals)
+    """
+    usage = await run_in_threadpool(usage_tracker.get_session_usage, session_id)
+    if usage is None:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail="No token usage recorded for this session"
+        )
+    return usage
+
+@router.get("/profiles")
+async def list_profiles(admin_user: dict = Depends(get_admin_user)):
+    """
+    Request profiles held by this worker, newest first (send X-Profile: 1 as an admin to record one)
+    """
+    profiles = profile_store.list()
+    return {"profiles": profiles, "total": len(profiles)}
+
+@router.get("/profiles/{profile_id}")
+async def get_profile(
+    profile_id: str,
+    admin_user: dict = Depends(get_admin_user),
+    format: Literal["json", "folded"] = "json"
+):
+    """
+    Download a profile: json (metadata, top functions and folded stacks) or
+    folded (collapsed stacks for flamegraph.pl or speedscope)
+    """
+    profile = profile_store.get(profile_id)
+    if profile is None:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail="Profile not found on this worker"
+        )
+    if format == "folded":
+        return PlainTextResponse(
+            profile["folded"],
+            headers={"Content-Disposition": f'attachment; filename="profile-{profile_id}.folded"'}
+        )
+    return profile
@@ -1,4 +1,5 @@
 from fastapi import APIRouter, Depends, HTTPException, status
+from starlette.concurrency import run_in_threadpool
 from app.core.dependencies import get_current_user
 from app.models.chat import ChatRequest, ChatResponse
 from app.services.gemini_service import gemini_service
@@ -26,10 +27,13 @@ async def chat_with_gemini(
             for msg in chat_request.conversation_history
         ] if chat_request.conversation_history else []
         
-        # Get response from Gemini service
-        response_text = gemini_service.chat(
+        # Get response from Gemini service (off the event loop so identical requests can coalesce)
+        response_text = await run_in_threadpool(
+            gemini_service.chat,
             message=chat_request.message,
-            conversation_history=conversation_history
+            conversation_history=conversation_history,
+            user_id=current_user.get("uid"),
+            source="ai"
         )
         
         return ChatResponse(
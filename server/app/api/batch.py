@@ -0,0 +1,124 @@
+import asyncio
+import json
+from fastapi import APIRouter, Depends, HTTPException, status
+from fastapi.responses import StreamingResponse
+from starlette.concurrency import run_in_threadpool
+from app.core.config import settings
+from app.core.dependencies import get_current_user
+from app.models.batch import CreateBatchJobRequest, BatchJobResponse, BatchJobListResponse
+from app.services.batch_service import batch_service, ACTIVE_STATUSES
+from app.services.gemini_service import gemini_service
+
+router = APIRouter(prefix="/batch", tags=["batch"])
+
+@router.post("/jobs", response_model=BatchJobResponse)
+async def create_batch_job(
+    request: CreateBatchJobRequest,
+    current_user: dict = Depends(get_current_user)
+):
+    """Submit a batch of prompts to be generated in the background"""
+    if not gemini_service.is_available():
+        raise HTTPException(
+            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
+            detail="Gemini AI service not available"
+        )
+    try:
+        job = await run_in_threadpool(
+            batch_service.create_job,
+            user_id=current_user.get("uid"),
+            prompts=request.prompts,
+            title=request.title
+        )
+        await batch_service.submit(job.job_id)
+        return job
+    except ValueError as e:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail=str(e)
+        )
+    except Exception as e:
+        print(f"Error creating batch job: {str(e)}")
+        raise HTTPException(
+            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
+            detail=f"Failed to create batch job: {str(e)}"
+        )
+
+@router.get("/jobs", response_model=BatchJobListResponse)
+async def list_batch_jobs(
+    current_user: dict = Depends(get_current_user),
+    limit: int = 20
+):
+    """List the current user's batch jobs"""
+    try:
+        jobs = await run_in_threadpool(batch_service.list_jobs, current_user.get("uid"), limit)
+        return BatchJobListResponse(jobs=jobs, total=len(jobs))
+    except Exception as e:
+        raise HTTPException(
+            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
+            detail=f"Failed to list batch jobs: {str(e)}"
+        )
+
+@router.get("/jobs/{job_id}", response_model=BatchJobResponse)
+async def get_batch_job(
+    job_id: str,
+    current_user: dict = Depends(get_current_user)
+):
+    """Get progress of a batch job"""
+    try:
+        return await run_in_threadpool(batch_service.get_job, job_id, current_user.get("uid"))
+    except ValueError as e:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail=str(e)
+        )
+
+@router.post("/jobs/{job_id}/cancel", response_model=BatchJobResponse)
+async def cancel_batch_job(
+    job_id: str,
+    current_user: dict = Depends(get_current_user)
+):
+    """Cancel a batch job; items already generated are kept"""
+    try:
+        return await run_in_threadpool(batch_service.cancel_job, job_id, current_user.get("uid"))
+    except ValueError as e:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail=str(e)
+        )
+
+@router.get("/jobs/{job_id}/results")
+async def stream_batch_results(
+    job_id: str,
+    current_user: dict = Depends(get_current_user),
+    follow: bool = False
+):
+    """
+    Stream finished items as NDJSON, in prompt order.
+    With follow=true the stream stays open until the job finishes.
+    """
+    user_id = current_user.get("uid")
+    try:
+        await run_in_threadpool(batch_service.get_job, job_id, user_id)
+    except ValueError as e:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail=str(e)
+        )
+
+    async def generate():
+        last_index = -1
+        while True:
+            items = await run_in_threadpool(batch_service.get_items, job_id, user_id, last_index)
+            for item in items:
+                last_index = item.index
+                yield json.dumps(item.model_dump()) + "\n"
+            if items:
+                continue
+            if not follow:
+                return
+            job = await run_in_threadpool(batch_service.get_job, job_id, user_id)
+            if job.status not in ACTIVE_STATUSES and last_index + 1 >= job.completed + job.failed:
+                return
+            await asyncio.sleep(settings.BATCH_RESULTS_POLL_INTERVAL)
+
+    return StreamingResponse(generate(), media_type="application/x-ndjson")
@@ -1,16 +1,22 @@
-from fastapi import APIRouter, Depends, HTTPException, status
+from fastapi import APIRouter, Depends, Header, HTTPException, Request, Response, status
 from fastapi.exceptions import RequestValidationError
-from typing import List
+from fastapi.responses import ORJSONResponse
+from starlette.concurrency import run_in_threadpool
+from typing import List, Optional
 from app.core.dependencies import get_current_user
+from app.core.http_cache import make_etag, etag_matches, not_modified
+from app.core.lifecycle import lifecycle
 from app.models.session import (
     CreateSessionRequest, UpdateSessionRequest, AddMessageRequest,
     SessionResponse, SessionListResponse, SessionMessagesResponse,
     ChatMessage
 )
-from app.models.chat import ChatResponse, StructuredResponse, MultipleStructuredResponse
-import json
+from app.models.chat import ChatResponse
+from app.services.cache import BackendUnavailable
 from app.services.firestore_service import firestore_service
 from app.services.gemini_service import gemini_service
+from app.services.idempotency import idempotency_store, IdempotencyInProgress
+from app.services.response_parser import parse_ai_response
 
 router = APIRouter(prefix="/chat", tags=["chat"])
 
@@ -69,6 +75,8 @@ async def create_chat_session(
 
 @router.get("/sessions", response_model=SessionListResponse)
 async def get_user_sessions(
+    request: Request,
+    response: Response,
     current_user: dict = Depends(get_current_user),
     limit: int = 50
 ):
@@ -81,16 +89,30 @@ async def get_user_sessions(
                 detail="User ID not found in token"
             )
         
-        sessions = firestore_service.get_user_sessions(
+        sessions = await run_in_threadpool(
+            firestore_service.get_user_sessions,
             user_id=user_id,
             limit=limit
         )
+        
+        etag = make_etag("sessions", limit, *(
+            (s.session_id, s.updated_at, s.message_count, s.title) for s in sessions
+        ))
+        if etag_matches(request, etag):
+            return not_modified(etag)
+        response.headers["ETag"] = etag
+        
         return SessionListResponse(sessions=sessions, total=len(sessions))
     except ValueError as e:
         raise HTTPException(
             status_code=status.HTTP_400_BAD_REQUEST,
             detail=str(e)
         )
+    except BackendUnavailable as e:
+        raise HTTPException(
+            status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+            detail=str(e)
+        )
     except Exception as e:
         print(f"Error in get_user_sessions endpoint: {str(e)}")
         raise HTTPException(
@@ -98,18 +120,37 @@ async def get_user_sessions(
             detail=f"Failed to get sessions: {str(e)}"
         )
 
-@router.get("/sessions/{session_id}/messages", response_model=SessionMessagesResponse)
+@router.get(
+    "/sessions/{session_id}/messages",
+    response_model=SessionMessagesResponse,
+    response_class=ORJSONResponse
+)
 async def get_session_messages(
     session_id: str,
+    request: Request,
+    response: Response,
     current_user: dict = Depends(get_current_user),
     limit: int = 100
 ):
     """Get all messages for a specific chat session"""
     try:
-        messages = firestore_service.get_session_messages(
+        # One session document read: an unchanged conversation costs no message reads at all
+        updated_at, message_count = await run_in_threadpool(
+            firestore_service.get_session_version,
+            session_id=session_id,
+            user_id=current_user.get("uid")
+        )
+        etag = make_etag("messages", session_id, limit, updated_at, message_count)
+        if etag_matches(request, etag):
+            return not_modified(etag)
+        response.headers["ETag"] = etag
+        
+        messages = await run_in_threadpool(
+            firestore_service.get_session_messages,
             session_id=session_id,
             user_id=current_user.get("uid"),
-            limit=limit
+            limit=limit,
+            message_count=message_count
         )
         return SessionMessagesResponse(
             session_id=session_id,
@@ -127,112 +168,49 @@ async def get_session_messages(
             detail=f"Failed to get messages: {str(e)}"
         )
 
-@router.post("/sessions/{session_id}/messages", response_model=ChatResponse)
-async def send_message_to_session(
-    session_id: str,
-    request: AddMessageRequest,
-    current_user: dict = Depends(get_current_user)
-):
-    """Send a message to a specific chat session and get AI response"""
-    try:
-        # Debug logging for request validation
-        print(f"Request received - message: '{request.message}', history length: {len(request.conversation_history)}")
-        for i, msg in enumerate(request.conversation_history):
-            print(f"  Message {i}: role={msg.role}, content_length={len(msg.content)}, timestamp={msg.timestamp}")
-        
-        user_id = current_user.get("uid")
-        
-        # Verify AI service is available
-        if not gemini_service.is_available():
-            raise HTTPException(
-                status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
-                detail="Gemini AI service not available"
-            )
-        
+async def _send_message(session_id: str, user_id: str, message: str) -> dict:
+    """Run one chat turn: store the user message, ask Gemini and queue the reply"""
+    # Tracked so a draining worker lets the turn finish before shutting down
+    async with lifecycle.turn():
         # Add user message to session
         firestore_service.add_message_to_session(
             session_id=session_id,
             user_id=user_id,
             role="user",
-            content=request.message
+            content=message
         )
-        
+    
         # Get conversation history from Firestore
-        messages = firestore_service.get_session_messages(
+        messages = await run_in_threadpool(
+            firestore_service.get_recent_messages,
             session_id=session_id,
             user_id=user_id,
-            limit=20  # Last 20 messages for context
+            count=20  # Last 20 messages for context
         )
-        
+    
         # Convert to format expected by Gemini service
         conversation_history = [
             {"role": msg.role, "content": msg.content}
             for msg in messages[:-1]  # Exclude the just-added user message
         ]
-        
-        # Get AI response
-        ai_response = gemini_service.chat(
-            message=request.message,
-            conversation_history=conversation_history
+    
+        # Get AI response (off the event loop so identical requests can coalesce)
+        ai_response = await run_in_threadpool(
+            gemini_service.chat,
+            message=message,
+            conversation_history=conversation_history,
+            session_id=session_id,
+            user_id=user_id,
+            source="chat"
         )
-        
-        # Parse the JSON response - clean up markdown formatting first
-        structured_response = None
-        clean_response = ai_response.strip()
-        
-        # Remove markdown code blocks if present
-        if clean_response.startswith('```json'):
-            clean_response = clean_response[7:]  # Remove ```json
-        if clean_response.startswith('```'):
-            clean_response = clean_response[3:]   # Remove ```
-        if clean_response.endswith('```'):
-            clean_response = clean_response[:-3]  # Remove ending ```
-        
-        clean_response = clean_response.strip()
-        
-        try:
-            # Parse the response as JSON array (enforced by schema)
-            parsed_response = json.loads(clean_response)
-            valid_types = ["text", "ladder", "plc-code"]
-            
-            # Response should always be an array due to schema enforcement
-            if isinstance(parsed_response, list):
-                responses = []
-                valid_responses = True
-                
-                for resp in parsed_response:
-                    if (isinstance(resp, dict) and 
-                        "type" in resp and "content" in resp and 
-                        resp["type"] in valid_types):
-                        responses.append(StructuredResponse(
-                            type=resp["type"],
-                            content=resp["content"],
-                            validation=resp.get("validation")
-                        ))
-                    else:
-                        valid_responses = False
-                        break
-                
-                if valid_responses and responses:
-                    structured_response = MultipleStructuredResponse(responses=responses)
-                    # Store the structured response as JSON for consistency
-                    content_to_store = json.dumps(parsed_response)
-                else:
-                    # Fallback to plain text if validation fails
-                    content_to_store = clean_response
-                    structured_response = None
-            else:
-                # Unexpected format (not array), treat as plain text
-                content_to_store = clean_response
-                structured_response = None
-                
-        except json.JSONDecodeError:
-            # If not valid JSON, treat as plain text
-            content_to_store = clean_response
-            structured_response = None
-        
-        # Add AI response to session
-        firestore_service.add_message_to_session(
+    
+        # Parse the JSON response; items are stored natively, plain text when it isn't a valid item array
+        content_to_store, items = parse_ai_response(ai_response)
+        if items is not None:
+            content_to_store = items
+    
+        # Add AI response to session; the write-behind queue persists it after we respond
+        message_id = firestore_service.queue_message_to_session(
             session_id=session_id,
             user_id=user_id,
             role="assistant",
@@ -241,15 +219,65 @@ async def send_message_to_session(
 
         return ChatResponse(
             response=content_to_store,  # Always return the stored content
+            message_id=message_id,
             structured_response=None,  # Don't return structured_response to avoid confusion
             success=True
+        ).model_dump()
+
+@router.post(
+    "/sessions/{session_id}/messages",
+    response_model=ChatResponse,
+    response_class=ORJSONResponse
+)
+async def send_message_to_session(
+    session_id: str,
+    request: AddMessageRequest,
+    response: Response,
+    current_user: dict = Depends(get_current_user),
+    idempotency_key: Optional[str] = Header(None, alias="Idempotency-Key", max_length=255)
+):
+    """
+    Send a message to a specific chat session and get AI response.
+    
+    With an Idempotency-Key header, a retried request joins the original call
+    or replays its stored response instead of adding the turn again.
+    """
+    try:
+        # Debug logging for request validation
+        print(f"Request received - message: '{request.message}', history length: {len(request.conversation_history)}")
+        for i, msg in enumerate(request.conversation_history):
+            print(f"  Message {i}: role={msg.role}, content_length={len(msg.content)}, timestamp={msg.timestamp}")
+        
+        user_id = current_user.get("uid")
+        
+        # Verify AI service is available
+        if not gemini_service.is_available():
+            raise HTTPException(
+                status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
+                detail="Gemini AI service not available"
+            )
+        
+        if not idempotency_key:
+            return await _send_message(session_id, user_id, request.message)
+        
+        result, replayed = await idempotency_store.run(
+            session_id, user_id, idempotency_key,
+            lambda: _send_message(session_id, user_id, request.message)
         )
+        if replayed:
+            response.headers["Idempotent-Replayed"] = "true"
+        return result
         
     except ValueError as e:
         raise HTTPException(
             status_code=status.HTTP_404_NOT_FOUND,
             detail=str(e)
         )
+    except IdempotencyInProgress as e:
+        raise HTTPException(
+            status_code=status.HTTP_409_CONFLICT,
+            detail=str(e)
+        )
     except Exception as e:
         print(f"Error in send_message_to_session: {str(e)}")
         raise HTTPException(
@@ -304,6 +332,7 @@ async def delete_session(
         )
         
         if success:
+            gemini_service.kb_context.forget(session_id)
             return {"message": "Session deleted successfully"}
         else:
             raise HTTPException(
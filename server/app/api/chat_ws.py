@@ -0,0 +1,211 @@
+import asyncio
+import time
+from fastapi import APIRouter, WebSocket, WebSocketDisconnect
+from pydantic import ValidationError
+from starlette.concurrency import iterate_in_threadpool, run_in_threadpool
+from app.core.config import settings
+from app.core.lifecycle import lifecycle
+from app.models.chat import ChatRequest
+from app.services.firebase_service import firebase_service
+from app.services.firestore_service import firestore_service
+from app.services.gemini_service import RESTART_STREAM, gemini_service
+from app.services.response_parser import StreamingItemParser, parse_ai_response
+
+router = APIRouter(prefix="/chat", tags=["chat"])
+
+# Application close codes (4000-4999 are reserved for applications)
+WS_CLOSE_UNAUTHORIZED = 4401
+WS_CLOSE_NOT_FOUND = 4404
+# Standard "service restart" code: the client should reconnect (to another worker)
+WS_CLOSE_RESTART = 1012
+
+
+class ChatConnection:
+    """Per-connection state: verified user, session metadata and recent history"""
+
+    def __init__(self, websocket: WebSocket, session_id: str):
+        self.websocket = websocket
+        self.session_id = session_id
+        self.user = None
+        self.session = None
+        self.history = []
+
+    @property
+    def uid(self) -> str:
+        return self.user.get("uid")
+
+    def token_expired(self) -> bool:
+        return self.user.get("exp", 0) <= time.time()
+
+    async def authenticate(self, token: str):
+        user = await run_in_threadpool(firebase_service.verify_id_token, token)
+        if self.user is not None and user.get("uid") != self.uid:
+            raise ValueError("Token belongs to a different user")
+        self.user = user
+
+    async def load_session(self):
+        self.session = await run_in_threadpool(firestore_service.get_session, self.session_id, self.uid)
+        messages = await run_in_threadpool(
+            firestore_service.get_recent_messages, self.session_id, self.uid, settings.WS_HISTORY_MESSAGES,
+            self.session.message_count
+        )
+        self.history = [{"role": msg.role, "content": msg.content} for msg in messages]
+
+    def remember(self, role: str, content):
+        self.history.append({"role": role, "content": content})
+        del self.history[:-settings.WS_HISTORY_MESSAGES]
+
+    async def send_error(self, detail: str):
+        await self.websocket.send_json({"type": "error", "detail": detail})
+
+
+async def _receive_auth(connection: ChatConnection) -> bool:
+    """Wait for the initial auth frame; close the socket if it is missing or invalid"""
+    websocket = connection.websocket
+    try:
+        frame = await asyncio.wait_for(websocket.receive_json(), timeout=settings.WS_AUTH_TIMEOUT)
+        if frame.get("type") != "auth" or not frame.get("token"):
+            raise ValueError("First message must be an auth frame")
+        await connection.authenticate(frame["token"])
+    except WebSocketDisconnect:
+        return False
+    except Exception as e:
+        print(f"WebSocket authentication error: {str(e)}")
+        await websocket.close(code=WS_CLOSE_UNAUTHORIZED, reason="Invalid authentication credentials")
+        return False
+
+    try:
+        await connection.load_session()
+    except ValueError as e:
+        await websocket.close(code=WS_CLOSE_NOT_FOUND, reason=str(e)[:120])
+        return False
+    return True
+
+
+async def _handle_turn(connection: ChatConnection, message: str):
+    """Stream one assistant reply and queue both messages of the turn"""
+    websocket = connection.websocket
+    conversation_history = list(connection.history)
+
+    # Ownership was verified at connect time, so the turn goes straight to the queue
+    firestore_service.queue_message_to_session(
+        session_id=connection.session_id,
+        user_id=connection.uid,
+        role="user",
+        content=message
+    )
+    connection.remember("user", message)
+
+    parser = StreamingItemParser()
+    chunks = iterate_in_threadpool(gemini_service.chat_stream(
+        message=message,
+        conversation_history=conversation_history,
+        session_id=connection.session_id,
+        user_id=connection.uid,
+        source="ws"
+    ))
+    async for chunk in chunks:
+        if chunk is RESTART_STREAM:
+            # The reply ran out of tokens and is being regenerated
+            parser = StreamingItemParser()
+            await websocket.send_json({"type": "restart"})
+            continue
+        for item in parser.feed(chunk):
+            await websocket.send_json({"type": "item", "item": item})
+
+    content_to_store, items = parse_ai_response(parser.text)
+    if items is not None:
+        content_to_store = items
+    message_id = firestore_service.queue_message_to_session(
+        session_id=connection.session_id,
+        user_id=connection.uid,
+        role="assistant",
+        content=content_to_store
+    )
+    connection.remember("assistant", content_to_store)
+
+    await websocket.send_json({
+        "type": "done",
+        "message_id": message_id,
+        "response": content_to_store
+    })
+
+
+@router.websocket("/sessions/{session_id}/ws")
+async def chat_session_socket(websocket: WebSocket, session_id: str):
+    """
+    Persistent chat channel for one session.
+
+    Protocol (JSON frames):
+      client -> {"type": "auth", "token": "<Firebase ID token>"}   (first frame; may be resent to refresh)
+      server -> {"type": "ready", "session": {...}}
+      client -> {"type": "message", "message": "..."}
+      server -> {"type": "item", "item": {...}} for each response item as it completes
+      server -> {"type": "restart"} when a truncated reply is regenerated (drop the items received so far)
+      server -> {"type": "done", "message_id": "...", "response": <stored item array, or text>}
+      server -> {"type": "error", "detail": "..."}
+    """
+    await websocket.accept()
+    connection = ChatConnection(websocket, session_id)
+
+    if not await _receive_auth(connection):
+        return
+
+    await websocket.send_json({"type": "ready", "session": connection.session.model_dump(mode="json")})
+
+    try:
+        while True:
+            try:
+                frame = await websocket.receive_json()
+            except ValueError:
+                await connection.send_error("Frames must be JSON objects")
+                continue
+            frame_type = frame.get("type") if isinstance(frame, dict) else None
+
+            if frame_type == "auth":
+                try:
+                    await connection.authenticate(frame.get("token", ""))
+                    await websocket.send_json({"type": "auth_ok"})
+                except Exception as e:
+                    print(f"WebSocket re-authentication error: {str(e)}")
+                    await websocket.close(code=WS_CLOSE_UNAUTHORIZED, reason="Invalid authentication credentials")
+                    return
+                continue
+
+            if frame_type != "message":
+                await connection.send_error("Expected a message frame")
+                continue
+            try:
+                # Same validation as the HTTP endpoint: the message must be text
+                message = ChatRequest(message=frame.get("message")).message
+            except ValidationError:
+                message = None
+            if not message or not message.strip():
+                await connection.send_error("Message frames need a non-empty text message")
+                continue
+
+            if connection.token_expired():
+                await connection.send_error("Authentication token expired; send a new auth frame")
+                continue
+
+            if not gemini_service.is_available():
+                await connection.send_error("Gemini AI service not available")
+                continue
+
+            if lifecycle.draining:
+                await websocket.close(code=WS_CLOSE_RESTART, reason="Server restarting; reconnect")
+                return
+
+            try:
+                async with lifecycle.turn():
+                    await _handle_turn(connection, message)
+            except ValueError as e:
+                await connection.send_error(str(e))
+            except WebSocketDisconnect:
+                raise
+            except Exception as e:
+                print(f"Error in chat websocket: {str(e)}")
+                await connection.send_error(f"Failed to send message: {str(e)}")
+
+    except WebSocketDisconnect:
+        pass
@@ -0,0 +1,43 @@
+from fastapi import APIRouter, Depends, HTTPException, status
+from starlette.concurrency import run_in_threadpool
+from app.core.dependencies import get_current_user
+from app.models.feedback import FeedbackRequest, FeedbackAcceptedResponse
+from app.services.feedback_service import answer_text, feedback_service
+from app.services.firestore_service import firestore_service
+
+router = APIRouter(prefix="/feedback", tags=["feedback"])
+
+@router.post("", response_model=FeedbackAcceptedResponse, status_code=status.HTTP_202_ACCEPTED)
+async def submit_feedback(
+    request: FeedbackRequest,
+    current_user: dict = Depends(get_current_user)
+):
+    """
+    Record accurate/inaccurate ratings of assistant messages.
+    The rated question and answer are read from the caller's own session;
+    events are buffered and written to Firestore in the background.
+    """
+    user_id = current_user.get("uid")
+    events = []
+    for event in request.events:
+        try:
+            pair = await run_in_threadpool(
+                firestore_service.get_rated_pair, event.session_id, user_id, event.message_id
+            )
+        except ValueError:
+            pair = None
+        if pair is None:
+            raise HTTPException(
+                status_code=status.HTTP_404_NOT_FOUND,
+                detail="Message not found or access denied"
+            )
+        question, answer = pair
+        events.append({
+            "session_id": event.session_id,
+            "message_id": event.message_id,
+            "user_question": question,
+            "assistant_response": answer_text(answer),
+            "rating": event.rating,
+        })
+    accepted = feedback_service.record(user_id, events)
+    return FeedbackAcceptedResponse(accepted=accepted)
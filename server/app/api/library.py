@@ -1,14 +1,19 @@
-from fastapi import APIRouter, Depends, HTTPException, status
-from typing import List
+from fastapi import APIRouter, Depends, HTTPException, Request, Response, status
+from fastapi.responses import ORJSONResponse
+from starlette.concurrency import run_in_threadpool
+from typing import List, Literal, Union
 from app.core.dependencies import get_current_user
+from app.core.http_cache import make_etag, etag_matches, not_modified
 from app.models.library import (
     CreateLibraryEntryRequest, LibrarySearchRequest,
-    LibraryEntryResponse, LibrarySearchResponse, LibraryStatsResponse
+    LibraryEntryResponse, LibraryEntrySummary, LibrarySearchResponse,
+    LibrarySummarySearchResponse, LibraryStatsResponse
 )
+from app.services.cache import BackendUnavailable
 from app.services.firestore_service import firestore_service
+from app.services.library_service import library_service, make_preview
+from app.services.feedback_service import question_key
 from google.cloud.firestore import FieldFilter
-from firebase_admin import firestore
-import uuid
 from datetime import datetime
 
 router = APIRouter(prefix="/library", tags=["library"])
@@ -22,29 +27,28 @@ async def save_to_library(
     try:
         user_id = current_user.get("uid")
         
-        # Create library entry
-        entry_id = str(uuid.uuid4())
-        
         # Get user's display name from the token
         user_name = current_user.get("name") or current_user.get("email", "Anonymous User")
         
         entry_data = {
-            "entry_id": entry_id,
             "user_id": user_id,
             "user_name": user_name,
             "user_question": request.user_question,
+            "question_key": question_key(request.user_question),
             "assistant_response": request.assistant_response,
             "session_id": request.session_id,
             "message_pair_id": request.message_pair_id,
+            "response_preview": make_preview(request.assistant_response),
             "created_at": datetime.utcnow(),
             "tags": request.tags or [],
             "category": request.category
         }
         
-        # Save to Firestore
-        firestore_service.db.collection("knowledge_library").document(entry_id).set(entry_data)
+        # Save to Firestore, merging into an existing entry when this answer is already there
+        saved = await run_in_threadpool(library_service.save_entry, entry_data)
         
-        return {"entry_id": entry_id, "message": "Successfully saved to library"}
+        message = "Successfully saved to library" if saved["duplicate"] is None else "Already in library; save counted"
+        return {"entry_id": saved["entry_id"], "duplicate": saved["duplicate"], "message": message}
         
     except Exception as e:
         print(f"Error saving to library: {str(e)}")
@@ -53,35 +57,40 @@ async def save_to_library(
             detail=f"Failed to save to library: {str(e)}"
         )
 
-@router.get("/entries", response_model=List[LibraryEntryResponse])
+@router.get(
+    "/entries",
+    response_model=Union[List[LibraryEntryResponse], List[LibraryEntrySummary]],
+    response_class=ORJSONResponse
+)
 async def get_library_entries(
+    request: Request,
+    response: Response,
     current_user: dict = Depends(get_current_user),
-    limit: int = 50
+    limit: int = 50,
+    view: Literal["full", "summary"] = "full"
 ):
-    """Get all library entries from all users (global library)"""
+    """
+    Get all library entries from all users (global library).
+    view=summary returns previews only; fetch the full answer from /entries/{entry_id}.
+    """
     try:
         user_id = current_user.get("uid")
         
-        # Get all entries from Firestore (global library)
-        entries_ref = firestore_service.db.collection("knowledge_library")
-        query = entries_ref.order_by("created_at", direction=firestore.Query.DESCENDING).limit(limit)
-        
-        entries = []
-        for doc in query.stream():
-            data = doc.to_dict()
-            entries.append(LibraryEntryResponse(
-                entry_id=data["entry_id"],
-                user_name=data.get("user_name", "Anonymous User"),
-                user_question=data["user_question"],
-                assistant_response=data["assistant_response"],
-                session_id=data["session_id"],
-                created_at=data["created_at"],
-                tags=data.get("tags", []),
-                category=data.get("category")
-            ))
-        
-        return entries
+        # The version read can wait on Firestore, so keep it off the event loop
+        version = await run_in_threadpool(library_service.get_version)
+        etag = make_etag("entries", view, limit, version)
+        if etag_matches(request, etag):
+            return not_modified(etag)
+        response.headers["ETag"] = etag
+        
+        # Get entries from Firestore (global library)
+        return await run_in_threadpool(library_service.list_entries, limit, view == "summary")
         
+    except BackendUnavailable as e:
+        raise HTTPException(
+            status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+            detail=str(e)
+        )
     except Exception as e:
         print(f"Error getting library entries: {str(e)}")
         raise HTTPException(
@@ -89,7 +98,37 @@ async def get_library_entries(
             detail=f"Failed to get library entries: {str(e)}"
         )
 
-@router.post("/search", response_model=LibrarySearchResponse)
+@router.get("/entries/{entry_id}", response_model=LibraryEntryResponse, response_class=ORJSONResponse)
+async def get_library_entry(
+    entry_id: str,
+    current_user: dict = Depends(get_current_user)
+):
+    """Get a single library entry including the full assistant response"""
+    try:
+        entry = await run_in_threadpool(library_service.get_entry, entry_id)
+    except BackendUnavailable as e:
+        raise HTTPException(
+            status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+            detail=str(e)
+        )
+    except Exception as e:
+        print(f"Error getting library entry: {str(e)}")
+        raise HTTPException(
+            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
+            detail=f"Failed to get library entry: {str(e)}"
+        )
+    if entry is None:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail="Library entry not found"
+        )
+    return entry
+
+@router.post(
+    "/search",
+    response_model=Union[LibrarySearchResponse, LibrarySummarySearchResponse],
+    response_class=ORJSONResponse
+)
 async def search_library(
     request: LibrarySearchRequest,
     current_user: dict = Depends(get_current_user)
@@ -99,29 +138,21 @@ async def search_library(
         user_id = current_user.get("uid")
         
         # Get all entries from all users - let frontend handle search/filtering
-        entries_ref = firestore_service.db.collection("knowledge_library")
-        query = entries_ref
-        
-        all_entries = []
-        for doc in query.stream():
-            data = doc.to_dict()
-            all_entries.append(LibraryEntryResponse(
-                entry_id=data["entry_id"],
-                user_name=data.get("user_name", "Anonymous User"),
-                user_question=data["user_question"],
-                assistant_response=data["assistant_response"],
-                session_id=data["session_id"],
-                created_at=data["created_at"],
-                tags=data.get("tags", []),
-                category=data.get("category")
-            ))
-        
-        return LibrarySearchResponse(
+        summary = request.view == "summary"
+        all_entries = await run_in_threadpool(library_service.all_entries, summary)
+        
+        response_class = LibrarySummarySearchResponse if summary else LibrarySearchResponse
+        return response_class(
             entries=all_entries,
             total=len(all_entries),
             query=request.query
         )
         
+    except BackendUnavailable as e:
+        raise HTTPException(
+            status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+            detail=str(e)
+        )
     except Exception as e:
         print(f"Error searching library: {str(e)}")
         raise HTTPException(
@@ -131,28 +162,25 @@ async def search_library(
 
 @router.get("/stats", response_model=LibraryStatsResponse)
 async def get_library_stats(
+    request: Request,
+    response: Response,
     current_user: dict = Depends(get_current_user)
 ):
     """Get statistics about the global library"""
     try:
         user_id = current_user.get("uid")
         
-        # Get all entries from all users
-        entries_ref = firestore_service.db.collection("knowledge_library")
-        query = entries_ref
+        version = await run_in_threadpool(library_service.get_version)
+        etag = make_etag("stats", version)
+        if etag_matches(request, etag):
+            return not_modified(etag)
+        response.headers["ETag"] = etag
         
-        entries = []
-        for doc in query.stream():
-            entries.append(doc.to_dict())
+        # Basic category count, reading only the category field of each entry
+        category_counts = await run_in_threadpool(library_service.category_counts)
         
         # Simple stats - let frontend handle complex calculations
-        total_entries = len(entries)
-        
-        # Basic category count
-        category_counts = {}
-        for entry in entries:
-            category = entry.get("category") or "General"
-            category_counts[category] = category_counts.get(category, 0) + 1
+        total_entries = sum(category_counts.values())
         
         categories = [{"name": name, "count": count} for name, count in category_counts.items()]
         categories.sort(key=lambda x: x["count"], reverse=True)
@@ -163,6 +191,11 @@ async def get_library_stats(
             recent_entries_count=0  # Frontend will calculate this
         )
         
+    except BackendUnavailable as e:
+        raise HTTPException(
+            status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+            detail=str(e)
+        )
     except Exception as e:
         print(f"Error getting library stats: {str(e)}")
         raise HTTPException(
@@ -9,12 +9,154 @@ class Settings:
     HOST: str = os.getenv("HOST", "0.0.0.0")
     PORT: int = int(os.getenv("PORT", 8000))
     DEBUG: bool = os.getenv("DEBUG", "True").lower() == "true"
+    # Production runner (gunicorn -c gunicorn.conf.py); WEB_CONCURRENCY is the platform-standard worker count
+    WEB_CONCURRENCY: int = int(os.getenv("WEB_CONCURRENCY", min(4, (os.cpu_count() or 1) * 2)))
+    # On SIGTERM a worker stops accepting connections and waits this long for in-flight chat turns
+    SHUTDOWN_DRAIN_TIMEOUT: float = float(os.getenv("SHUTDOWN_DRAIN_TIMEOUT", 30))
+    # Extra time gunicorn allows after the drain for queues to flush before killing a worker
+    SHUTDOWN_FLUSH_TIMEOUT: float = float(os.getenv("SHUTDOWN_FLUSH_TIMEOUT", 30))
+    
+    # Responses smaller than this many bytes are sent uncompressed
+    GZIP_MINIMUM_SIZE: int = int(os.getenv("GZIP_MINIMUM_SIZE", 1024))
     
     # Firebase settings
     FIREBASE_SERVICE_ACCOUNT_PATH: str = "firebase-service-account.json"
     
+    # Admin access (comma-separated Firebase UIDs / emails allowed on /admin endpoints; emails must be verified)
+    ADMIN_UIDS: list = [uid.strip() for uid in os.getenv("ADMIN_UIDS", "").split(",") if uid.strip()]
+    ADMIN_EMAILS: list = [email.strip().lower() for email in os.getenv("ADMIN_EMAILS", "").split(",") if email.strip()]
+    
+    # Chat persistence settings
+    # Assistant messages and session metadata are flushed by a background write-behind queue
+    WRITE_BEHIND_FLUSH_INTERVAL: float = float(os.getenv("WRITE_BEHIND_FLUSH_INTERVAL", 0.5))
+    WRITE_BEHIND_BATCH_SIZE: int = int(os.getenv("WRITE_BEHIND_BATCH_SIZE", 400))  # Firestore caps batches at 500 writes
+    WRITE_BEHIND_MAX_RETRIES: int = int(os.getenv("WRITE_BEHIND_MAX_RETRIES", 5))
+    # Per-user cache of the sidebar session list (per worker, kept fresh by write-through)
+    # Session lists are also refetched whenever the user's shared session_list_versions document moves
+    SESSION_CACHE_TTL: float = float(os.getenv("SESSION_CACHE_TTL", 60))  # served without a refresh
+    SESSION_CACHE_HARD_TTL: float = float(os.getenv("SESSION_CACHE_HARD_TTL", 600))  # served while refreshing
+    SESSION_CACHE_MAX_USERS: int = int(os.getenv("SESSION_CACHE_MAX_USERS", 1000))
+    # Stale-while-revalidate reads: how long a request waits on Firestore before falling back to cached data
+    FIRESTORE_READ_DEADLINE: float = float(os.getenv("FIRESTORE_READ_DEADLINE", 2.0))
+    SWR_MAX_STALE: float = float(os.getenv("SWR_MAX_STALE", 24 * 3600))  # oldest copy served when a read fails
+    SWR_WORKERS: int = int(os.getenv("SWR_WORKERS", 8))  # threads running cache loads per process
+    # Older messages are packed into compressed archive buckets; the newest stay one document each
+    ARCHIVE_HOT_MESSAGES: int = int(os.getenv("ARCHIVE_HOT_MESSAGES", 50))
+    ARCHIVE_BUCKET_MESSAGES: int = int(os.getenv("ARCHIVE_BUCKET_MESSAGES", 100))
+    ARCHIVE_COMPACTION_PAUSE: float = float(os.getenv("ARCHIVE_COMPACTION_PAUSE", 1.0))  # seconds between sessions
+    # Ladder/code blocks at least this long are stored once in message_blobs and referenced by hash
+    MESSAGE_BLOB_MIN_CHARS: int = int(os.getenv("MESSAGE_BLOB_MIN_CHARS", 1024))
+    MESSAGE_BLOB_CACHE_SIZE: int = int(os.getenv("MESSAGE_BLOB_CACHE_SIZE", 2000))
+    MESSAGE_BLOB_CACHE_TTL: float = float(os.getenv("MESSAGE_BLOB_CACHE_TTL", 3600))
+    # Blobs (re)written this recently are never deleted by `python -m app.services.message_format sweep`
+    MESSAGE_BLOB_SWEEP_GRACE: float = float(os.getenv("MESSAGE_BLOB_SWEEP_GRACE", 3600))
+    # In-memory tail of recent messages per active session (feeds the next turn's history)
+    TAIL_CACHE_MESSAGES: int = int(os.getenv("TAIL_CACHE_MESSAGES", 50))
+    TAIL_CACHE_IDLE_TTL: float = float(os.getenv("TAIL_CACHE_IDLE_TTL", 600))
+    TAIL_CACHE_MAX_BYTES: int = int(os.getenv("TAIL_CACHE_MAX_BYTES", 64 * 1024 * 1024))
+    # Idempotency-Key handling for send-message retries
+    IDEMPOTENCY_TTL: float = float(os.getenv("IDEMPOTENCY_TTL", 24 * 3600))  # how long completed keys replay
+    IDEMPOTENCY_CACHE_SIZE: int = int(os.getenv("IDEMPOTENCY_CACHE_SIZE", 5000))  # completed keys kept per worker
+    IDEMPOTENCY_WAIT: float = float(os.getenv("IDEMPOTENCY_WAIT", 120))  # max wait on a key held by another worker
+    IDEMPOTENCY_POLL_INTERVAL: float = float(os.getenv("IDEMPOTENCY_POLL_INTERVAL", 0.5))
+    
+    # WebSocket chat settings
+    WS_AUTH_TIMEOUT: float = float(os.getenv("WS_AUTH_TIMEOUT", 10))  # seconds to send the auth frame
+    WS_HISTORY_MESSAGES: int = int(os.getenv("WS_HISTORY_MESSAGES", 20))  # history kept per connection
+    
+    # Batch generation settings
+    BATCH_WORKERS: int = int(os.getenv("BATCH_WORKERS", 4))  # concurrent Gemini calls per process
+    BATCH_REQUESTS_PER_MINUTE: int = int(os.getenv("BATCH_REQUESTS_PER_MINUTE", 60))
+    BATCH_MAX_PROMPTS: int = int(os.getenv("BATCH_MAX_PROMPTS", 1000))
+    BATCH_MAX_ATTEMPTS: int = int(os.getenv("BATCH_MAX_ATTEMPTS", 4))
+    BATCH_LEASE_SECONDS: float = float(os.getenv("BATCH_LEASE_SECONDS", 90))
+    BATCH_RESULTS_POLL_INTERVAL: float = float(os.getenv("BATCH_RESULTS_POLL_INTERVAL", 2))
+    
+    # Library settings
+    # How long a worker trusts its copy of the library version counter (drives library ETags)
+    LIBRARY_VERSION_TTL: float = float(os.getenv("LIBRARY_VERSION_TTL", 5))
+    # Library reads are cached per library version and reloaded once the version moves
+    LIBRARY_CACHE_TTL: float = float(os.getenv("LIBRARY_CACHE_TTL", 300))  # served without a refresh
+    LIBRARY_CACHE_HARD_TTL: float = float(os.getenv("LIBRARY_CACHE_HARD_TTL", 3600))  # served while refreshing
+    LIBRARY_READ_DEADLINE: float = float(os.getenv("LIBRARY_READ_DEADLINE", 5.0))
+    LIBRARY_PREVIEW_CHARS: int = int(os.getenv("LIBRARY_PREVIEW_CHARS", 200))  # answer preview in list views
+    # Saves that repeat an entry (same normalized text, or MinHash similarity above the threshold) merge into it
+    LIBRARY_DEDUP_THRESHOLD: float = float(os.getenv("LIBRARY_DEDUP_THRESHOLD", 0.8))
+    LIBRARY_MINHASH_PERMUTATIONS: int = int(os.getenv("LIBRARY_MINHASH_PERMUTATIONS", 64))
+    LIBRARY_LSH_BANDS: int = int(os.getenv("LIBRARY_LSH_BANDS", 16))  # 16 bands of 4 rows: candidates from ~0.5 similarity
+    LIBRARY_DEDUP_CANDIDATES: int = int(os.getenv("LIBRARY_DEDUP_CANDIDATES", 20))
+    # Differently worded near-duplicates kept on the matched entry; further ones become entries of their own
+    LIBRARY_MAX_VARIANTS: int = int(os.getenv("LIBRARY_MAX_VARIANTS", 5))
+    
+    # Dense retrieval over KB chunks and library entries (needs NumPy; keyword-only otherwise).
+    # Opt-in, and only used once its golden-set recall matches keyword retrieval
+    DENSE_RETRIEVAL: bool = os.getenv("DENSE_RETRIEVAL", "False").lower() == "true"
+    DENSE_HASH_DIM: int = int(os.getenv("DENSE_HASH_DIM", 1024))  # hashed feature space
+    DENSE_DIM: int = int(os.getenv("DENSE_DIM", 128))  # SVD output dims once the corpus is large enough
+    DENSE_SVD_MIN_DOCS: int = int(os.getenv("DENSE_SVD_MIN_DOCS", 2000))
+    DENSE_ENCODE_BATCH: int = int(os.getenv("DENSE_ENCODE_BATCH", 1024))
+    DENSE_CHUNK_CHARS: int = int(os.getenv("DENSE_CHUNK_CHARS", 1200))
+    DENSE_CANDIDATES: int = int(os.getenv("DENSE_CANDIDATES", 20))
+    DENSE_BLEND_ALPHA: float = float(os.getenv("DENSE_BLEND_ALPHA", 0.6))  # weight of dense vs keyword score
+    DENSE_MIN_SIMILARITY: float = float(os.getenv("DENSE_MIN_SIMILARITY", 0.15))
+    DENSE_REFRESH_INTERVAL: float = float(os.getenv("DENSE_REFRESH_INTERVAL", 300))
+    DENSE_LIBRARY_MAX_INACCURATE: int = int(os.getenv("DENSE_LIBRARY_MAX_INACCURATE", 2))  # skip disputed answers
+    DENSE_GOLDEN_PATH: str = os.getenv(
+        "DENSE_GOLDEN_PATH",
+        os.path.join(os.path.dirname(os.path.dirname(os.path.dirname(__file__))), "benchmarks", "retrieval_golden.json")
+    )
+    DENSE_GOLDEN_K: int = int(os.getenv("DENSE_GOLDEN_K", 3))  # recall@k compared by the gate
+    
+    # Per-session KB context: follow-up turns keep the previous turn's passages in the prompt
+    KB_CONTEXT_MAX_PASSAGES: int = int(os.getenv("KB_CONTEXT_MAX_PASSAGES", 6))
+    KB_CONTEXT_MAX_SESSIONS: int = int(os.getenv("KB_CONTEXT_MAX_SESSIONS", 5000))
+    KB_CONTEXT_TTL: float = float(os.getenv("KB_CONTEXT_TTL", 3600))
+    KB_FOLLOW_UP_MAX_WORDS: int = int(os.getenv("KB_FOLLOW_UP_MAX_WORDS", 4))  # shorter turns borrow the last question
+    
+    # Feedback ingestion (ratings are buffered in memory and flushed in batches)
+    FEEDBACK_FLUSH_INTERVAL: float = float(os.getenv("FEEDBACK_FLUSH_INTERVAL", 2))
+    FEEDBACK_BATCH_SIZE: int = int(os.getenv("FEEDBACK_BATCH_SIZE", 200))  # events + aggregates per batch stay under 500
+    # Events carry the full question and answer, so the buffer is capped by size
+    FEEDBACK_MAX_BUFFER_BYTES: int = int(os.getenv("FEEDBACK_MAX_BUFFER_BYTES", 64 * 1024 * 1024))
+    # Rated messages are looked up in this many recent messages before reading the whole session
+    FEEDBACK_LOOKUP_MESSAGES: int = int(os.getenv("FEEDBACK_LOOKUP_MESSAGES", 40))
+    
+    # Request profiling (admin X-Profile header or random sampling); profiles kept in a per-worker ring buffer
+    PROFILE_SAMPLE_RATE: float = float(os.getenv("PROFILE_SAMPLE_RATE", 0.0))  # share of all requests, 0 = header only
+    PROFILE_INTERVAL: float = float(os.getenv("PROFILE_INTERVAL", 0.005))  # seconds between stack samples
+    PROFILE_BUFFER_SIZE: int = int(os.getenv("PROFILE_BUFFER_SIZE", 20))
+    PROFILE_MAX_STACKS: int = int(os.getenv("PROFILE_MAX_STACKS", 5000))  # distinct stacks kept per profile
+    
+    # Gemini token usage accounting (aggregated in memory, flushed to usage_daily / usage_sessions)
+    USAGE_FLUSH_INTERVAL: float = float(os.getenv("USAGE_FLUSH_INTERVAL", 10))
+    USAGE_MAX_PENDING: int = int(os.getenv("USAGE_MAX_PENDING", 20000))  # user-days + sessions awaiting a flush
+    # USD per million tokens, used for cost estimates (gemini-2.0-flash list prices)
+    GEMINI_INPUT_COST_PER_MTOK: float = float(os.getenv("GEMINI_INPUT_COST_PER_MTOK", 0.10))
+    GEMINI_CACHED_COST_PER_MTOK: float = float(os.getenv("GEMINI_CACHED_COST_PER_MTOK", 0.025))
+    GEMINI_OUTPUT_COST_PER_MTOK: float = float(os.getenv("GEMINI_OUTPUT_COST_PER_MTOK", 0.40))
+    
+    # Bulk export/import of sessions and the library (python -m app.services.bulk_transfer)
+    EXPORT_PAGE_SIZE: int = int(os.getenv("EXPORT_PAGE_SIZE", 500))  # documents read per Firestore query
+    EXPORT_COMPRESSION_LEVEL: int = int(os.getenv("EXPORT_COMPRESSION_LEVEL", 6))
+    IMPORT_CHECKPOINT_EVERY: int = int(os.getenv("IMPORT_CHECKPOINT_EVERY", 5000))  # lines between flush + checkpoint
+    IMPORT_INITIAL_OPS_PER_SECOND: int = int(os.getenv("IMPORT_INITIAL_OPS_PER_SECOND", 500))  # BulkWriter ramps up 50% every 5 min
+    IMPORT_MAX_OPS_PER_SECOND: int = int(os.getenv("IMPORT_MAX_OPS_PER_SECOND", 5000))
+    IMPORT_MAX_ATTEMPTS: int = int(os.getenv("IMPORT_MAX_ATTEMPTS", 10))
+    
     # Gemini AI settings
     GEMINI_API_KEY: str = os.getenv("GEMINI_API_KEY", "")
+    # Local off-topic gate: "off", "shadow" (classify and compare with Gemini, never block) or "enforce"
+    SCOPE_GATE_MODE: str = os.getenv("SCOPE_GATE_MODE", "shadow").lower()
+    # Questions scoring below this on-topic probability are answered with the canned rejection
+    # (tuned with `python -m benchmarks.bench_scope` against held-out in-scope questions)
+    SCOPE_GATE_THRESHOLD: float = float(os.getenv("SCOPE_GATE_THRESHOLD", 0.02))
+    
+    # Knowledge base settings
+    # Built with `python -m app.services.kb_index build`; raw kb/ files are used when missing
+    KB_INDEX_PATH: str = os.getenv(
+        "KB_INDEX_PATH",
+        os.path.join(os.path.dirname(os.path.dirname(__file__)), "services", "kb.idx")
+    )
     
     # CORS settings
     ALLOWED_ORIGINS: list = [
@@ -1,5 +1,6 @@
 from fastapi import Depends, HTTPException, status
 from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
+from app.core.config import settings
 from app.services.firebase_service import firebase_service
 
 # Security
@@ -26,3 +27,25 @@ async def get_current_user(credentials: HTTPAuthorizationCredentials = Depends(s
             detail=f"Invalid authentication credentials: {str(e)}",
             headers={"WWW-Authenticate": "Bearer"},
         )
+
+def is_admin(user: dict) -> bool:
+    """Whether a decoded token belongs to a user listed in ADMIN_UIDS or ADMIN_EMAILS.
+
+    Emails only count once Firebase has verified them; anyone can sign up
+    an unverified account with an admin's address.
+    """
+    if user.get("uid") in settings.ADMIN_UIDS:
+        return True
+    email = (user.get("email") or "").lower()
+    return bool(email and email in settings.ADMIN_EMAILS and user.get("email_verified") is True)
+
+async def get_admin_user(current_user: dict = Depends(get_current_user)) -> dict:
+    """
+    Require an authenticated user listed in ADMIN_UIDS or ADMIN_EMAILS
+    """
+    if is_admin(current_user):
+        return current_user
+    raise HTTPException(
+        status_code=status.HTTP_403_FORBIDDEN,
+        detail="Admin access required"
+    )
@@ -0,0 +1,77 @@
+import hashlib
+from contextvars import ContextVar
+from typing import List, Optional
+from fastapi import Request, Response
+from starlette.datastructures import MutableHeaders
+
+# Sources of stale cached data used for the current request (see StaleMarkerMiddleware)
+_stale_sources: ContextVar[Optional[List[str]]] = ContextVar("stale_sources", default=None)
+
+
+def make_etag(*parts) -> str:
+    """Weak ETag from the version fields that identify a response body"""
+    digest = hashlib.sha1("|".join(str(part) for part in parts).encode("utf-8")).hexdigest()
+    return f'W/"{digest[:20]}"'
+
+
+def etag_matches(request: Request, etag: str) -> bool:
+    """Check If-None-Match using weak comparison"""
+    header = request.headers.get("if-none-match")
+    if not header:
+        return False
+    if header.strip() == "*":
+        return True
+    bare = etag[2:] if etag.startswith("W/") else etag
+    for candidate in header.split(","):
+        candidate = candidate.strip()
+        if candidate.startswith("W/"):
+            candidate = candidate[2:]
+        if candidate == bare:
+            return True
+    return False
+
+
+def not_modified(etag: str) -> Response:
+    """Empty 304 response carrying the current ETag"""
+    return Response(status_code=304, headers={"ETag": etag})
+
+
+def mark_stale(source: str):
+    """Record that the current response is built from stale cached data"""
+    sources = _stale_sources.get()
+    if sources is not None and source not in sources:
+        sources.append(source)
+
+
+class StaleMarkerMiddleware:
+    """Flags responses served from stale cache entries.
+
+    Adds ``Served-Stale: <sources>`` and drops the ETag, so clients neither
+    mistake the body for current data nor revalidate against it later.
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        # A list rather than a flag: worker threads see a copy of the context but share the list
+        sources: List[str] = []
+        token = _stale_sources.set(sources)
+
+        async def send_with_marker(message):
+            if message["type"] == "http.response.start" and sources:
+                headers = MutableHeaders(scope=message)
+                headers["Served-Stale"] = ", ".join(sources)
+                headers["Cache-Control"] = "no-store"
+                if "etag" in headers:
+                    del headers["etag"]
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_marker)
+        finally:
+            _stale_sources.reset(token)
@@ -0,0 +1,76 @@
+import asyncio
+import time
+from contextlib import asynccontextmanager
+from typing import Optional
+from app.services.metrics import metrics
+
+
+class Lifecycle:
+    """Readiness and in-flight chat turns of this worker.
+
+    The worker is ready once application startup has finished and stops
+    being ready as soon as it starts draining for shutdown. Chat turns
+    (HTTP sends and WebSocket turns) run inside turn(), so the drain can
+    wait for them to finish before connections are closed.
+    """
+    _instance = None
+    _initialized = False
+
+    def __new__(cls):
+        if cls._instance is None:
+            cls._instance = super().__new__(cls)
+        return cls._instance
+
+    def __init__(self):
+        if not self._initialized:
+            self.ready = False
+            self.draining = False
+            self.inflight = 0
+            self.completed_turns = 0
+            self.startup_seconds: Optional[float] = None
+            self.drain_seconds: Optional[float] = None
+            self.abandoned_turns = 0
+            metrics.register("lifecycle", self.stats)
+            self._initialized = True
+
+    def mark_ready(self, startup_seconds: float):
+        self.startup_seconds = round(startup_seconds, 3)
+        self.ready = not self.draining
+
+    def begin_drain(self):
+        self.draining = True
+        self.ready = False
+
+    @asynccontextmanager
+    async def turn(self):
+        """Track one chat turn so the shutdown drain waits for it"""
+        self.inflight += 1
+        try:
+            yield
+        finally:
+            self.inflight -= 1
+            self.completed_turns += 1
+
+    async def wait_idle(self, timeout: float) -> bool:
+        """Wait up to timeout seconds for in-flight turns; False if some are still running"""
+        started_at = time.monotonic()
+        while self.inflight and time.monotonic() - started_at < timeout:
+            await asyncio.sleep(0.1)
+        self.drain_seconds = round(time.monotonic() - started_at, 3)
+        self.abandoned_turns = self.inflight
+        return not self.inflight
+
+    def stats(self) -> dict:
+        return {
+            "ready": self.ready,
+            "draining": self.draining,
+            "inflight_turns": self.inflight,
+            "completed_turns": self.completed_turns,
+            "startup_seconds": self.startup_seconds,
+            "drain_seconds": self.drain_seconds,
+            "abandoned_turns": self.abandoned_turns,
+        }
+
+
+# Create singleton instance
+lifecycle = Lifecycle()
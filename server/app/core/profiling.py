@@ -0,0 +1,74 @@
+import random
+import time
+from starlette.concurrency import run_in_threadpool
+from starlette.datastructures import MutableHeaders
+from app.core.config import settings
+from app.core.dependencies import is_admin
+from app.services.firebase_service import firebase_service
+from app.services.profiler import profile_store
+
+PROFILE_HEADER = b"x-profile"
+
+
+async def _admin_requested(scope) -> bool:
+    """True when the request carries X-Profile and an admin's bearer token"""
+    if not any(name == PROFILE_HEADER for name, _ in scope["headers"]):
+        return False
+    authorization = dict(scope["headers"]).get(b"authorization", b"").decode("latin-1")
+    scheme, _, token = authorization.partition(" ")
+    if scheme.lower() != "bearer" or not token:
+        return False
+    try:
+        user = await run_in_threadpool(firebase_service.verify_id_token, token)
+    except Exception:
+        return False
+    return is_admin(user)
+
+
+class ProfilingMiddleware:
+    """Samples requests that an admin asks for, or a random PROFILE_SAMPLE_RATE share of all requests.
+
+    Profiles land in the profile store (listed and downloaded under
+    /admin/profiles) and the response carries their id in X-Profile-Id.
+    Unprofiled requests only pay for a header lookup and a random draw.
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        if settings.PROFILE_SAMPLE_RATE > 0 and random.random() < settings.PROFILE_SAMPLE_RATE:
+            trigger = "sample"
+        elif await _admin_requested(scope):
+            trigger = "header"
+        else:
+            await self.app(scope, receive, send)
+            return
+
+        profiler = profile_store.begin()
+        if profiler is None:
+            await self.app(scope, receive, send)
+            return
+
+        profile_id = profile_store.new_id()
+        status_code = None
+        started_at = time.perf_counter()
+
+        async def send_with_id(message):
+            nonlocal status_code
+            if message["type"] == "http.response.start":
+                status_code = message["status"]
+                MutableHeaders(scope=message)["X-Profile-Id"] = profile_id
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_id)
+        finally:
+            # stop() joins the sampler thread and the folding walks every stack: keep both off the event loop
+            await run_in_threadpool(
+                profile_store.finish, profiler, profile_id, scope["method"], scope["path"], status_code, trigger, started_at
+            )
@@ -0,0 +1,80 @@
+"""
+Gunicorn worker for the production runner (see gunicorn.conf.py).
+
+A UvicornWorker on uvloop and httptools that drains on SIGTERM: it stops
+accepting connections, marks itself not ready, waits up to
+SHUTDOWN_DRAIN_TIMEOUT for in-flight chat turns, and only then runs the
+regular uvicorn shutdown, whose lifespan handler stops batch workers and
+flushes the write-behind, feedback and token usage queues. Stock uvicorn
+would close open WebSockets with 1012 immediately, cutting off replies
+that are still streaming.
+"""
+import asyncio
+import os
+import signal
+import sys
+import time
+from gunicorn.arbiter import Arbiter
+from uvicorn.server import Server
+from uvicorn.workers import UvicornWorker
+from app.core.config import settings
+from app.core.lifecycle import lifecycle
+
+
+class DrainingServer(Server):
+    def __init__(self, config, worker: "DrainingUvicornWorker"):
+        super().__init__(config=config)
+        self.worker = worker
+
+    def handle_exit(self, sig, frame):
+        # A second SIGTERM, or SIGINT/SIGQUIT, falls through to the immediate uvicorn shutdown
+        if sig == signal.SIGTERM and not lifecycle.draining and not self.should_exit:
+            asyncio.ensure_future(self.drain())
+            return
+        super().handle_exit(sig, frame)
+
+    async def drain(self):
+        for server in getattr(self, "servers", []):
+            server.close()
+        lifecycle.begin_drain()
+        print(f"Worker {os.getpid()} draining: {lifecycle.inflight} chat turns in flight")
+        if await lifecycle.wait_idle(settings.SHUTDOWN_DRAIN_TIMEOUT):
+            print(f"Worker {os.getpid()} drained in {lifecycle.drain_seconds}s")
+        else:
+            print(f"Worker {os.getpid()} drain deadline passed with {lifecycle.inflight} chat turns in flight")
+        self.should_exit = True
+
+    async def startup(self, sockets=None):
+        started_at = time.monotonic()
+        await super().startup(sockets=sockets)
+        if not self.should_exit:
+            self.worker.log_startup(time.monotonic() - started_at)
+
+
+class DrainingUvicornWorker(UvicornWorker):
+    CONFIG_KWARGS = {"loop": "uvloop", "http": "httptools"}
+
+    def init_process(self):
+        # Runs in the child right after the fork
+        self.forked_at = time.monotonic()
+        super().init_process()
+
+    def load_wsgi(self):
+        started_at = time.monotonic()
+        super().load_wsgi()
+        self.import_seconds = time.monotonic() - started_at
+
+    def log_startup(self, startup_seconds: float):
+        total = time.monotonic() - self.forked_at
+        print(
+            f"Worker {os.getpid()} ready in {total:.2f}s "
+            f"(app import {self.import_seconds:.2f}s, startup {startup_seconds:.2f}s)"
+        )
+
+    async def _serve(self):
+        self.config.app = self.wsgi
+        server = DrainingServer(config=self.config, worker=self)
+        self._install_sigquit_handler()
+        await server.serve(sockets=self.sockets)
+        if not server.started:
+            sys.exit(Arbiter.WORKER_BOOT_ERROR)
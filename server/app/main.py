@@ -1,8 +1,13 @@
+import time
 from fastapi import FastAPI, Request
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.middleware.gzip import GZipMiddleware
 from fastapi.exceptions import RequestValidationError
 from fastapi.responses import JSONResponse
 from app.core.config import settings
+from app.core.http_cache import StaleMarkerMiddleware
+from app.core.lifecycle import lifecycle
+from app.core.profiling import ProfilingMiddleware
 from app.api.main import api_router
 from app.services.firebase_service import firebase_service
 from app.services.gemini_service import gemini_service
@@ -23,6 +28,15 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+# Compress large payloads (message histories, library dumps); small responses go out as-is
+app.add_middleware(GZipMiddleware, minimum_size=settings.GZIP_MINIMUM_SIZE)
+
+# Mark responses built from stale cached data while Firestore is slow or failing
+app.add_middleware(StaleMarkerMiddleware)
+
+# Sample requests an admin asks for with X-Profile (or PROFILE_SAMPLE_RATE of all requests)
+app.add_middleware(ProfilingMiddleware)
+
 # Initialize services (this will trigger the singleton initialization)
 firebase_service  # Initialize Firebase
 gemini_service    # Initialize Gemini
@@ -31,6 +45,27 @@ gemini_service    # Initialize Gemini
 from app.services.firestore_service import firestore_service
 firestore_service  # Initialize Firestore
 
+from app.services.batch_service import batch_service
+from app.services.feedback_service import feedback_service
+from app.services.usage_service import usage_tracker
+
+@app.on_event("startup")
+async def start_background_workers():
+    """Start the batch job worker pool, resume unfinished jobs and build the dense retrieval index"""
+    started_at = time.monotonic()
+    await batch_service.start()
+    gemini_service.retriever.start()
+    lifecycle.mark_ready(time.monotonic() - started_at)
+
+@app.on_event("shutdown")
+async def stop_background_workers():
+    """Stop batch workers, then drain buffered feedback, token usage and the chat write-behind queue before the process exits"""
+    await batch_service.stop()
+    gemini_service.retriever.stop()
+    feedback_service.stop()
+    usage_tracker.stop()
+    firestore_service.flush_pending_writes()
+
 # Add exception handler for validation errors
 @app.exception_handler(RequestValidationError)
 async def validation_exception_handler(request: Request, exc: RequestValidationError):
@@ -74,3 +109,18 @@ async def health_check():
         "firebase_ready": True,
         "gemini_ready": gemini_service.is_available()
     }
+
+@app.get("/ready")
+async def readiness_check():
+    """
+    Readiness probe: 503 until startup has finished and again once the worker is draining for shutdown
+    """
+    status_code = 200 if lifecycle.ready else 503
+    return JSONResponse(
+        status_code=status_code,
+        content={
+            "status": "ready" if lifecycle.ready else ("draining" if lifecycle.draining else "starting"),
+            "firestore_ready": firestore_service.is_available(),
+            "gemini_ready": gemini_service.is_available()
+        }
+    )
@@ -0,0 +1,28 @@
+from pydantic import BaseModel, Field
+from typing import Optional, List
+from datetime import datetime
+
+class CreateBatchJobRequest(BaseModel):
+    prompts: List[str] = Field(..., min_length=1)
+    title: Optional[str] = None
+
+class BatchJobResponse(BaseModel):
+    job_id: str
+    title: Optional[str] = None
+    status: str  # 'queued', 'running', 'completed' or 'cancelled'
+    total: int
+    completed: int = 0
+    failed: int = 0
+    created_at: datetime
+    updated_at: datetime
+
+class BatchJobListResponse(BaseModel):
+    jobs: List[BatchJobResponse]
+    total: int
+
+class BatchItemResult(BaseModel):
+    index: int
+    prompt: str
+    status: str  # 'pending', 'done' or 'failed'
+    response: Optional[str] = None
+    error: Optional[str] = None
@@ -24,6 +24,7 @@ class MultipleStructuredResponse(BaseModel):
     responses: List[StructuredResponse]
 
 class ChatResponse(BaseModel):
-    response: str
+    response: Union[str, List[dict]]  # item array for structured replies
+    message_id: Optional[str] = None  # id of the stored assistant message (used to rate it)
     structured_response: Optional[Union[StructuredResponse, MultipleStructuredResponse]] = None
     success: bool = True
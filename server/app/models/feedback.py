@@ -0,0 +1,28 @@
+from pydantic import BaseModel, Field
+from typing import Optional, List, Literal
+from datetime import datetime
+
+class FeedbackEvent(BaseModel):
+    session_id: str
+    message_id: str = Field(..., min_length=1, max_length=255)  # assistant message being rated
+    # Ignored: the question and answer are loaded from the session (kept so older clients still validate)
+    user_question: Optional[str] = Field(None, max_length=10000)
+    assistant_response: Optional[str] = Field(None, max_length=50000)
+    rating: Literal["accurate", "inaccurate"]
+
+class FeedbackRequest(BaseModel):
+    events: List[FeedbackEvent] = Field(..., min_length=1, max_length=100)
+
+class FeedbackAcceptedResponse(BaseModel):
+    accepted: int
+
+class QuestionFeedback(BaseModel):
+    question_key: str
+    user_question: str
+    accurate: int = 0
+    inaccurate: int = 0
+    last_feedback_at: Optional[datetime] = None
+
+class QuestionFeedbackListResponse(BaseModel):
+    questions: List[QuestionFeedback]
+    total: int
@@ -1,5 +1,5 @@
 from pydantic import BaseModel, Field
-from typing import Optional, List
+from typing import Optional, List, Literal
 from datetime import datetime
 
 class LibraryEntry(BaseModel):
@@ -27,6 +27,14 @@ class LibrarySearchRequest(BaseModel):
     limit: Optional[int] = 20
     category: Optional[str] = None
     tags: Optional[List[str]] = []
+    view: Literal["full", "summary"] = "full"
+
+class LibraryVariant(BaseModel):
+    """Near-duplicate save whose wording differs from the entry it was merged into"""
+    user_name: Optional[str] = None
+    user_question: str
+    assistant_response: str
+    saved_at: Optional[datetime] = None
 
 class LibraryEntryResponse(BaseModel):
     entry_id: str
@@ -37,12 +45,33 @@ class LibraryEntryResponse(BaseModel):
     created_at: datetime
     tags: List[str]
     category: Optional[str] = None
+    save_count: int = 1  # users who saved this answer (or a near-duplicate)
+    contributors: List[str] = []
+    variants: List[LibraryVariant] = []
+
+class LibraryEntrySummary(BaseModel):
+    """List view of an entry: the full answer is fetched separately by entry_id"""
+    entry_id: str
+    user_name: Optional[str] = None
+    user_question: str
+    response_preview: str
+    session_id: str
+    created_at: datetime
+    tags: List[str]
+    category: Optional[str] = None
+    save_count: int = 1
+    contributors: List[str] = []
 
 class LibrarySearchResponse(BaseModel):
     entries: List[LibraryEntryResponse]
     total: int
     query: str
 
+class LibrarySummarySearchResponse(BaseModel):
+    entries: List[LibraryEntrySummary]
+    total: int
+    query: str
+
 class LibraryStatsResponse(BaseModel):
     total_entries: int
     categories: List[dict]  # [{"name": "category", "count": 5}]
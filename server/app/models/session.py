@@ -1,10 +1,10 @@
 from pydantic import BaseModel, Field
-from typing import Optional, List
+from typing import Optional, List, Union
 from datetime import datetime
 
 class ChatMessage(BaseModel):
     role: str  # 'user' or 'assistant'
-    content: str
+    content: Union[str, List[dict]]  # text, or the item array of a structured assistant reply
     timestamp: Optional[datetime] = None
     message_id: Optional[str] = None
 
@@ -0,0 +1,29 @@
+from pydantic import BaseModel
+from typing import Optional, List, Dict
+from datetime import datetime
+
+class UsageTotals(BaseModel):
+    calls: int = 0
+    prompt_tokens: int = 0
+    output_tokens: int = 0
+    cached_tokens: int = 0
+    cost_usd: float = 0.0
+    latency_ms: float = 0.0
+    sections: Dict[str, int] = {}  # prompt tokens by section: system, kb_context, history, message
+    sources: Dict[str, int] = {}   # calls by request type: chat, ws, ai, batch
+    profiles: Dict[str, int] = {}  # calls by generation profile
+
+class UserUsage(UsageTotals):
+    user_id: str
+
+class UsageReport(BaseModel):
+    days: int
+    since: str
+    totals: UsageTotals
+    users: List[UserUsage]
+    total_users: int
+
+class SessionUsage(UsageTotals):
+    session_id: str
+    user_id: Optional[str] = None
+    updated_at: Optional[datetime] = None
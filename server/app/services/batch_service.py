@@ -0,0 +1,369 @@
+import asyncio
+import os
+import socket
+import time
+import uuid
+from datetime import datetime, timedelta
+from typing import List, Optional
+from firebase_admin import firestore
+from google.cloud.firestore import FieldFilter
+from starlette.concurrency import run_in_threadpool
+from app.core.config import settings
+from app.models.batch import BatchJobResponse, BatchItemResult
+from app.services.firestore_service import firestore_service
+from app.services.gemini_service import gemini_service
+from app.services.metrics import metrics
+from app.services.response_parser import parse_ai_response
+
+ACTIVE_STATUSES = ["queued", "running"]
+
+
+class RateLimiter:
+    """Async token bucket that spaces upstream calls to a requests-per-minute budget"""
+
+    def __init__(self, per_minute: int):
+        self.interval = 60.0 / max(per_minute, 1)
+        self._next_slot = 0.0
+        self._lock = asyncio.Lock()
+        self._penalty_until = 0.0
+
+    async def acquire(self):
+        async with self._lock:
+            now = time.monotonic()
+            slot = max(now, self._next_slot, self._penalty_until)
+            self._next_slot = slot + self.interval
+        await asyncio.sleep(max(0.0, slot - time.monotonic()))
+
+    def penalize(self, seconds: float):
+        """Pause everyone after the upstream reports rate limiting"""
+        self._penalty_until = max(self._penalty_until, time.monotonic() + seconds)
+
+
+def _is_rate_limited(error: Exception) -> bool:
+    text = str(error).lower()
+    return "429" in text or "resource exhausted" in text or "quota" in text or "rate limit" in text
+
+
+class BatchJobService:
+    """Runs batch generation jobs on a bounded async worker pool.
+
+    Jobs and their items are persisted in ``batch_jobs/{job_id}/items``. A
+    process claims a job with a short lease, so after a restart (or a worker
+    crash) the job is picked up again and only items still pending are sent
+    to Gemini.
+    """
+    _instance = None
+    _initialized = False
+
+    def __new__(cls):
+        if cls._instance is None:
+            cls._instance = super().__new__(cls)
+        return cls._instance
+
+    def __init__(self):
+        if not self._initialized:
+            self.worker_id = f"{socket.gethostname()}:{os.getpid()}"
+            self._queue: Optional[asyncio.Queue] = None
+            self._tasks: List[asyncio.Task] = []
+            self._limiter: Optional[RateLimiter] = None
+            self._owned_jobs = set()
+            self.items_processed = 0
+            self.items_failed = 0
+            self.rate_limited = 0
+            metrics.register("batch_jobs", self.stats)
+            self._initialized = True
+
+    @property
+    def db(self):
+        return firestore_service.db
+
+    def _job_ref(self, job_id: str):
+        return self.db.collection("batch_jobs").document(job_id)
+
+    def stats(self) -> dict:
+        return {
+            "workers": len(self._tasks),
+            "queued_items": self._queue.qsize() if self._queue is not None else 0,
+            "owned_jobs": len(self._owned_jobs),
+            "items_processed": self.items_processed,
+            "items_failed": self.items_failed,
+            "rate_limited": self.rate_limited,
+        }
+
+    # Lifecycle
+
+    async def start(self):
+        """Start the worker pool and resume unfinished jobs (called on startup)"""
+        if self._tasks or not firestore_service.is_available():
+            return
+        self._queue = asyncio.Queue()
+        self._limiter = RateLimiter(settings.BATCH_REQUESTS_PER_MINUTE)
+        self._tasks = [asyncio.create_task(self._worker()) for _ in range(settings.BATCH_WORKERS)]
+        self._tasks.append(asyncio.create_task(self._resume_loop()))
+
+    async def stop(self):
+        """Stop workers; unfinished items stay pending and resume on the next start"""
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+        jobs = list(self._owned_jobs)
+        self._owned_jobs.clear()
+        for job_id in jobs:
+            # Release the lease so another process can take over immediately
+            await run_in_threadpool(self._job_ref(job_id).update, {"lease_expires_at": datetime.utcnow()})
+
+    # Job management
+
+    def create_job(self, user_id: str, prompts: List[str], title: Optional[str] = None) -> BatchJobResponse:
+        if len(prompts) > settings.BATCH_MAX_PROMPTS:
+            raise ValueError(f"A batch job can contain at most {settings.BATCH_MAX_PROMPTS} prompts")
+
+        job_id = str(uuid.uuid4())
+        now = datetime.utcnow()
+        job_data = {
+            "job_id": job_id,
+            "user_id": user_id,
+            "title": title,
+            "status": "queued",
+            "total": len(prompts),
+            "completed": 0,
+            "failed": 0,
+            "created_at": now,
+            "updated_at": now,
+            "owner": None,
+            "lease_expires_at": now,
+        }
+        job_ref = self._job_ref(job_id)
+
+        # Items first, then the job document, so a resumed job always has all its items
+        for start in range(0, len(prompts), 400):
+            batch = self.db.batch()
+            for index in range(start, min(start + 400, len(prompts))):
+                batch.set(job_ref.collection("items").document(f"{index:06d}"), {
+                    "index": index,
+                    "prompt": prompts[index],
+                    "status": "pending",
+                    "response": None,
+                    "error": None,
+                    "attempts": 0,
+                })
+            batch.commit()
+        job_ref.set(job_data)
+
+        return self._job_response(job_data)
+
+    async def submit(self, job_id: str):
+        """Claim a freshly created job and queue its items"""
+        await self._claim_and_enqueue(job_id)
+
+    def get_job(self, job_id: str, user_id: str) -> BatchJobResponse:
+        return self._job_response(self._get_job_data(job_id, user_id))
+
+    def list_jobs(self, user_id: str, limit: int = 20) -> List[BatchJobResponse]:
+        """A user's newest jobs, newest first"""
+        query = self.db.collection("batch_jobs").where(filter=FieldFilter("user_id", "==", user_id))
+        try:
+            # Needs a composite index on (user_id, created_at desc)
+            ordered = query.order_by("created_at", direction=firestore.Query.DESCENDING).limit(limit)
+            return [self._job_response(doc.to_dict()) for doc in ordered.stream()]
+        except Exception as e:
+            print(f"Error with ordered batch job query, sorting all of the user's jobs: {e}")
+            jobs = [self._job_response(doc.to_dict()) for doc in query.stream()]
+            jobs.sort(key=lambda job: job.created_at, reverse=True)
+            return jobs[:limit]
+
+    def cancel_job(self, job_id: str, user_id: str) -> BatchJobResponse:
+        job_data = self._get_job_data(job_id, user_id)
+        if job_data["status"] in ACTIVE_STATUSES:
+            job_data["status"] = "cancelled"
+            job_data["updated_at"] = datetime.utcnow()
+            self._job_ref(job_id).update({"status": "cancelled", "updated_at": job_data["updated_at"]})
+        return self._job_response(job_data)
+
+    def get_items(self, job_id: str, user_id: str, after_index: int = -1, limit: int = 500) -> List[BatchItemResult]:
+        """Finished items (done or failed) with index greater than after_index"""
+        self._get_job_data(job_id, user_id)
+        query = (
+            self._job_ref(job_id).collection("items")
+            .where(filter=FieldFilter("index", ">", after_index))
+            .order_by("index")
+            .limit(limit)
+        )
+        items = []
+        for doc in query.stream():
+            data = doc.to_dict()
+            if data["status"] == "pending":
+                # Results stream in index order; stop at the first unfinished item
+                break
+            items.append(BatchItemResult(
+                index=data["index"],
+                prompt=data["prompt"],
+                status=data["status"],
+                response=data.get("response"),
+                error=data.get("error"),
+            ))
+        return items
+
+    def _get_job_data(self, job_id: str, user_id: str) -> dict:
+        doc = self._job_ref(job_id).get()
+        if not doc.exists or doc.to_dict().get("user_id") != user_id:
+            raise ValueError("Batch job not found or access denied")
+        return doc.to_dict()
+
+    @staticmethod
+    def _job_response(data: dict) -> BatchJobResponse:
+        return BatchJobResponse(
+            job_id=data["job_id"],
+            title=data.get("title"),
+            status=data["status"],
+            total=data["total"],
+            completed=data.get("completed", 0),
+            failed=data.get("failed", 0),
+            created_at=data["created_at"],
+            updated_at=data["updated_at"],
+        )
+
+    # Claiming and resuming
+
+    def _claim_job(self, job_id: str) -> bool:
+        """Take the job's lease if it is free, expired or already ours"""
+        job_ref = self._job_ref(job_id)
+        worker_id = self.worker_id
+
+        @firestore.transactional
+        def claim(transaction):
+            snapshot = job_ref.get(transaction=transaction)
+            if not snapshot.exists:
+                return False
+            data = snapshot.to_dict()
+            if data["status"] not in ACTIVE_STATUSES:
+                return False
+            lease = data.get("lease_expires_at")
+            if data.get("owner") not in (None, worker_id) and lease is not None and \
+                    lease.replace(tzinfo=None) > datetime.utcnow():
+                return False
+            transaction.update(job_ref, {
+                "owner": worker_id,
+                "status": "running",
+                "lease_expires_at": datetime.utcnow() + timedelta(seconds=settings.BATCH_LEASE_SECONDS),
+            })
+            return True
+
+        return claim(self.db.transaction())
+
+    def _pending_items(self, job_id: str) -> List[dict]:
+        query = (
+            self._job_ref(job_id).collection("items")
+            .where(filter=FieldFilter("status", "==", "pending"))
+        )
+        return sorted((doc.to_dict() for doc in query.stream()), key=lambda item: item["index"])
+
+    async def _claim_and_enqueue(self, job_id: str):
+        if job_id in self._owned_jobs:
+            return
+        if not await run_in_threadpool(self._claim_job, job_id):
+            return
+        self._owned_jobs.add(job_id)
+        pending = await run_in_threadpool(self._pending_items, job_id)
+        if not pending:
+            await run_in_threadpool(self._finish_job_if_done, job_id)
+            return
+        for item in pending:
+            await self._queue.put((job_id, item["index"], item["prompt"], item.get("attempts", 0)))
+
+    async def _resume_loop(self):
+        """Periodically pick up active jobs whose owner's lease has lapsed"""
+        while True:
+            try:
+                query = self.db.collection("batch_jobs").where(
+                    filter=FieldFilter("status", "in", ACTIVE_STATUSES)
+                )
+                docs = await run_in_threadpool(lambda: list(query.stream()))
+                for doc in docs:
+                    await self._claim_and_enqueue(doc.id)
+                # Keep the leases of jobs we are still working on alive
+                for job_id in list(self._owned_jobs):
+                    await run_in_threadpool(self._job_ref(job_id).update, {
+                        "lease_expires_at": datetime.utcnow() + timedelta(seconds=settings.BATCH_LEASE_SECONDS)
+                    })
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                print(f"Error resuming batch jobs: {str(e)}")
+            await asyncio.sleep(settings.BATCH_LEASE_SECONDS / 3)
+
+    # Processing
+
+    async def _worker(self):
+        while True:
+            job_id, index, prompt, attempts = await self._queue.get()
+            try:
+                await self._process_item(job_id, index, prompt, attempts)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                print(f"Error processing batch item {job_id}/{index}: {str(e)}")
+            finally:
+                self._queue.task_done()
+
+    async def _process_item(self, job_id: str, index: int, prompt: str, attempts: int):
+        job_doc = await run_in_threadpool(self._job_ref(job_id).get)
+        job_data = job_doc.to_dict() if job_doc.exists else {}
+        if job_data.get("status") != "running":
+            # Cancelled (or deleted) while queued
+            self._owned_jobs.discard(job_id)
+            return
+
+        while True:
+            await self._limiter.acquire()
+            attempts += 1
+            try:
+                ai_response = await run_in_threadpool(
+                    gemini_service.chat,
+                    message=prompt,
+                    conversation_history=[],
+                    user_id=job_data.get("user_id"),
+                    source="batch"
+                )
+                content_to_store, _ = parse_ai_response(ai_response)
+                await run_in_threadpool(self._record_item, job_id, index, "done", content_to_store, None, attempts)
+                self.items_processed += 1
+                return
+            except Exception as e:
+                if _is_rate_limited(e):
+                    self.rate_limited += 1
+                    self._limiter.penalize(min(2 ** attempts, 60))
+                if attempts >= settings.BATCH_MAX_ATTEMPTS:
+                    await run_in_threadpool(self._record_item, job_id, index, "failed", None, str(e), attempts)
+                    self.items_failed += 1
+                    return
+                await asyncio.sleep(min(2 ** attempts, 30))
+
+    def _record_item(self, job_id: str, index: int, status: str, response: Optional[str],
+                     error: Optional[str], attempts: int):
+        job_ref = self._job_ref(job_id)
+        batch = self.db.batch()
+        batch.update(job_ref.collection("items").document(f"{index:06d}"), {
+            "status": status,
+            "response": response,
+            "error": error,
+            "attempts": attempts,
+        })
+        batch.update(job_ref, {
+            "completed" if status == "done" else "failed": firestore.Increment(1),
+            "updated_at": datetime.utcnow(),
+        })
+        batch.commit()
+        self._finish_job_if_done(job_id)
+
+    def _finish_job_if_done(self, job_id: str):
+        job_ref = self._job_ref(job_id)
+        data = job_ref.get().to_dict()
+        if data and data["status"] == "running" and data["completed"] + data["failed"] >= data["total"]:
+            job_ref.update({"status": "completed", "owner": None, "updated_at": datetime.utcnow()})
+            self._owned_jobs.discard(job_id)
+
+
+# Create singleton instance
+batch_service = BatchJobService()
@@ -0,0 +1,246 @@
+"""
+Bulk export and import of chat sessions and the knowledge library as gzip NDJSON.
+
+Each line is one Firestore document:
+
+    {"kind": "session", "path": "chat_sessions/<id>", "data": {...}}
+
+with kind one of session, message (``chat_sessions/<id>/messages``),
+archive (compressed buckets under ``chat_sessions/<id>/archive``), blob
+(shared code blocks in ``message_blobs``, exported after the sessions) or
+library. Timestamps are written as {"$date": iso} and bytes as
+{"$bytes": base64}, so documents come back with their original types.
+Idempotency records are short-lived retry keys and are not exported.
+
+Export pages through collections by document id and streams compressed
+chunks, so memory stays flat however large the collections are. Import
+writes through a BulkWriter (parallel, rate-limited, retried) and saves a
+checkpoint every IMPORT_CHECKPOINT_EVERY lines once those writes are
+committed; a rerun with the same checkpoint file resumes after it. Writes
+are plain sets, so lines replayed after a crash are harmless.
+
+    python -m app.services.bulk_transfer export sessions backup/sessions.ndjson.gz
+    python -m app.services.bulk_transfer export library backup/library.ndjson.gz
+    python -m app.services.bulk_transfer import backup/sessions.ndjson.gz --checkpoint sessions.ckpt
+"""
+import argparse
+import base64
+import gzip
+import json
+import os
+import time
+import zlib
+from datetime import datetime
+from typing import Iterator, List, Optional
+from google.cloud.firestore_v1.bulk_writer import BulkWriterOptions
+from app.core.config import settings
+from app.services.firestore_service import firestore_service
+from app.services.message_format import BLOB_COLLECTION
+
+COLLECTIONS = ("sessions", "library")
+KINDS = ("session", "message", "archive", "blob", "library")
+# Archive buckets are up to ~900 KB each, so they are fetched a few at a time
+ARCHIVE_PAGE_SIZE = 10
+# Uncompressed NDJSON gathered before each compressor call
+CHUNK_BYTES = 256 * 1024
+
+
+def _encode_value(value):
+    if isinstance(value, datetime):
+        return {"$date": value.isoformat()}
+    if isinstance(value, bytes):
+        return {"$bytes": base64.b64encode(value).decode("ascii")}
+    raise TypeError(f"Cannot export value of type {type(value).__name__}")
+
+
+def _decode_object(obj: dict):
+    if len(obj) == 1:
+        if "$date" in obj:
+            return datetime.fromisoformat(obj["$date"])
+        if "$bytes" in obj:
+            return base64.b64decode(obj["$bytes"])
+    return obj
+
+
+def encode_record(kind: str, path: str, data: dict) -> bytes:
+    return json.dumps(
+        {"kind": kind, "path": path, "data": data}, default=_encode_value, separators=(",", ":")
+    ).encode("utf-8") + b"\n"
+
+
+def decode_record(line: str) -> dict:
+    return json.loads(line, object_hook=_decode_object)
+
+
+def paged_documents(collection, page_size: int) -> Iterator:
+    """All documents of a collection, one page in memory at a time"""
+    last = None
+    while True:
+        query = collection.order_by("__name__").limit(page_size)
+        if last is not None:
+            query = query.start_after(last)
+        docs = list(query.stream())
+        yield from docs
+        if len(docs) < page_size:
+            return
+        last = docs[-1]
+
+
+def iter_records(collection: str) -> Iterator[bytes]:
+    """NDJSON lines of a collection; sessions are followed by their messages and archive buckets"""
+    db = firestore_service.db
+    page_size = settings.EXPORT_PAGE_SIZE
+    if collection == "library":
+        for doc in paged_documents(db.collection("knowledge_library"), page_size):
+            yield encode_record("library", doc.reference.path, doc.to_dict())
+        return
+
+    for session in paged_documents(db.collection("chat_sessions"), page_size):
+        yield encode_record("session", session.reference.path, session.to_dict())
+        for doc in paged_documents(session.reference.collection("messages"), page_size):
+            yield encode_record("message", doc.reference.path, doc.to_dict())
+        for doc in paged_documents(session.reference.collection("archive"), ARCHIVE_PAGE_SIZE):
+            yield encode_record("archive", doc.reference.path, doc.to_dict())
+    for doc in paged_documents(db.collection(BLOB_COLLECTION), page_size):
+        yield encode_record("blob", doc.reference.path, doc.to_dict())
+
+
+def export_gzip(collection: str) -> Iterator[bytes]:
+    """Gzip-compressed NDJSON export of a collection, as a stream of chunks"""
+    if collection not in COLLECTIONS:
+        raise ValueError(f"Unknown collection: {collection}")
+    compressor = zlib.compressobj(settings.EXPORT_COMPRESSION_LEVEL, zlib.DEFLATED, 31)  # 31: gzip container
+    pending: List[bytes] = []
+    pending_bytes = 0
+    for line in iter_records(collection):
+        pending.append(line)
+        pending_bytes += len(line)
+        if pending_bytes >= CHUNK_BYTES:
+            chunk = compressor.compress(b"".join(pending))
+            pending, pending_bytes = [], 0
+            if chunk:
+                yield chunk
+    yield compressor.compress(b"".join(pending)) + compressor.flush()
+
+
+def export_to_file(collection: str, path: str) -> dict:
+    """Write an export to path (through a temporary file, so a failed export leaves nothing behind)"""
+    started = time.monotonic()
+    written = 0
+    partial = path + ".partial"
+    with open(partial, "wb") as target:
+        for chunk in export_gzip(collection):
+            target.write(chunk)
+            written += len(chunk)
+    os.replace(partial, path)
+    return {"collection": collection, "bytes": written, "seconds": round(time.monotonic() - started, 1)}
+
+
+def _load_checkpoint(checkpoint_path: Optional[str], source: str) -> dict:
+    if not checkpoint_path or not os.path.exists(checkpoint_path):
+        return {"line": 0, "written": 0}
+    with open(checkpoint_path, "r", encoding="utf-8") as f:
+        checkpoint = json.load(f)
+    if checkpoint.get("source") != os.path.basename(source) or checkpoint.get("size") != os.path.getsize(source):
+        raise ValueError(f"Checkpoint {checkpoint_path} belongs to a different export file")
+    return checkpoint
+
+
+def _save_checkpoint(checkpoint_path: Optional[str], source: str, line: int, written: int):
+    if not checkpoint_path:
+        return
+    partial = checkpoint_path + ".partial"
+    with open(partial, "w", encoding="utf-8") as f:
+        json.dump({
+            "source": os.path.basename(source),
+            "size": os.path.getsize(source),
+            "line": line,
+            "written": written,
+            "saved_at": datetime.utcnow().isoformat(),
+        }, f)
+    os.replace(partial, checkpoint_path)
+
+
+def import_file(source: str, checkpoint_path: Optional[str] = None, kinds: Optional[List[str]] = None) -> dict:
+    """Write an export back to Firestore, resuming after the checkpoint when there is one.
+
+    Raises RuntimeError when writes still fail after IMPORT_MAX_ATTEMPTS; the
+    checkpoint then stays at the last fully committed line.
+    """
+    db = firestore_service.db
+    checkpoint = _load_checkpoint(checkpoint_path, source)
+    start_line = checkpoint["line"]
+    stats = {"resumed_at": start_line, "written": checkpoint["written"], "skipped": 0, "lines": start_line}
+    failures = []
+
+    def on_error(failure, bulk_writer) -> bool:
+        if failure.attempts < settings.IMPORT_MAX_ATTEMPTS:
+            return True
+        failures.append(f"{failure.operation.reference.path}: {failure.message}")
+        return False
+
+    writer = db.bulk_writer(BulkWriterOptions(
+        initial_ops_per_second=settings.IMPORT_INITIAL_OPS_PER_SECOND,
+        max_ops_per_second=settings.IMPORT_MAX_OPS_PER_SECOND,
+    ))
+    writer.on_write_error(on_error)
+    library_written = False
+
+    def commit(line_no: int):
+        # Blocks until every write queued so far has landed (or finally failed)
+        writer.flush()
+        if failures:
+            raise RuntimeError(f"{len(failures)} writes failed before line {line_no}; first: {failures[0]}")
+        _save_checkpoint(checkpoint_path, source, line_no, stats["written"])
+
+    try:
+        with gzip.open(source, "rt", encoding="utf-8") as lines:
+            line_no = 0
+            for line_no, line in enumerate(lines, 1):
+                if line_no <= start_line:
+                    continue
+                record = decode_record(line)
+                if record["kind"] not in KINDS or (kinds and record["kind"] not in kinds):
+                    stats["skipped"] += 1
+                else:
+                    writer.set(db.document(record["path"]), record["data"])
+                    stats["written"] += 1
+                    library_written = library_written or record["kind"] == "library"
+                if line_no % settings.IMPORT_CHECKPOINT_EVERY == 0:
+                    commit(line_no)
+                    print(f"Imported {line_no} lines ({stats['written']} documents)")
+            commit(line_no)
+            stats["lines"] = line_no
+    finally:
+        writer.close()
+
+    if library_written:
+        # Lazily imported: only library imports need to invalidate library caches and ETags
+        from app.services.library_service import library_service
+        library_service.bump_version()
+    return stats
+
+
+def main(argv: Optional[List[str]] = None):
+    parser = argparse.ArgumentParser(description="Bulk export and import of chat sessions and the library")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    export = subparsers.add_parser("export", help="Stream a collection to a gzip NDJSON file")
+    export.add_argument("collection", choices=COLLECTIONS)
+    export.add_argument("output")
+    restore = subparsers.add_parser("import", help="Write a gzip NDJSON export back to Firestore")
+    restore.add_argument("input")
+    restore.add_argument("--checkpoint", help="progress file; rerun with the same file to resume")
+    restore.add_argument("--kinds", nargs="+", choices=KINDS, help="only import these record kinds")
+    args = parser.parse_args(argv)
+
+    if not firestore_service.is_available():
+        raise SystemExit("Firestore not available")
+    if args.command == "export":
+        stats = export_to_file(args.collection, args.output)
+    else:
+        stats = import_file(args.input, args.checkpoint, args.kinds)
+    print(", ".join(f"{key}={value}" for key, value in stats.items()))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,427 @@
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor, TimeoutError as FutureTimeout
+from typing import Any, Callable, Dict, Hashable, Optional
+from app.core.config import settings
+from app.core.http_cache import mark_stale
+
+
+class TTLCache:
+    """Thread-safe in-memory cache with per-entry TTL and LRU eviction"""
+
+    def __init__(self, maxsize: int, ttl: float):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data: "OrderedDict[Hashable, tuple]" = OrderedDict()
+        self._lock = threading.RLock()
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self) -> int:
+        with self._lock:
+            return len(self._data)
+
+    def get(self, key: Hashable, default: Any = None) -> Any:
+        with self._lock:
+            item = self._data.get(key)
+            if item is None:
+                self.misses += 1
+                return default
+            expires_at, value = item
+            if expires_at < time.monotonic():
+                del self._data[key]
+                self.misses += 1
+                return default
+            self._data.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def set(self, key: Hashable, value: Any, ttl: Optional[float] = None):
+        with self._lock:
+            self._data[key] = (time.monotonic() + (self.ttl if ttl is None else ttl), value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def pop(self, key: Hashable, default: Any = None) -> Any:
+        with self._lock:
+            item = self._data.pop(key, None)
+            return default if item is None else item[1]
+
+    def update(self, key: Hashable, fn: Callable[[Any], Any]) -> bool:
+        """Apply fn to a live entry under the cache lock, keeping its expiry.
+
+        fn returns the new value, or None to drop the entry. Returns False
+        when there was no live entry to update.
+        """
+        with self._lock:
+            item = self._data.get(key)
+            if item is None or item[0] < time.monotonic():
+                self._data.pop(key, None)
+                return False
+            value = fn(item[1])
+            if value is None:
+                del self._data[key]
+            else:
+                self._data[key] = (item[0], value)
+            return True
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+
+class MessageTailCache:
+    """Newest chat messages per active session, kept in process memory.
+
+    Entries expire after idle_ttl seconds without access and the least
+    recently used sessions are evicted once the estimated size of all
+    cached messages passes max_bytes. Each entry remembers the session's
+    total message count so a writer can detect turns added by another
+    worker and drop the stale tail; readers that know the current count
+    pass it as message_count, and a tail that disagrees is dropped rather
+    than served.
+    """
+
+    # Rough per-message overhead of the ChatMessage object, timestamp and ids
+    MESSAGE_OVERHEAD = 400
+
+    def __init__(self, max_messages: int, max_bytes: int, idle_ttl: float):
+        self.max_messages = max_messages
+        self.max_bytes = max_bytes
+        self.idle_ttl = idle_ttl
+        self._data: "OrderedDict[str, dict]" = OrderedDict()
+        self._lock = threading.Lock()
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __len__(self) -> int:
+        with self._lock:
+            return len(self._data)
+
+    @classmethod
+    def _size(cls, message) -> int:
+        content = message.content
+        if not isinstance(content, str):
+            # Structured reply: item texts plus the type/validation fields around them
+            return sum(len(item.get("content", "").encode("utf-8")) + 200 for item in content) + cls.MESSAGE_OVERHEAD
+        return len(content.encode("utf-8")) + cls.MESSAGE_OVERHEAD
+
+    def _drop(self, session_id: str):
+        entry = self._data.pop(session_id, None)
+        if entry is not None:
+            self.bytes -= entry["bytes"]
+
+    def _evict(self):
+        """Drop idle sessions from the LRU end, then the least recent ones over the memory cap"""
+        now = time.monotonic()
+        while self._data:
+            session_id, entry = next(iter(self._data.items()))
+            if entry["accessed_at"] + self.idle_ttl >= now and self.bytes <= self.max_bytes:
+                break
+            self._drop(session_id)
+            self.evictions += 1
+
+    def _live_entry(self, session_id: str, user_id: str, message_count: Optional[int] = None) -> Optional[dict]:
+        entry = self._data.get(session_id)
+        if entry is None or entry["user_id"] != user_id:
+            return None
+        expired = entry["accessed_at"] + self.idle_ttl < time.monotonic()
+        if expired or (message_count is not None and message_count != entry["message_count"]):
+            self._drop(session_id)
+            return None
+        entry["accessed_at"] = time.monotonic()
+        self._data.move_to_end(session_id)
+        return entry
+
+    def get_recent(
+        self, session_id: str, user_id: str, count: int, message_count: Optional[int] = None
+    ) -> Optional[list]:
+        """Newest count messages (oldest first), or None when the cached tail is too short or stale"""
+        with self._lock:
+            entry = self._live_entry(session_id, user_id, message_count)
+            if entry is None or (len(entry["messages"]) < count and not entry["complete"]):
+                self.misses += 1
+                return None
+            self.hits += 1
+            return [m.model_copy() for m in entry["messages"][-count:]]
+
+    def get_all(self, session_id: str, user_id: str, limit: int, message_count: int) -> Optional[list]:
+        """First limit messages of the session, when the cache holds the whole, current conversation"""
+        with self._lock:
+            entry = self._live_entry(session_id, user_id, message_count)
+            if entry is None or not entry["complete"]:
+                self.misses += 1
+                return None
+            self.hits += 1
+            return [m.model_copy() for m in entry["messages"][:limit]]
+
+    def put(self, session_id: str, user_id: str, messages: list, complete: bool, message_count: int):
+        """Store a freshly read tail; complete means messages is the whole conversation"""
+        if len(messages) > self.max_messages:
+            messages = messages[-self.max_messages:]
+            complete = False
+        messages = [m.model_copy() for m in messages]
+        with self._lock:
+            self._drop(session_id)
+            size = sum(self._size(m) for m in messages)
+            self._data[session_id] = {
+                "user_id": user_id,
+                "messages": messages,
+                "complete": complete,
+                "message_count": message_count,
+                "bytes": size,
+                "accessed_at": time.monotonic(),
+            }
+            self.bytes += size
+            self._evict()
+
+    def append(self, session_id: str, message, expected_count: Optional[int] = None):
+        """Add a new message to a cached tail.
+
+        expected_count is the session's message count before this message as
+        seen by the writer; when it disagrees with the cache, another worker
+        wrote to the session and the entry is dropped instead.
+        """
+        with self._lock:
+            entry = self._data.get(session_id)
+            if entry is None:
+                return
+            if expected_count is not None and expected_count != entry["message_count"]:
+                self._drop(session_id)
+                return
+            entry["messages"].append(message.model_copy())
+            entry["message_count"] += 1
+            entry["bytes"] += self._size(message)
+            self.bytes += self._size(message)
+            while len(entry["messages"]) > self.max_messages:
+                removed = entry["messages"].pop(0)
+                entry["bytes"] -= self._size(removed)
+                self.bytes -= self._size(removed)
+                entry["complete"] = False
+            self._evict()
+
+    def invalidate(self, session_id: str):
+        with self._lock:
+            self._drop(session_id)
+
+    def stats(self) -> dict:
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "sessions": len(self._data),
+                "messages": sum(len(entry["messages"]) for entry in self._data.values()),
+                "bytes": self.bytes,
+                "max_bytes": self.max_bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": round(self.hits / lookups, 4) if lookups else 0.0,
+                "evictions": self.evictions,
+            }
+
+
+class BackendUnavailable(Exception):
+    """A read failed or missed its deadline and no cached copy could stand in"""
+
+
+class StaleWhileRevalidateCache:
+    """Read-through cache that serves stale data rather than wait on a slow backend.
+
+    Entries younger than soft_ttl are served as-is. Between soft_ttl and
+    hard_ttl they are served immediately while a single background load
+    refreshes them. Missing, older or unusable entries are loaded in the
+    foreground, but the caller waits at most ``deadline`` seconds: when the
+    load fails or overruns, a copy younger than max_stale is served and the
+    request is marked stale, otherwise BackendUnavailable is raised. A load
+    that overruns keeps going and fills the cache when it completes.
+
+    Writers keep entries current with update()/pop(); a load that was
+    already running when the entry changed does not overwrite it.
+    """
+
+    _executor: Optional[ThreadPoolExecutor] = None
+    _executor_lock = threading.Lock()
+
+    def __init__(self, name: str, maxsize: int, soft_ttl: float, hard_ttl: float, deadline: float,
+                 max_stale: Optional[float] = None):
+        self.name = name
+        self.maxsize = maxsize
+        self.soft_ttl = soft_ttl
+        self.hard_ttl = hard_ttl
+        self.deadline = deadline
+        self.max_stale = settings.SWR_MAX_STALE if max_stale is None else max_stale
+        self._data: "OrderedDict[Hashable, tuple]" = OrderedDict()
+        self._loading: Dict[tuple, Future] = {}
+        self._changed_at: Dict[Hashable, float] = {}
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.stale_hits = 0
+        self.misses = 0
+        self.refreshes = 0
+        self.timeouts = 0
+        self.failures = 0
+        self.served_stale = 0
+
+    @classmethod
+    def _pool(cls) -> ThreadPoolExecutor:
+        # Shared by every cache, so a hung backend ties up at most SWR_WORKERS threads
+        with cls._executor_lock:
+            if cls._executor is None:
+                cls._executor = ThreadPoolExecutor(max_workers=settings.SWR_WORKERS, thread_name_prefix="swr-load")
+            return cls._executor
+
+    def __len__(self) -> int:
+        with self._lock:
+            return len(self._data)
+
+    def read(self, key: Hashable, loader: Callable, *args, usable: Callable[[Any], bool] = None,
+             flight: Hashable = None) -> Any:
+        """Cached value for key, loading it with loader(*args) when needed.
+
+        usable(value) rejects a cached value that cannot answer this read
+        (it is still served if the load fails). Loads are deduplicated per
+        (key, flight).
+        """
+        with self._lock:
+            item = self._data.get(key)
+            if item is not None:
+                self._data.move_to_end(key)
+        now = time.monotonic()
+        if item is not None and (usable is None or usable(item[1])):
+            age = now - item[0]
+            if age < self.soft_ttl:
+                self.hits += 1
+                return item[1]
+            if age < self.hard_ttl:
+                self.stale_hits += 1
+                self._load(key, flight, loader, args)
+                return item[1]
+
+        self.misses += 1
+        future = self._load(key, flight, loader, args)
+        try:
+            return future.result(timeout=self.deadline)
+        except Exception as e:
+            if isinstance(e, FutureTimeout):
+                self.timeouts += 1
+                reason = f"timed out after {self.deadline}s"
+            else:
+                self.failures += 1
+                reason = f"failed: {str(e)}"
+            if item is not None and now - item[0] < self.max_stale:
+                self.served_stale += 1
+                mark_stale(self.name)
+                print(f"Serving stale {self.name} data, read {reason}")
+                return item[1]
+            raise BackendUnavailable(f"{self.name} read {reason}") from e
+
+    def _load(self, key: Hashable, flight: Hashable, loader: Callable, args: tuple) -> Future:
+        flight_key = (key, flight)
+        with self._lock:
+            future = self._loading.get(flight_key)
+            if future is None:
+                self.refreshes += 1
+                future = self._pool().submit(self._run_load, key, flight_key, time.monotonic(), loader, args)
+                self._loading[flight_key] = future
+            return future
+
+    def _run_load(self, key: Hashable, flight_key: tuple, started_at: float, loader: Callable, args: tuple) -> Any:
+        try:
+            value = loader(*args)
+        except Exception as e:
+            print(f"Error loading {self.name} data: {str(e)}")
+            with self._lock:
+                self._finish_load(key, flight_key)
+            raise
+        with self._lock:
+            if self._changed_at.get(key, -1.0) < started_at:
+                self._store(key, value)
+            self._finish_load(key, flight_key)
+        return value
+
+    def _finish_load(self, key: Hashable, flight_key: tuple):
+        self._loading.pop(flight_key, None)
+        if not any(loading[0] == key for loading in self._loading):
+            self._changed_at.pop(key, None)
+
+    def _store(self, key: Hashable, value: Any):
+        self._data[key] = (time.monotonic(), value)
+        self._data.move_to_end(key)
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+
+    def _mark_changed(self, key: Hashable):
+        if any(loading[0] == key for loading in self._loading):
+            self._changed_at[key] = time.monotonic()
+
+    def get(self, key: Hashable, default: Any = None) -> Any:
+        """Fresh (younger than soft_ttl) value without loading"""
+        with self._lock:
+            item = self._data.get(key)
+        if item is None or time.monotonic() - item[0] >= self.soft_ttl:
+            return default
+        return item[1]
+
+    def peek(self, key: Hashable, default: Any = None) -> Any:
+        """Cached value of any age"""
+        with self._lock:
+            item = self._data.get(key)
+        return default if item is None else item[1]
+
+    def set(self, key: Hashable, value: Any):
+        with self._lock:
+            self._mark_changed(key)
+            self._store(key, value)
+
+    def update(self, key: Hashable, fn: Callable[[Any], Any]) -> bool:
+        """Apply fn to a cached entry, keeping its age; fn returns None to drop it"""
+        with self._lock:
+            item = self._data.get(key)
+            if item is None:
+                return False
+            self._mark_changed(key)
+            value = fn(item[1])
+            if value is None:
+                del self._data[key]
+            else:
+                self._data[key] = (item[0], value)
+            return True
+
+    def pop(self, key: Hashable, default: Any = None) -> Any:
+        with self._lock:
+            self._mark_changed(key)
+            item = self._data.pop(key, None)
+            return default if item is None else item[1]
+
+    def expire(self, key: Hashable):
+        """Make the next read load in the foreground, keeping the entry as a fallback"""
+        with self._lock:
+            item = self._data.get(key)
+            if item is not None:
+                self._mark_changed(key)
+                self._data[key] = (min(item[0], time.monotonic() - self.hard_ttl), item[1])
+
+    def clear(self):
+        with self._lock:
+            for key in self._data:
+                self._mark_changed(key)
+            self._data.clear()
+
+    def stats(self) -> dict:
+        with self._lock:
+            entries = len(self._data)
+            loading = len(self._loading)
+        return {
+            "entries": entries,
+            "loading": loading,
+            "hits": self.hits,
+            "stale_hits": self.stale_hits,
+            "misses": self.misses,
+            "refreshes": self.refreshes,
+            "timeouts": self.timeouts,
+            "failures": self.failures,
+            "served_stale": self.served_stale,
+        }
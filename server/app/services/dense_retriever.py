@@ -0,0 +1,417 @@
+import json
+import math
+import os
+import re
+import threading
+import time
+import zlib
+from datetime import datetime
+from typing import Dict, List, Optional, Tuple
+from firebase_admin import firestore
+from google.cloud.firestore import FieldFilter
+from app.core.config import settings
+from app.services.kb_index import tokenize
+from app.services.library_service import library_service
+from app.services.metrics import metrics
+
+try:
+    import numpy as np
+except ImportError:  # dense retrieval is optional; lexical retrieval keeps working without it
+    np = None
+
+_WORD_RE = re.compile(r"[a-z0-9_]+")
+
+# IEC 61131-3 / automation paraphrases that share no words; each group becomes one concept feature
+CONCEPTS = {
+    "latch": [
+        "latch", "latching", "latched", "unlatch", "seal-in", "seal in", "self-holding", "self holding",
+        "set/reset", "set reset", "set coil", "reset coil", "sr", "rs", "(s)", "(r)", "holding contact",
+    ],
+    "hysteresis": [
+        "hysteresis", "deadband", "dead band", "dead-band", "differential gap", "on/off band",
+        "switching band", "chatter", "chattering",
+    ],
+    "timer": ["timer", "ton", "tof", "tp", "tonr", "on-delay", "off-delay", "on delay", "off delay", "time delay"],
+    "counter": ["counter", "ctu", "ctd", "ctud", "count up", "count down", "counting"],
+    "edge": ["r_trig", "f_trig", "rising edge", "falling edge", "one-shot", "one shot", "oneshot", "pulse"],
+    "alarm": ["alarm", "alarms", "alert", "annunciator", "acknowledge", "ack", "fault indication"],
+    "interlock": ["interlock", "interlocks", "permissive", "permissives", "lockout", "inhibit"],
+    "estop": ["emergency stop", "e-stop", "estop", "safety stop", "emergency"],
+    "pid": ["pid", "proportional", "integral", "derivative", "loop tuning", "closed loop", "setpoint tracking"],
+    "motor": ["motor", "starter", "dol", "star-delta", "star delta", "contactor", "vfd", "drive"],
+    "analog": ["analog", "analogue", "4-20ma", "4-20 ma", "scaling", "raw value", "engineering units"],
+    "fieldbus": ["modbus", "profibus", "profinet", "ethernet/ip", "ethercat", "opc ua", "opc-ua", "fieldbus"],
+    "threshold": ["threshold", "thresholds", "limit", "limits", "high limit", "low limit", "setpoint", "trip point"],
+}
+_PHRASE_CONCEPTS = {phrase: concept for concept, phrases in CONCEPTS.items() for phrase in phrases}
+_CONCEPT_RE = re.compile(
+    r"(?<![a-z0-9_])("
+    + "|".join(re.escape(phrase) for phrase in sorted(_PHRASE_CONCEPTS, key=len, reverse=True))
+    + r")(?![a-z0-9_])"
+)
+
+# Function words carry no topic; dropping them keeps "what is ..." questions from matching each other
+STOPWORDS = {
+    "a", "an", "and", "are", "as", "at", "be", "by", "can", "do", "does", "for", "from", "how", "i",
+    "in", "is", "it", "me", "my", "of", "on", "or", "so", "that", "the", "this", "to", "use", "what",
+    "when", "where", "which", "who", "why", "with", "you", "your",
+}
+
+
+def _features(text: str) -> Dict[str, float]:
+    """Weighted sparse features: words, word bigrams, character trigrams and concepts"""
+    lowered = text.lower()
+    words = [word for word in _WORD_RE.findall(lowered) if word not in STOPWORDS]
+    counts: Dict[str, float] = {}
+    for word in words:
+        counts["w:" + word] = counts.get("w:" + word, 0.0) + 1.0
+        if len(word) >= 5:
+            # Trigrams tie inflections together ("latching" / "latched")
+            padded = f"<{word}>"
+            for i in range(len(padded) - 2):
+                key = "c:" + padded[i:i + 3]
+                counts[key] = counts.get(key, 0.0) + 0.2
+    for first, second in zip(words, words[1:]):
+        key = f"b:{first} {second}"
+        counts[key] = counts.get(key, 0.0) + 0.5
+    for phrase in _CONCEPT_RE.findall(lowered):
+        key = "k:" + _PHRASE_CONCEPTS[phrase]
+        counts[key] = counts.get(key, 0.0) + 3.0
+    # Sublinear term frequency
+    return {key: 1.0 + math.log(value) if value > 1.0 else value for key, value in counts.items()}
+
+
+class HashingEncoder:
+    """Signed feature hashing with IDF weights and an optional SVD projection.
+
+    fit() learns per-bucket IDF and, for corpora of at least
+    DENSE_SVD_MIN_DOCS documents, projects the hashed space onto its top
+    DENSE_DIM singular directions (LSA) so that co-occurring terms land
+    close together. Everything is computed locally; no model download.
+    """
+
+    def __init__(self, hash_dim: int, dim: int):
+        self.hash_dim = hash_dim
+        self.dim = dim
+        self.idf = np.ones(hash_dim, dtype=np.float32)
+        self.projection: Optional["np.ndarray"] = None
+
+    @property
+    def output_dim(self) -> int:
+        return self.hash_dim if self.projection is None else self.projection.shape[1]
+
+    def _hashed(self, texts: List[str]) -> "np.ndarray":
+        rows, cols, values = [], [], []
+        for row, text in enumerate(texts):
+            for feature, weight in _features(text).items():
+                h = zlib.crc32(feature.encode("utf-8"))
+                rows.append(row)
+                cols.append(h % self.hash_dim)
+                values.append(weight if (h // self.hash_dim) & 1 else -weight)
+        flat = np.asarray(rows, dtype=np.int64) * self.hash_dim + np.asarray(cols, dtype=np.int64)
+        matrix = np.bincount(flat, weights=np.asarray(values, dtype=np.float64), minlength=len(texts) * self.hash_dim)
+        return matrix.astype(np.float32).reshape(len(texts), self.hash_dim)
+
+    def fit(self, texts: List[str]):
+        """Learn IDF weights (and the SVD projection) from a corpus, in batches"""
+        batch_size = settings.DENSE_ENCODE_BATCH
+        df = np.zeros(self.hash_dim, dtype=np.float64)
+        for start in range(0, len(texts), batch_size):
+            df += (self._hashed(texts[start:start + batch_size]) != 0).sum(axis=0)
+        self.idf = (np.log((len(texts) + 1) / (df + 1)) + 1.0).astype(np.float32)
+
+        self.projection = None
+        if len(texts) >= settings.DENSE_SVD_MIN_DOCS and self.dim < self.hash_dim:
+            # Uncentered covariance accumulated batch by batch; its top eigenvectors are the LSA basis
+            covariance = np.zeros((self.hash_dim, self.hash_dim), dtype=np.float64)
+            for start in range(0, len(texts), batch_size):
+                batch = self._hashed(texts[start:start + batch_size]) * self.idf
+                covariance += batch.T.astype(np.float64) @ batch
+            _, vectors = np.linalg.eigh(covariance)
+            self.projection = np.ascontiguousarray(vectors[:, ::-1][:, :self.dim], dtype=np.float32)
+
+    def encode(self, texts: List[str]) -> "np.ndarray":
+        """L2-normalized float32 vectors, one row per text"""
+        matrix = self._hashed(texts) * self.idf
+        if self.projection is not None:
+            matrix = matrix @ self.projection
+        norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+        norms[norms == 0] = 1.0
+        return np.ascontiguousarray(matrix / norms, dtype=np.float32)
+
+
+_BLANK_LINES_RE = re.compile(r"\n\s*\n")
+
+
+def chunk_spans(text: str, max_chars: int) -> List[Tuple[int, int]]:
+    """(start, end) offsets splitting a document on blank lines into chunks of at most roughly max_chars"""
+    blocks, position = [], 0
+    for match in _BLANK_LINES_RE.finditer(text):
+        blocks.append((position, match.start()))
+        position = match.end()
+    blocks.append((position, len(text)))
+    spans, current = [], None
+    for start, end in blocks:
+        if current and end - current[0] > max_chars:
+            spans.append(current)
+            current = None
+        current = (current[0], end) if current else (start, end)
+    if current:
+        spans.append(current)
+    return spans or [(0, len(text))]
+
+
+class DenseIndex:
+    """One contiguous float32 matrix over KB chunks and library Q&A entries.
+
+    Row i belongs to items[i], either ("kb", doc_id, (start, end)) for a
+    chunk of a KB document or ("library", entry_id, passage). New library
+    entries are appended by refresh() without refitting the encoder;
+    readers always see a consistent (matrix, items) pair because both are
+    swapped together.
+    """
+
+    def __init__(self, encoder: HashingEncoder, matrix: "np.ndarray", items: List[tuple]):
+        self.encoder = encoder
+        self._rows = (matrix, items)
+
+    @property
+    def matrix(self) -> "np.ndarray":
+        return self._rows[0]
+
+    @property
+    def items(self) -> List[tuple]:
+        return self._rows[1]
+
+    def search(self, query: str, k: int) -> List[Tuple[float, tuple]]:
+        """(similarity, item) of the k nearest rows, best first"""
+        matrix, items = self._rows
+        if not len(items):
+            return []
+        scores = matrix @ self.encoder.encode([query])[0]
+        k = min(k, len(items))
+        top = np.argpartition(-scores, k - 1)[:k]
+        top = top[np.argsort(-scores[top])]
+        return [(float(scores[i]), items[i]) for i in top]
+
+    def append(self, vectors: "np.ndarray", items: List[tuple]):
+        matrix, current = self._rows
+        self._rows = (np.ascontiguousarray(np.vstack([matrix, vectors]), dtype=np.float32), current + items)
+
+
+class DenseRetriever:
+    """Hybrid KB + library retrieval: dense candidates re-ranked with keyword overlap.
+
+    The index is built on a background thread (KB chunks from the keyword
+    retriever, library entries from ``knowledge_library``) and then
+    refreshed every DENSE_REFRESH_INTERVAL seconds with entries created
+    since the last pass. Passages are the matched chunk or library entry,
+    held in memory, so a query never reads Firestore.
+
+    Dense retrieval is opt-in (DENSE_RETRIEVAL) and gated: after each build
+    it answers the golden questions (DENSE_GOLDEN_PATH) and is only used
+    when its recall@k is at least that of keyword retrieval. Until then,
+    without NumPy, or when the gate fails, retrieve() is keyword retrieval.
+    """
+
+    def __init__(self, kb_retriever):
+        self.kb_retriever = kb_retriever
+        self.index: Optional[DenseIndex] = None
+        self.gate: Optional[dict] = None
+        self._watermark: Optional[datetime] = None
+        self._disputed: set = set()
+        self._thread: Optional[threading.Thread] = None
+        self._stop = threading.Event()
+        self.build_seconds = None
+        self.queries = 0
+        self.query_ms = 0.0
+        self.max_query_ms = 0.0
+        metrics.register("dense_retriever", self.stats)
+
+    @property
+    def available(self) -> bool:
+        return np is not None and settings.DENSE_RETRIEVAL
+
+    @property
+    def active(self) -> bool:
+        """Whether queries are answered from the dense index"""
+        return self.index is not None and self.gate is not None and self.gate["passed"]
+
+    def start(self):
+        """Build the index and keep it fresh in the background"""
+        if not self.available:
+            if settings.DENSE_RETRIEVAL:
+                print("NumPy not installed; dense retrieval disabled")
+            return
+        if self._thread is None or not self._thread.is_alive():
+            self._stop.clear()
+            self._thread = threading.Thread(target=self._run, name="dense-index", daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+
+    def _run(self):
+        try:
+            self.build()
+        except Exception as e:
+            print(f"Error building dense index: {str(e)}")
+            return
+        while not self._stop.wait(settings.DENSE_REFRESH_INTERVAL):
+            try:
+                self.refresh()
+            except Exception as e:
+                print(f"Error refreshing dense index: {str(e)}")
+
+    def _library_rows(self, since: Optional[datetime] = None):
+        """(entry_id, passage, created_at) for undisputed library entries, oldest first"""
+        query = library_service.collection
+        if since is not None:
+            query = query.where(filter=FieldFilter("created_at", ">", since))
+        query = query.order_by("created_at", direction=firestore.Query.ASCENDING).select(
+            ["entry_id", "user_question", "assistant_response", "created_at", "inaccurate_count"]
+        )
+        for doc in query.stream():
+            data = doc.to_dict()
+            if data.get("inaccurate_count", 0) >= settings.DENSE_LIBRARY_MAX_INACCURATE:
+                continue
+            answer = (data.get("assistant_response") or "")[:settings.DENSE_CHUNK_CHARS]
+            passage = f"Q: {data.get('user_question', '')}\nA: {answer}"
+            yield data.get("entry_id", doc.id), passage, data.get("created_at")
+
+    def _disputed_ids(self) -> set:
+        """Library entries rated inaccurate since they were indexed"""
+        query = library_service.collection.where(
+            filter=FieldFilter("inaccurate_count", ">=", settings.DENSE_LIBRARY_MAX_INACCURATE)
+        ).select(["entry_id"])
+        return {doc.to_dict().get("entry_id", doc.id) for doc in query.stream()}
+
+    def build(self, check_golden: bool = True):
+        started_at = time.perf_counter()
+        texts, items = [], []
+        for doc_id in range(self.kb_retriever.document_count()):
+            document = self.kb_retriever.document(doc_id)
+            for start, end in chunk_spans(document, settings.DENSE_CHUNK_CHARS):
+                texts.append(document[start:end])
+                items.append(("kb", doc_id, (start, end)))
+        watermark = None
+        try:
+            for entry_id, passage, created_at in self._library_rows():
+                texts.append(passage)
+                items.append(("library", entry_id, passage))
+                watermark = created_at or watermark
+        except Exception as e:
+            print(f"Dense index built without library entries: {str(e)}")
+
+        encoder = HashingEncoder(settings.DENSE_HASH_DIM, settings.DENSE_DIM)
+        encoder.fit(texts)
+        batch_size = settings.DENSE_ENCODE_BATCH
+        vectors = [encoder.encode(texts[start:start + batch_size]) for start in range(0, len(texts), batch_size)]
+        matrix = np.ascontiguousarray(
+            np.vstack(vectors) if vectors else np.zeros((0, encoder.output_dim), dtype=np.float32)
+        )
+        index = DenseIndex(encoder, matrix, items)
+        gate = self._check_golden(index) if check_golden else {"passed": True}
+        self.index, self.gate = index, gate
+        self._watermark = watermark
+        self.build_seconds = round(time.perf_counter() - started_at, 3)
+        print(f"Dense index built: {len(items)} vectors x {encoder.output_dim} dims in {self.build_seconds}s")
+        if not gate["passed"]:
+            print(
+                f"Dense retrieval not enabled: golden recall@k {gate['dense_recall']} "
+                f"below keyword {gate['keyword_recall']}"
+            )
+
+    def _check_golden(self, index: DenseIndex) -> dict:
+        """Golden-set recall@k of the index against keyword retrieval"""
+        path = settings.DENSE_GOLDEN_PATH
+        if not os.path.exists(path):
+            return {"passed": False, "reason": f"golden set not found: {path}"}
+        with open(path, "r", encoding="utf-8") as f:
+            golden = json.load(f)
+        k = settings.DENSE_GOLDEN_K
+        names = self.kb_retriever.document_name
+        dense = keyword = 0.0
+        for item in golden:
+            expected = set(item["expected"])
+            found = {names(key) for _, kind, key, _ in self._rank(index, item["question"], k) if kind == "kb"}
+            dense += len(found & expected) / len(expected)
+            found = {names(doc_id) for doc_id in self.kb_retriever.top_documents(item["question"], k)}
+            keyword += len(found & expected) / len(expected)
+        total = len(golden) or 1
+        dense, keyword = round(dense / total, 4), round(keyword / total, 4)
+        return {"passed": dense >= keyword, "dense_recall": dense, "keyword_recall": keyword, "k": k}
+
+    def refresh(self):
+        """Append library entries created since the last build or refresh, and drop disputed ones"""
+        index = self.index
+        if index is None:
+            return
+        self._disputed = self._disputed_ids()
+        rows = list(self._library_rows(self._watermark))
+        if not rows:
+            return
+        batch_size = settings.DENSE_ENCODE_BATCH
+        for start in range(0, len(rows), batch_size):
+            batch = rows[start:start + batch_size]
+            index.append(
+                index.encoder.encode([passage for _, passage, _ in batch]),
+                [("library", entry_id, passage) for entry_id, passage, _ in batch]
+            )
+        self._watermark = rows[-1][2] or self._watermark
+
+    def _text(self, kind: str, key, ref) -> str:
+        if kind == "kb":
+            start, end = ref
+            return self.kb_retriever.document(key)[start:end]
+        return ref
+
+    def _rank(self, index: DenseIndex, query: str, top_k: int) -> List[tuple]:
+        """(score, kind, key, text) of the top_k results: dense candidates blended with keyword overlap"""
+        query_words = set(tokenize(query))
+        alpha = settings.DENSE_BLEND_ALPHA
+        # Best chunk per KB document, one row per library entry
+        best: Dict[Tuple[str, object], tuple] = {}
+        for similarity, (kind, key, ref) in index.search(query, settings.DENSE_CANDIDATES):
+            if similarity < settings.DENSE_MIN_SIMILARITY or (kind == "library" and key in self._disputed):
+                continue
+            text = self._text(kind, key, ref)
+            overlap = len(query_words & set(tokenize(text))) / len(query_words) if query_words else 0.0
+            score = alpha * similarity + (1 - alpha) * overlap
+            if (kind, key) not in best or score > best[(kind, key)][0]:
+                best[(kind, key)] = (score, kind, key, text)
+        return sorted(best.values(), key=lambda row: -row[0])[:top_k]
+
+    def retrieve(self, query: str, top_k: int = 3) -> List[str]:
+        """Top_k context passages for a query"""
+        index = self.index
+        if index is None or not self.active:
+            return self.kb_retriever.retrieve(query, top_k)
+
+        started_at = time.perf_counter()
+        passages = [
+            text if kind == "kb" else f"Curated library answer\n{text}"
+            for _, kind, _, text in self._rank(index, query, top_k)
+        ]
+        elapsed_ms = (time.perf_counter() - started_at) * 1000
+        self.queries += 1
+        self.query_ms += elapsed_ms
+        self.max_query_ms = max(self.max_query_ms, elapsed_ms)
+        return passages
+
+    def stats(self) -> dict:
+        index = self.index
+        return {
+            "enabled": self.available,
+            "ready": index is not None,
+            "active": self.active,
+            "gate": self.gate,
+            "vectors": len(index.items) if index is not None else 0,
+            "dims": index.encoder.output_dim if index is not None else None,
+            "matrix_bytes": int(index.matrix.nbytes) if index is not None else 0,
+            "disputed_entries": len(self._disputed),
+            "build_seconds": self.build_seconds,
+            "queries": self.queries,
+            "avg_query_ms": round(self.query_ms / self.queries, 3) if self.queries else None,
+            "max_query_ms": round(self.max_query_ms, 3),
+        }
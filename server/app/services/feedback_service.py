@@ -0,0 +1,258 @@
+import threading
+import time
+from collections import deque
+from datetime import datetime
+from typing import Deque, Dict, List, Optional
+from firebase_admin import firestore
+from google.cloud.firestore import FieldFilter
+from app.core.config import settings
+from app.models.feedback import QuestionFeedback
+from app.services.firestore_service import firestore_service
+from app.services.library_dedup import content_hash
+from app.services.library_service import library_service
+from app.services.metrics import metrics
+from app.services.single_flight import normalize_text, request_key
+
+
+def question_key(question: str) -> str:
+    """Aggregation key for a question, insensitive to case and whitespace"""
+    return request_key("question", normalize_text(question))
+
+
+def rating_key(user_id: str, session_id: str, message_id: str) -> str:
+    """Document id of a user's rating of one message"""
+    return request_key("feedback", user_id, session_id, message_id)
+
+
+def answer_text(content) -> str:
+    """Rated answer as text, joined the way the frontend saves it to the library"""
+    if isinstance(content, str):
+        return content
+    return "\n\n".join(item.get("content", "") for item in content)
+
+
+def event_size(event: dict) -> int:
+    """Approximate memory held by a buffered event (its texts dominate)"""
+    return len(event["user_question"]) + len(event["assistant_response"]) + 200
+
+
+class FeedbackService:
+    """Buffered ingestion of accurate/inaccurate ratings.
+
+    record() only appends to an in-memory buffer, so the request path never
+    waits on Firestore. Events carry the question and answer loaded from the
+    rater's own session, never client-sent text. A background thread flushes
+    the buffer in transactions: one ``feedback`` document per user and
+    message (a new rating replaces the old one) plus a coalesced Increment
+    per question on ``feedback_aggregates/{question_key}``. Library entries
+    holding the answer (same content hash of question and answer) get their
+    ``inaccurate_count`` bumped the first time a user rates it inaccurate,
+    and the library version changes, so cached library responses are
+    refetched. The buffer is capped at FEEDBACK_MAX_BUFFER_BYTES.
+    """
+    _instance = None
+    _initialized = False
+
+    def __new__(cls):
+        if cls._instance is None:
+            cls._instance = super().__new__(cls)
+        return cls._instance
+
+    def __init__(self):
+        if not self._initialized:
+            self._cond = threading.Condition()
+            self._buffer: Deque[dict] = deque()
+            self._buffer_bytes = 0
+            self._thread: Optional[threading.Thread] = None
+            self._stopping = False
+            self.received = 0
+            self.written = 0
+            self.dropped = 0
+            self.failed_flushes = 0
+            metrics.register("feedback", self.stats)
+            self._initialized = True
+
+    @property
+    def db(self):
+        return firestore_service.db
+
+    def record(self, user_id: str, events: List[dict]) -> int:
+        """Buffer rating events for the background flusher; returns how many were accepted"""
+        now = datetime.utcnow()
+        with self._cond:
+            for event in events:
+                self._buffer.append({**event, "user_id": user_id, "created_at": now})
+                self._buffer_bytes += event_size(event)
+            self.received += len(events)
+            # Shed the oldest events rather than grow without bound if Firestore is down
+            while self._buffer and self._buffer_bytes > settings.FEEDBACK_MAX_BUFFER_BYTES:
+                self._buffer_bytes -= event_size(self._buffer.popleft())
+                self.dropped += 1
+            if self._thread is None or not self._thread.is_alive():
+                self._stopping = False
+                self._thread = threading.Thread(target=self._run, name="feedback-flusher", daemon=True)
+                self._thread.start()
+            if len(self._buffer) >= settings.FEEDBACK_BATCH_SIZE:
+                self._cond.notify_all()
+        return len(events)
+
+    def _take(self) -> List[dict]:
+        with self._cond:
+            count = min(len(self._buffer), settings.FEEDBACK_BATCH_SIZE)
+            events = [self._buffer.popleft() for _ in range(count)]
+            self._buffer_bytes -= sum(event_size(event) for event in events)
+            return events
+
+    def _flush(self, events: List[dict]):
+        # One rating per user and message: a later event replaces an earlier one
+        latest: Dict[str, dict] = {}
+        for event in events:
+            latest[rating_key(event["user_id"], event["session_id"], event["message_id"])] = event
+        refs = {key: self.db.collection("feedback").document(key) for key in latest}
+
+        @firestore.transactional
+        def commit(transaction) -> Dict[str, int]:
+            previous = {
+                doc.id: doc.to_dict()
+                for doc in self.db.get_all(list(refs.values()), transaction=transaction)
+                if doc.exists
+            }
+            aggregates: Dict[str, dict] = {}
+            flagged: Dict[str, int] = {}
+            for key, event in latest.items():
+                before = previous.get(key) or {}
+                if before.get("rating") == event["rating"]:
+                    continue
+                question = question_key(event["user_question"])
+                aggregate = aggregates.setdefault(question, {
+                    "user_question": event["user_question"],
+                    "accurate": 0,
+                    "inaccurate": 0,
+                    "last_feedback_at": event["created_at"],
+                })
+                aggregate[event["rating"]] += 1
+                if before.get("rating") in ("accurate", "inaccurate"):
+                    aggregate[before["rating"]] -= 1
+                aggregate["last_feedback_at"] = max(aggregate["last_feedback_at"], event["created_at"])
+
+                # Library entries count a user's inaccurate rating of an answer once, even after a change of mind
+                library_flagged = before.get("library_flagged", False)
+                if event["rating"] == "inaccurate" and not library_flagged:
+                    digest = content_hash(event["user_question"], event["assistant_response"])
+                    flagged[digest] = flagged.get(digest, 0) + 1
+                    library_flagged = True
+                transaction.set(refs[key], {
+                    **event,
+                    "question_key": question,
+                    "created_at": before.get("created_at", event["created_at"]),
+                    "updated_at": event["created_at"],
+                    "library_flagged": library_flagged,
+                })
+
+            # At most FEEDBACK_BATCH_SIZE events plus one aggregate each stays under the 500-write cap
+            for question, aggregate in aggregates.items():
+                transaction.set(self.db.collection("feedback_aggregates").document(question), {
+                    "question_key": question,
+                    "user_question": aggregate["user_question"],
+                    "accurate": firestore.Increment(aggregate["accurate"]),
+                    "inaccurate": firestore.Increment(aggregate["inaccurate"]),
+                    "last_feedback_at": aggregate["last_feedback_at"],
+                }, merge=True)
+            return flagged
+
+        flagged = commit(self.db.transaction())
+        if flagged:
+            try:
+                self._flag_library_entries(flagged)
+            except Exception as e:
+                # The events are committed; don't requeue them over a library update
+                print(f"Error flagging library entries: {str(e)}")
+
+    def _flag_library_entries(self, flagged: Dict[str, int]):
+        """Mark library entries holding answers rated inaccurate, by content hash of question and answer.
+
+        An entry matches on its own hash or on one of its near-duplicate variants.
+        """
+        keys = list(flagged)
+        counts: Dict[str, int] = {}
+        refs = {}
+        # "in" and "array_contains_any" filters accept up to 30 values
+        for start in range(0, len(keys), 30):
+            chunk = keys[start:start + 30]
+            for field, operator in (("content_hash", "in"), ("variant_hashes", "array_contains_any")):
+                query = library_service.collection.where(
+                    filter=FieldFilter(field, operator, chunk)
+                ).select(["content_hash", "variant_hashes"])
+                for doc in query.stream():
+                    data = doc.to_dict() or {}
+                    hashes = {data.get("content_hash")} | set(data.get("variant_hashes") or [])
+                    refs[doc.id] = doc.reference
+                    counts[doc.id] = sum(flagged.get(digest, 0) for digest in hashes)
+        ids = list(counts)
+        for start in range(0, len(ids), 400):
+            batch = self.db.batch()
+            for entry_id in ids[start:start + 400]:
+                batch.update(refs[entry_id], {"inaccurate_count": firestore.Increment(counts[entry_id])})
+            batch.commit()
+        if ids:
+            library_service.bump_version()
+
+    def _run(self):
+        while True:
+            with self._cond:
+                if not self._stopping and len(self._buffer) < settings.FEEDBACK_BATCH_SIZE:
+                    self._cond.wait(settings.FEEDBACK_FLUSH_INTERVAL)
+                if self._stopping and not self._buffer:
+                    return
+            events = self._take()
+            if not events:
+                continue
+            try:
+                self._flush(events)
+                self.written += len(events)
+            except Exception as e:
+                self.failed_flushes += 1
+                print(f"Error flushing feedback: {str(e)}")
+                with self._cond:
+                    if self._stopping:
+                        self.dropped += len(events)
+                        return
+                    # Put the batch back in front and back off before retrying
+                    self._buffer.extendleft(reversed(events))
+                    self._buffer_bytes += sum(event_size(event) for event in events)
+                time.sleep(min(settings.FEEDBACK_FLUSH_INTERVAL * 4, 10.0))
+
+    def get_question_feedback(self, limit: int = 50) -> List[QuestionFeedback]:
+        """Questions with the most inaccurate ratings"""
+        query = (
+            self.db.collection("feedback_aggregates")
+            .order_by("inaccurate", direction=firestore.Query.DESCENDING)
+            .limit(limit)
+        )
+        return [QuestionFeedback(**doc.to_dict()) for doc in query.stream()]
+
+    def stop(self, timeout: float = 10.0):
+        """Flush buffered events and stop the background thread"""
+        with self._cond:
+            self._stopping = True
+            self._cond.notify_all()
+            thread = self._thread
+        if thread is not None:
+            thread.join(timeout)
+
+    def stats(self) -> dict:
+        with self._cond:
+            buffered = len(self._buffer)
+            buffered_bytes = self._buffer_bytes
+        return {
+            "buffered": buffered,
+            "buffered_bytes": buffered_bytes,
+            "received": self.received,
+            "written": self.written,
+            "dropped": self.dropped,
+            "failed_flushes": self.failed_flushes,
+        }
+
+
+# Create singleton instance
+feedback_service = FeedbackService()
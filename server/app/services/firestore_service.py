@@ -1,10 +1,18 @@
 from firebase_admin import firestore
 from google.cloud.firestore import FieldFilter
-from typing import List, Optional, Dict, Any
+from typing import List, Optional, Dict, Any, Union
 from datetime import datetime
 import uuid
 from app.models.session import ChatSession, ChatMessage, SessionResponse
 from app.services.firebase_service import firebase_service
+from app.services.write_behind import SESSION_LIST_VERSIONS, WriteBehindQueue
+from app.services.message_archive import MessageArchive
+from app.services.message_format import MessageBlobStore, message_preview
+from app.services.cache import MessageTailCache, StaleWhileRevalidateCache
+from app.services.metrics import metrics
+from app.services.response_parser import is_valid_item
+from app.services.single_flight import SingleFlight
+from app.core.config import settings
 
 class FirestoreService:
     _instance = None
@@ -30,6 +38,28 @@ class FirestoreService:
         except Exception as e:
             print(f"Error initializing Firestore: {e}")
             self.db = None
+        self.blobs = MessageBlobStore(self.db) if self.db is not None else None
+        self.write_queue = WriteBehindQueue(self.db, self.blobs) if self.db is not None else None
+        self.archive = MessageArchive(self.db) if self.db is not None else None
+        # Served stale (and refreshed in the background) rather than waiting on a slow Firestore
+        self.session_cache = StaleWhileRevalidateCache(
+            "sessions",
+            maxsize=settings.SESSION_CACHE_MAX_USERS,
+            soft_ttl=settings.SESSION_CACHE_TTL,
+            hard_ttl=settings.SESSION_CACHE_HARD_TTL,
+            deadline=settings.FIRESTORE_READ_DEADLINE
+        )
+        self.tail_cache = MessageTailCache(
+            max_messages=settings.TAIL_CACHE_MESSAGES,
+            max_bytes=settings.TAIL_CACHE_MAX_BYTES,
+            idle_ttl=settings.TAIL_CACHE_IDLE_TTL
+        )
+        self._messages_flight = SingleFlight("firestore_session_messages")
+        metrics.register("session_cache", self.session_cache.stats)
+        metrics.register("message_tail_cache", self.tail_cache.stats)
+        if self.archive is not None:
+            metrics.register("message_archive", self.archive.stats)
+            metrics.register("message_blobs", self.blobs.stats)
     
     def is_available(self) -> bool:
         """Check if Firestore is available"""
@@ -54,7 +84,18 @@ class FirestoreService:
         }
         
         # Store in Firestore
-        self.db.collection("chat_sessions").document(session_id).set(session_data)
+        batch = self.db.batch()
+        batch.set(self.db.collection("chat_sessions").document(session_id), session_data)
+        self._touch_session_list(user_id, now, batch)
+        batch.commit()
+        self._cache_upsert_session(user_id, SessionResponse(
+            session_id=session_id,
+            title=title,
+            created_at=now,
+            updated_at=now,
+            message_count=0,
+            last_message=None
+        ))
         
         return session_id
     
@@ -63,6 +104,53 @@ class FirestoreService:
         if not self.is_available():
             raise ValueError("Firestore not available")
         
+        # Refreshes re-read at least as many sessions as the cached list holds
+        cached = self.session_cache.peek(user_id)
+        query_limit = max(limit, cached["limit"]) if cached is not None else limit
+        
+        # Other workers change the list too: the cached list is only reused while it
+        # was read after the user's latest change (falls back to the TTL when unknown)
+        try:
+            version = self.get_session_list_version(user_id)
+        except Exception as e:
+            print(f"Error reading session list version: {str(e)}")
+            version = None
+        
+        # A cached list answers any limit it covers, or any limit at all once it holds every session.
+        # Several tabs polling the sidebar at once share one Firestore query.
+        entry = self.session_cache.read(
+            user_id, self._load_user_sessions, user_id, query_limit, version,
+            usable=lambda cached: (cached["limit"] >= limit or cached["complete"]) and (
+                version is None or (cached["version"] is not None and cached["version"] >= version)
+            ),
+            flight=(query_limit, version)
+        )
+        # Callers share the cached entry, so hand each one its own copies
+        return [session.model_copy() for session in entry["sessions"][:limit]]
+    
+    def _load_user_sessions(self, user_id: str, limit: int, version: Optional[datetime]) -> dict:
+        sessions = self._query_user_sessions(user_id, limit)
+        return {"limit": limit, "complete": len(sessions) < limit, "sessions": sessions, "version": version}
+    
+    def _session_list_version_ref(self, user_id: str):
+        return self.db.collection(SESSION_LIST_VERSIONS).document(user_id)
+    
+    def get_session_list_version(self, user_id: str) -> Optional[datetime]:
+        """Time of the user's latest session-list change on any worker (None before the first one)"""
+        doc = self._session_list_version_ref(user_id).get()
+        updated_at = (doc.to_dict() or {}).get("updated_at") if doc.exists else None
+        return updated_at.replace(tzinfo=None) if updated_at is not None else None
+    
+    def _touch_session_list(self, user_id: str, at: datetime, batch=None):
+        """Record a change to the user's session list, in the given batch or on its own"""
+        ref = self._session_list_version_ref(user_id)
+        if batch is not None:
+            batch.set(ref, {"updated_at": at}, merge=True)
+        else:
+            ref.set({"updated_at": at}, merge=True)
+    
+    def _query_user_sessions(self, user_id: str, limit: int) -> List[SessionResponse]:
+        """Query a user's sessions from Firestore, newest first"""
         try:
             # First try with ordering (this might fail if no composite index exists)
             sessions_ref = (
@@ -85,75 +173,343 @@ class FirestoreService:
                         last_message=data.get("last_message")
                     ))
             
-            return sessions
+            return self._apply_pending_metadata(sessions)
             
         except Exception as e:
             print(f"Error with ordered query, trying simple query: {e}")
             # Fallback: simple query without ordering
-            try:
-                sessions_ref = (
-                    self.db.collection("chat_sessions")
-                    .where(filter=FieldFilter("user_id", "==", user_id))
-                    .limit(limit)
-                )
-                
-                sessions = []
-                for doc in sessions_ref.stream():
-                    data = doc.to_dict()
-                    if data:  # Ensure data is not None
-                        sessions.append(SessionResponse(
-                            session_id=data.get("session_id", doc.id),
-                            title=data.get("title", "Untitled Chat"),
-                            created_at=data.get("created_at"),
-                            updated_at=data.get("updated_at"),
-                            message_count=data.get("message_count", 0),
-                            last_message=data.get("last_message")
-                        ))
-                
-                # Sort by updated_at in Python if available
-                sessions.sort(key=lambda x: x.updated_at or x.created_at, reverse=True)
-                return sessions
-                
-            except Exception as e2:
-                print(f"Error with simple query: {e2}")
-                # Return empty list if both queries fail
-                return []
-    
-    def get_session_messages(self, session_id: str, user_id: str, limit: int = 100) -> List[ChatMessage]:
-        """Get all messages for a chat session"""
+            sessions_ref = (
+                self.db.collection("chat_sessions")
+                .where(filter=FieldFilter("user_id", "==", user_id))
+                .limit(limit)
+            )
+            
+            sessions = []
+            for doc in sessions_ref.stream():
+                data = doc.to_dict()
+                if data:  # Ensure data is not None
+                    sessions.append(SessionResponse(
+                        session_id=data.get("session_id", doc.id),
+                        title=data.get("title", "Untitled Chat"),
+                        created_at=data.get("created_at"),
+                        updated_at=data.get("updated_at"),
+                        message_count=data.get("message_count", 0),
+                        last_message=data.get("last_message")
+                    ))
+            
+            # Sort by updated_at in Python if available
+            sessions = self._apply_pending_metadata(sessions)
+            sessions.sort(key=lambda x: x.updated_at or x.created_at, reverse=True)
+            return sessions
+    
+    def _apply_pending_metadata(self, sessions: List[SessionResponse]) -> List[SessionResponse]:
+        """Overlay metadata still sitting in the write-behind queue"""
+        changed = False
+        for session in sessions:
+            pending = self.write_queue.pending_metadata(session.session_id)
+            if pending:
+                session.updated_at = pending["updated_at"]
+                session.message_count += pending["message_count_delta"]
+                session.last_message = pending["last_message"]
+                changed = True
+        if changed:
+            sessions.sort(key=lambda x: x.updated_at or x.created_at, reverse=True)
+        return sessions
+    
+    def _cache_upsert_session(self, user_id: str, session: SessionResponse):
+        """Write-through: put a changed session at the top of the cached list"""
+        def apply(entry):
+            sessions = [s for s in entry["sessions"] if s.session_id != session.session_id]
+            sessions.insert(0, session)
+            complete = entry["complete"] and len(sessions) <= entry["limit"]
+            return {**entry, "complete": complete, "sessions": sessions[:entry["limit"]]}
+        self.session_cache.update(user_id, apply)
+    
+    def _cache_touch_session(
+        self,
+        user_id: str,
+        session_id: str,
+        updated_at: datetime,
+        message_delta: int = 0,
+        **fields
+    ):
+        """Write-through: apply changes to a cached session and move it to the top"""
+        def apply(entry):
+            for session in entry["sessions"]:
+                if session.session_id == session_id:
+                    updated = session.model_copy(update={"updated_at": updated_at, **fields})
+                    updated.message_count += message_delta
+                    sessions = [s for s in entry["sessions"] if s.session_id != session_id]
+                    sessions.insert(0, updated)
+                    return {**entry, "sessions": sessions}
+            # Session fell outside the cached window; refetch on next read
+            return None
+        self.session_cache.update(user_id, apply)
+    
+    def _cache_remove_session(self, user_id: str, session_id: str):
+        """Write-through: drop a deleted session from the cached list"""
+        def apply(entry):
+            if not entry["complete"]:
+                # The next older session would shift into the window; refetch instead
+                return None
+            sessions = [s for s in entry["sessions"] if s.session_id != session_id]
+            return {**entry, "complete": True, "sessions": sessions}
+        self.session_cache.update(user_id, apply)
+    
+    def get_session(self, session_id: str, user_id: str) -> SessionResponse:
+        """Get a single session's metadata, verifying it belongs to the user"""
         if not self.is_available():
             raise ValueError("Firestore not available")
         
-        # Verify session belongs to user
         session_doc = self.db.collection("chat_sessions").document(session_id).get()
         if not session_doc.exists or session_doc.to_dict().get("user_id") != user_id:
             raise ValueError("Session not found or access denied")
         
-        messages_ref = (
-            self.db.collection("chat_sessions").document(session_id)
-            .collection("messages")
-            .order_by("timestamp")
-            .limit(limit)
+        data = session_doc.to_dict()
+        session = SessionResponse(
+            session_id=data.get("session_id", session_doc.id),
+            title=data.get("title", "Untitled Chat"),
+            created_at=data.get("created_at"),
+            updated_at=data.get("updated_at"),
+            message_count=data.get("message_count", 0),
+            last_message=data.get("last_message")
         )
+        return self._apply_pending_metadata([session])[0]
+    
+    def owns_session(self, session_id: str, user_id: str) -> bool:
+        """Whether a session belongs to the user; the user's cached session list answers without a read"""
+        if not self.is_available():
+            raise ValueError("Firestore not available")
         
-        messages = []
-        for doc in messages_ref.stream():
-            data = doc.to_dict()
-            messages.append(ChatMessage(
+        # Sessions never change owner, so a cached list of any age is good enough
+        cached = self.session_cache.peek(user_id)
+        if cached is not None and any(session.session_id == session_id for session in cached["sessions"]):
+            return True
+        session_doc = self.db.collection("chat_sessions").document(session_id).get(field_paths=["user_id"])
+        return session_doc.exists and (session_doc.to_dict() or {}).get("user_id") == user_id
+    
+    def get_rated_pair(self, session_id: str, user_id: str, message_id: str) -> Optional[tuple]:
+        """(question, answer content) of an assistant message in the user's session, or None.
+
+        The question is the nearest user message before it. Recent messages
+        (usually cached) are searched first, the whole session only when the
+        message is older.
+        """
+        messages = self.get_recent_messages(session_id, user_id, settings.FEEDBACK_LOOKUP_MESSAGES)
+        pair = self._find_rated_pair(messages, message_id)
+        if pair is None and len(messages) >= settings.FEEDBACK_LOOKUP_MESSAGES:
+            _, message_count = self.get_session_version(session_id, user_id)
+            messages = self.get_session_messages(session_id, user_id, max(message_count, 1), message_count)
+            pair = self._find_rated_pair(messages, message_id)
+        return pair
+    
+    @staticmethod
+    def _find_rated_pair(messages: List[ChatMessage], message_id: str) -> Optional[tuple]:
+        for index, message in enumerate(messages):
+            if message.message_id == message_id and message.role == "assistant":
+                for earlier in reversed(messages[:index]):
+                    if earlier.role == "user":
+                        return earlier.content, message.content
+                return None
+        return None
+    
+    def get_session_version(self, session_id: str, user_id: str) -> tuple:
+        """Return (updated_at, message_count) for a session.
+        
+        Read from the session document rather than this worker's session cache,
+        which misses turns handled by other workers.
+        """
+        if not self.is_available():
+            raise ValueError("Firestore not available")
+        
+        session_doc = self.db.collection("chat_sessions").document(session_id).get()
+        if not session_doc.exists or session_doc.to_dict().get("user_id") != user_id:
+            raise ValueError("Session not found or access denied")
+        
+        data = session_doc.to_dict()
+        updated_at = data.get("updated_at")
+        message_count = data.get("message_count", 0)
+        pending = self.write_queue.pending_metadata(session_id)
+        if pending:
+            updated_at = pending["updated_at"]
+            message_count += pending["message_count_delta"]
+        return updated_at, message_count
+    
+    def get_session_messages(
+        self,
+        session_id: str,
+        user_id: str,
+        limit: int = 100,
+        message_count: Optional[int] = None
+    ) -> List[ChatMessage]:
+        """Get all messages for a chat session.
+        
+        message_count is the session's current count (see get_session_version);
+        the cached tail is only served when it matches, since another worker
+        may have added turns.
+        """
+        if not self.is_available():
+            raise ValueError("Firestore not available")
+        
+        if message_count is None:
+            _, message_count = self.get_session_version(session_id, user_id)
+        cached = self.tail_cache.get_all(session_id, user_id, limit, message_count)
+        if cached is not None:
+            return cached
+        
+        # Keyed on the session version: a caller that just wrote gets a new key
+        # instead of joining a read that started before its write
+        messages = self._messages_flight.do(
+            (session_id, user_id, limit, message_count), self._read_session_messages, session_id, user_id, limit
+        )
+        return list(messages)
+    
+    def get_recent_messages(
+        self,
+        session_id: str,
+        user_id: str,
+        count: int = 20,
+        message_count: Optional[int] = None
+    ) -> List[ChatMessage]:
+        """Get the newest messages of a chat session, oldest first.
+        
+        Without message_count the cached tail is trusted as is: right after
+        add_message_to_session, which already drops a tail that missed
+        another worker's turns.
+        """
+        if not self.is_available():
+            raise ValueError("Firestore not available")
+        
+        cached = self.tail_cache.get_recent(session_id, user_id, count, message_count)
+        if cached is not None:
+            return cached
+        
+        if message_count is None:
+            # No version to key on, and the caller may just have written: read on its own
+            return self._read_session_messages(session_id, user_id, count, True)
+        messages = self._messages_flight.do(
+            ("recent", session_id, user_id, count, message_count),
+            self._read_session_messages, session_id, user_id, count, True
+        )
+        return list(messages)
+    
+    def _read_session_messages(
+        self,
+        session_id: str,
+        user_id: str,
+        limit: int,
+        newest: bool = False
+    ) -> List[ChatMessage]:
+        """Read a session's messages (hot documents plus archive buckets) and any still-queued writes"""
+        session_ref = self.db.collection("chat_sessions").document(session_id)
+        if newest:
+            hot, archived, session_data = self._read_newest(session_ref, session_id, user_id, limit)
+        else:
+            hot, archived, session_data = self._read_oldest(session_ref, session_id, user_id, limit)
+        self._maybe_compact(session_id, session_data)
+        
+        # Archived messages are always older than the hot ones
+        rows = list(archived)
+        seen_ids = {row["message_id"] for row in rows}
+        rows.extend(row for row in hot if row["message_id"] not in seen_ids)
+        rows = rows[-limit:] if newest else rows[:limit]
+        seen_ids.update(row["message_id"] for row in hot)
+        
+        # Read-your-writes: include messages still waiting in the write-behind queue
+        whole_session = len(rows) < limit
+        for data in self.write_queue.pending_messages(session_id):
+            if data["message_id"] not in seen_ids and (newest or len(rows) < limit):
+                rows.append(data)
+        if newest:
+            rows = rows[-limit:]
+        
+        # Stored documents of either schema (and queued messages) to text or item arrays
+        rows = self.blobs.decode(rows)
+        messages = [
+            ChatMessage(
                 role=data["role"],
                 content=data["content"],
                 timestamp=data["timestamp"],
-                message_id=doc.id
-            ))
+                message_id=data["message_id"]
+            )
+            for data in rows
+        ]
         
+        # Keep the tail in memory so the next turn's history skips Firestore
+        if newest or whole_session:
+            self.tail_cache.put(
+                session_id, user_id, messages,
+                complete=whole_session,
+                message_count=self._message_count(session_id, session_data)
+            )
         return messages
     
+    @staticmethod
+    def _owned_session_data(session_doc, user_id: str) -> dict:
+        if not session_doc.exists or session_doc.to_dict().get("user_id") != user_id:
+            raise ValueError("Session not found or access denied")
+        return session_doc.to_dict()
+    
+    def _read_newest(self, session_ref, session_id: str, user_id: str, limit: int) -> tuple:
+        """(hot, archived, session data) for the newest messages: hot documents first, buckets only when short"""
+        # Hot documents are read before the session document: if compaction moves
+        # some of them into the archive in between, the session document already
+        # shows the new bucket and the duplicates are dropped by the caller
+        messages_ref = session_ref.collection("messages").order_by(
+            "timestamp", direction=firestore.Query.DESCENDING
+        ).limit(limit)
+        hot = [{**doc.to_dict(), "message_id": doc.id} for doc in messages_ref.stream()]
+        hot.reverse()
+        
+        session_data = self._owned_session_data(session_ref.get(), user_id)
+        archived = []
+        if session_data.get("archive_buckets") and len(hot) < limit:
+            archived = self.archive.read_buckets(session_id, newest_first=True, limit=limit - len(hot))
+        return hot, archived, session_data
+    
+    def _read_oldest(self, session_ref, session_id: str, user_id: str, limit: int) -> tuple:
+        """(hot, archived, session data) for the oldest messages: buckets first, then only the hot documents still needed"""
+        session_data = self._owned_session_data(session_ref.get(), user_id)
+        for attempt in range(3):
+            archived = []
+            if session_data.get("archive_buckets"):
+                archived = self.archive.read_buckets(session_id, limit=limit)
+            needed = limit - len(archived)
+            if needed <= 0:
+                return [], archived, session_data
+            messages_ref = session_ref.collection("messages").order_by(
+                "timestamp", direction=firestore.Query.ASCENDING
+            ).limit(needed)
+            hot = [{**doc.to_dict(), "message_id": doc.id} for doc in messages_ref.stream()]
+            
+            # Compaction only runs on sessions with a long hot tail. If it moved a bucket
+            # after the archive read, those messages are in neither list: read again.
+            hot_count = session_data.get("message_count", 0) - session_data.get("archived_count", 0)
+            if hot_count < settings.ARCHIVE_HOT_MESSAGES or attempt == 2:
+                break
+            current = (session_ref.get(field_paths=["archived_count"]).to_dict() or {}).get("archived_count", 0)
+            if current == len(archived):
+                break
+            session_data = self._owned_session_data(session_ref.get(), user_id)
+        return hot, archived, session_data
+    
+    def _message_count(self, session_id: str, session_data: dict) -> int:
+        """Total messages of a session including writes still in the write-behind queue"""
+        pending = self.write_queue.pending_metadata(session_id)
+        return session_data.get("message_count", 0) + (pending["message_count_delta"] if pending else 0)
+    
+    def _maybe_compact(self, session_id: str, session_data: dict, new_messages: int = 0):
+        """Hand a session to background compaction once it has a full bucket beyond the hot tail"""
+        hot_count = session_data.get("message_count", 0) + new_messages - session_data.get("archived_count", 0)
+        if hot_count >= settings.ARCHIVE_HOT_MESSAGES + settings.ARCHIVE_BUCKET_MESSAGES:
+            self.archive.schedule(session_id)
+    
     def add_message_to_session(
         self, 
         session_id: str, 
         user_id: str, 
         role: str, 
-        content: str
+        content: Union[str, List[dict]]
     ) -> str:
         """Add a message to a chat session"""
         if not self.is_available():
@@ -177,19 +533,82 @@ class FirestoreService:
             "message_id": message_id
         }
         
-        # Add message to subcollection
-        session_ref.collection("messages").document(message_id).set(message_data)
+        last_message = message_preview(content)
+        message_count = self._message_count(session_id, session_doc.to_dict())
         
-        # Update session metadata
-        session_data = session_doc.to_dict()
-        session_ref.update({
-            "updated_at": now,
-            "message_count": session_data.get("message_count", 0) + 1,
-            "last_message": content[:100] + "..." if len(content) > 100 else content
-        })
+        if self.write_queue.has_pending(session_id):
+            # Keep ordering with writes that are still queued for this session
+            self.write_queue.enqueue_message(session_id, user_id, message_data)
+        else:
+            # Add message to subcollection (with any shared code blocks) and update session metadata
+            batch = self.db.batch()
+            batch.set(
+                session_ref.collection("messages").document(message_id),
+                self.blobs.write(batch, message_data)
+            )
+            batch.update(session_ref, {
+                "updated_at": now,
+                "message_count": firestore.Increment(1),
+                "last_message": last_message
+            })
+            self._touch_session_list(user_id, now, batch)
+            batch.commit()
+        
+        self._cache_touch_session(user_id, session_id, now, message_delta=1, last_message=last_message)
+        self.tail_cache.append(session_id, ChatMessage(**message_data), expected_count=message_count)
+        self._maybe_compact(session_id, session_doc.to_dict(), new_messages=1)
         
         return message_id
     
+    def queue_message_to_session(
+        self,
+        session_id: str,
+        user_id: str,
+        role: str,
+        content: Union[str, List[dict]]
+    ) -> str:
+        """Add a message through the write-behind queue without blocking on Firestore.
+        
+        Callers must already have verified that the session belongs to the user
+        (e.g. by adding the user message of the same turn).
+        """
+        if not self.is_available():
+            raise ValueError("Firestore not available")
+        # Checked before anything is queued: a bad message would be retried against Firestore forever
+        if role == "user" and not (isinstance(content, str) and content.strip()):
+            raise ValueError("User messages must be non-empty text")
+        if role == "assistant" and not isinstance(content, str) and not (
+            isinstance(content, list) and all(is_valid_item(item) for item in content)
+        ):
+            raise ValueError("Assistant messages must be text or an array of response items")
+        if role not in ("user", "assistant"):
+            raise ValueError(f"Unknown message role: {role}")
+        
+        message_id = str(uuid.uuid4())
+        now = datetime.utcnow()
+        message_data = {
+            "role": role,
+            "content": content,
+            "timestamp": now,
+            "message_id": message_id
+        }
+        message = ChatMessage(**message_data)
+        self.write_queue.enqueue_message(session_id, user_id, message_data)
+        self.tail_cache.append(session_id, message)
+        self._cache_touch_session(
+            user_id, session_id, now,
+            message_delta=1,
+            last_message=message_preview(content)
+        )
+        return message_id
+    
+    def flush_pending_writes(self, timeout: float = 10.0) -> bool:
+        """Stop archive compaction and drain the write-behind queue (used on shutdown)"""
+        if self.write_queue is None:
+            return True
+        self.archive.stop()
+        return self.write_queue.stop(timeout)
+    
     def update_session_title(self, session_id: str, user_id: str, title: str) -> bool:
         """Update the title of a chat session"""
         if not self.is_available():
@@ -201,10 +620,16 @@ class FirestoreService:
         if not session_doc.exists or session_doc.to_dict().get("user_id") != user_id:
             raise ValueError("Session not found or access denied")
         
-        session_ref.update({
+        now = datetime.utcnow()
+        batch = self.db.batch()
+        batch.update(session_ref, {
             "title": title,
-            "updated_at": datetime.utcnow()
+            "updated_at": now
         })
+        self._touch_session_list(user_id, now, batch)
+        batch.commit()
+        self._cache_touch_session(user_id, session_id, now, title=title)
+        self.tail_cache.invalidate(session_id)
         
         return True
     
@@ -219,13 +644,24 @@ class FirestoreService:
         if not session_doc.exists or session_doc.to_dict().get("user_id") != user_id:
             raise ValueError("Session not found or access denied")
         
-        # Delete all messages in the session
+        # Drop queued writes so they cannot recreate messages after the delete
+        self.write_queue.discard_session(session_id)
+        self.archive.discard(session_id)
+        self.tail_cache.invalidate(session_id)
+        
+        # Delete all messages in the session, then the archive buckets holding older ones. Their
+        # code blocks may be shared with other sessions and are left to message_format sweep
         messages_ref = session_ref.collection("messages")
         for doc in messages_ref.stream():
             doc.reference.delete()
+        self.archive.delete_buckets(session_id)
+        for doc in session_ref.collection("idempotency").stream():
+            doc.reference.delete()
         
         # Delete the session
         session_ref.delete()
+        self._touch_session_list(user_id, datetime.utcnow())
+        self._cache_remove_session(user_id, session_id)
         
         return True
 
@@ -1,35 +1,211 @@
 import os
-from typing import List, Dict, Any
+import re
+import threading
+import time
+from typing import List, Dict, Any, Iterator
 import google.generativeai as genai
 from app.core.config import settings
+from app.services.kb_index import DEFAULT_KB_PATH, load_kb_documents, open_index, tokenize
+from app.services.single_flight import SingleFlight, normalize_text, request_key
+from app.services.scope_classifier import ScopeClassifier, OFF_TOPIC_RESPONSE, is_off_topic_response
+from app.services.metrics import metrics
+from app.services.dense_retriever import DenseRetriever
+from app.services.kb_context import SessionContextLedger, expand_query
+from app.services.message_format import BLOB_TYPES, message_text, parse_legacy_content
+from app.services.usage_service import usage_tracker
+
+
+# System prompt for IEC analyst
+SYSTEM_PROMPT = """You are an IEC 61131-3 programming analyst and expert. You specialize ONLY in PLC programming, ladder diagrams, and industrial automation. SCOPE RESTRICTION - VERY IMPORTANT: - You ONLY answer questions related to PLCs, IEC 61131-3, industrial automation, control systems, ladder diagrams, SCADA, HMI, and related industrial topics - For ANY question outside of PLC/industrial automation scope, you MUST politely decline with a specific rejection message - If a question is not related to PLCs or industrial automation, respond with: [{"type": "text", "content": "I'm sorry, but I can only answer questions related to PLCs, IEC 61131-3 programming, industrial automation, and control systems. Please ask me about ladder diagrams, PLC programming, SCADA systems, or other industrial automation topics."}] CRITICAL INSTRUCTIONS: 1. You MUST ALWAYS return a JSON array - NEVER any other format 2. NEVER use markdown, code blocks, or any formatting - only pure JSON array 3. Even for single responses, wrap in array format 4. Each array item must have "type" and "content" fields 5. When you output ladder or plc-code, INCLUDE a validation object that assesses executability and correctness 6. ALWAYS check if the question is PLC/industrial automation related FIRST before providing any technical answer RESPONSE FORMAT (ALWAYS AN ARRAY): [ {"type": "text", "content": "your text response"}, {"type": "ladder", "content": "ASCII ladder diagram", "validation": {"status": "valid|invalid|unknown", "executable": true/false, "reason": "why", "warnings": ["optional"]}}, {"type": "plc-code", "content": "PLC code in IEC 61131-3 format", "validation": {"status": "valid|invalid|unknown", "executable": true/false, "reason": "why", "warnings": ["optional"]}} ] VALID TYPES: "text", "ladder", "plc-code" LADDER DIAGRAM FORMATTING RULES: - Use proper ASCII art with lines, boxes, and connections - Use \\n for newlines (will be converted to actual newlines in frontend) - Use consistent spacing and alignment - Power rails: | (left) and | (right) - Horizontal lines: --- or ---- - Contacts: ] [ (NO) or ]/ [ (NC) - Coils: ( ) for outputs, (S) for set, (R) for reset - Function blocks: [TON], [CTU], etc. - Always show complete rungs with proper connections - Label inputs/outputs clearly - Use proper electrical symbols LADDER EXAMPLE FORMAT: "|----] [----] [----[TON]----( )-------|\\n| Start Stop Timer1 Output |\\n| |\\n|----]/[---------------------(S)------|\\n| Emergency Alarm |" VALIDATION RULES: - For ladder or plc-code, analyze syntax, required declarations, and typical runtime conditions - Set executable to true if it can compile/run as-is on common IEC 61131-3 runtimes; otherwise false - Set status accordingly and provide a concise reason; include warnings if applicable RULES: - ALWAYS return array format, even for single responses - Include text explanation when providing code or diagrams - Be concise and precise - NO markdown, NO
+json, NO extra text - ONLY JSON array
+- For ladder diagrams: Use proper ASCII art with \\n newlines and consistent formatting
+
+EXAMPLES:
+PLC Related Question:
+User: "What is a timer?"
+Response: [{"type": "text", "content": "A timer is a device that delays actions in PLC programs. It counts time intervals and activates outputs when preset time is reached."}]
+
+PLC Related Question:
+User: "Show me a timer implementation"
+Response: [
+  {"type": "text", "content": "Here's a complete timer implementation with ladder diagram and code:"},
+  {"type": "ladder", "content": "|----] [----] [----[TON]----( )-------|\\n|   Start   Stop  Timer1   Output    |\\n|                                      |\\n|           Timer1.IN := Start        |\\n|           Timer1.PT := T#5s          |\\n|           Output := Timer1.Q         |", "validation": {"status": "valid", "executable": true, "reason": "Standard TON usage with proper contacts and coil"}},
+  {"type": "plc-code", "content": "PROGRAM Timer_Example\\nVAR\\n  StartButton: BOOL;\\n  StopButton: BOOL;\\n  Timer1: TON;\\n  Output: BOOL;\\nEND_VAR\\n\\nTimer1(IN:=StartButton AND NOT StopButton, PT:=T#5s);\\nOutput := Timer1.Q;\\nEND_PROGRAM", "validation": {"status": "valid", "executable": true, "reason": "Compiles on IEC ST with proper declarations"}}
+]
+
+NON-PLC Questions (REJECT THESE):
+User: "What's the weather like?"
+Response: [{"type": "text", "content": "I'm sorry, but I can only answer questions related to PLCs, IEC 61131-3 programming, industrial automation, and control systems. Please ask me about ladder diagrams, PLC programming, SCADA systems, or other industrial automation topics."}]
+
+User: "How do I cook pasta?"
+Response: [{"type": "text", "content": "I'm sorry, but I can only answer questions related to PLCs, IEC 61131-3 programming, industrial automation, and control systems. Please ask me about ladder diagrams, PLC programming, SCADA systems, or other industrial automation topics."}]
+
+User: "Tell me about history"
+Response: [{"type": "text", "content": "I'm sorry, but I can only answer questions related to PLCs, IEC 61131-3 programming, industrial automation, and control systems. Please ask me about ladder diagrams, PLC programming, SCADA systems, or other industrial automation topics."}]"""
+
+
+FULL_RESPONSE_SCHEMA = {
+    "type": "array",
+    "items": {
+        "type": "object",
+        "properties": {
+            "type": {"type": "string", "enum": ["text", "ladder", "plc-code"]},
+            "content": {"type": "string"},
+            "validation": {
+                "type": "object",
+                "properties": {
+                    "status": {"type": "string", "enum": ["valid", "invalid", "unknown"]},
+                    "executable": {"type": "boolean"},
+                    "reason": {"type": "string"},
+                    "warnings": {"type": "array", "items": {"type": "string"}}
+                },
+                "required": ["status", "executable"],
+            },
+        },
+        "required": ["type", "content"],
+    },
+}
+
+TEXT_RESPONSE_SCHEMA = {
+    "type": "array",
+    "items": {
+        "type": "object",
+        "properties": {
+            "type": {"type": "string", "enum": ["text"]},
+            "content": {"type": "string"},
+        },
+        "required": ["type", "content"],
+    },
+}
+
+# Generation profiles: short conceptual answers vs. code / ladder generation
+GENERATION_PROFILES = {
+    "short": {"max_output_tokens": 512, "response_schema": TEXT_RESPONSE_SCHEMA},
+    "full": {"max_output_tokens": 2048, "response_schema": FULL_RESPONSE_SCHEMA},
+}
+
+_ARTIFACT_RE = re.compile(
+    r"\b(write|show|create|generate|implement|program|code|ladder|diagram|rung|example|sample|"
+    r"snippet|template|st|structured text|function block|fb|convert|build|design|modify|"
+    r"change|add|update|fix|refactor|extend|rewrite|step[- ]by[- ]step)\b"
+)
+_QUESTION_RE = re.compile(
+    r"^\s*(what|what's|whats|who|why|when|which|is|are|does|do|can|explain|define|describe|"
+    r"difference|compare|meaning|tell me)\b"
+)
+
+
+# Yielded by chat_stream when a truncated reply is regenerated: discard what was streamed so far
+RESTART_STREAM = object()
+
+
+def _has_artifact(content) -> bool:
+    """Whether a stored assistant reply contains code or a ladder diagram"""
+    items = parse_legacy_content(content) if isinstance(content, str) else content
+    return any(item.get("type") in BLOB_TYPES for item in items or [])
+
+
+def classify_request(message: str, conversation_history: List[Dict[str, str]] = None) -> str:
+    """Pick a generation profile; anything that may need code or a diagram gets "full".
+
+    A follow-up (see expand_query) to a turn that asked for or produced
+    code is classified with that turn, since it usually asks for a change.
+    """
+    text = (message or "").lower()
+    if len(text) > 200 or _ARTIFACT_RE.search(text) or not _QUESTION_RE.search(text):
+        return "full"
+    if conversation_history and expand_query(message, conversation_history) != message:
+        for msg in conversation_history[-2:]:
+            content = msg.get("content", "")
+            if msg.get("role") == "assistant" and _has_artifact(content):
+                return "full"
+            if msg.get("role") == "user" and classify_request(message_text(content)) == "full":
+                return "full"
+    return "short"
+
+
+def _truncated(response) -> bool:
+    """Whether Gemini stopped because the profile's max_output_tokens ran out"""
+    try:
+        reason = response.candidates[0].finish_reason
+    except (AttributeError, IndexError, TypeError):
+        return False
+    return getattr(reason, "name", str(reason)) == "MAX_TOKENS"
 
 
 class SimpleKBRetriever:
-    """Lightweight KB retriever using keyword matching"""
-    def __init__(self, kb_path: str = None):
+    """Lightweight KB retriever using keyword matching.
+
+    Uses the shared memory-mapped index when one has been built, otherwise
+    reads and tokenizes the raw kb/ files in-process.
+    """
+    def __init__(self, kb_path: str = None, index_path: str = None):
         if kb_path is None:
-            kb_path = os.path.join(os.path.dirname(__file__), "kb")
+            kb_path = DEFAULT_KB_PATH
         self.kb_path = os.path.abspath(kb_path)
+        self.index = open_index(index_path if index_path is not None else settings.KB_INDEX_PATH, self.kb_path)
         self.docs = []
-        self._load_kb()
+        self.names = []
+        self._doc_words = []
+        if self.index is not None:
+            print(f"KB index mapped from {self.index.index_path} ({len(self.index)} documents)")
+        else:
+            self._load_kb()
 
     def _load_kb(self):
-        for file in os.listdir(self.kb_path):
-            full_path = os.path.join(self.kb_path, file)
-            if os.path.isfile(full_path):
-                with open(full_path, "r", encoding="utf-8") as f:
-                    self.docs.append(f.read())
+        for name, text in load_kb_documents(self.kb_path):
+            self.names.append(name)
+            self.docs.append(text)
+            self._doc_words.append(set(tokenize(text)))
+
+    def _score(self, query_words: set) -> List[tuple]:
+        """(score, doc_id) for every document sharing at least one query word"""
+        if self.index is not None:
+            counts = {}
+            for word in query_words:
+                for doc_id in self.index.postings(word):
+                    counts[doc_id] = counts.get(doc_id, 0) + 1
+            return [(score, doc_id) for doc_id, score in counts.items()]
+        return [
+            (len(query_words & doc_words), doc_id)
+            for doc_id, doc_words in enumerate(self._doc_words)
+        ]
+
+    def _document(self, doc_id: int) -> str:
+        if self.index is not None:
+            return self.index.document(doc_id)
+        return self.docs[doc_id]
+
+    def document(self, doc_id: int) -> str:
+        return self._document(doc_id)
+
+    def document_name(self, doc_id: int) -> str:
+        if self.index is not None:
+            return self.index.document_name(doc_id)
+        return self.names[doc_id]
+
+    def document_count(self) -> int:
+        return len(self.index) if self.index is not None else len(self.docs)
+
+    def lexical_scores(self, query_words: set) -> List[tuple]:
+        """(overlap, doc_id) for documents sharing at least one query word"""
+        return [(score, doc_id) for score, doc_id in self._score(query_words) if score > 0]
+
+    def vocabulary(self) -> set:
+        """All indexed terms (used to seed the scope classifier)"""
+        if self.index is not None:
+            return {self.index.term(i) for i in range(self.index.n_terms)}
+        return set().union(*self._doc_words) if self._doc_words else set()
+
+    def top_documents(self, query: str, top_k: int = 3) -> List[int]:
+        """Ids of the top_k docs by keyword overlap"""
+        scored_docs = self._score(set(tokenize(query)))
+        scored_docs.sort(key=lambda x: (-x[0], x[1]))
+        return [doc_id for score, doc_id in scored_docs[:top_k] if score > 0]
 
     def retrieve(self, query: str, top_k: int = 3) -> List[str]:
         """Retrieve top_k docs by keyword overlap"""
-        query_words = set(query.lower().split())
-        scored_docs = []
-        for doc in self.docs:
-            doc_words = set(doc.lower().split())
-            score = len(query_words & doc_words)
-            scored_docs.append((score, doc))
-        scored_docs.sort(reverse=True, key=lambda x: x[0])
-        return [doc for score, doc in scored_docs[:top_k] if score > 0]
+        return [self._document(doc_id) for doc_id in self.top_documents(query, top_k)]
 
 
 class GeminiService:
@@ -45,6 +221,24 @@ class GeminiService:
         if getattr(self, "_initialized", False):
             return
         self.kb_retriever = SimpleKBRetriever()
+        # Dense + keyword retrieval over KB chunks and library entries (keyword-only until built)
+        self.retriever = DenseRetriever(self.kb_retriever)
+        # KB passages already in each session's prompt, so follow-ups don't repeat them
+        self.kb_context = SessionContextLedger()
+        metrics.register("kb_context", self.kb_context.stats)
+        # Identical concurrent requests (e.g. a whole class sending the same prompt) share one call
+        self._chat_flight = SingleFlight("gemini_chat")
+        self._kb_flight = SingleFlight("kb_retrieve")
+        # Local scope gate: answers clearly off-topic questions without calling Gemini
+        self.scope_classifier = ScopeClassifier(self.kb_retriever.vocabulary())
+        self.scope_stats = {"checked": 0, "blocked": 0, "tp": 0, "fp": 0, "tn": 0, "fn": 0}
+        # Counted from request threads and the event loop at once
+        self._scope_lock = threading.Lock()
+        metrics.register("scope_gate", self._scope_gate_metrics)
+        self.profile_stats = {
+            name: {"requests": 0, "total_ms": 0.0, "max_ms": 0.0, "truncated": 0} for name in GENERATION_PROFILES
+        }
+        metrics.register("generation_profiles", self._profile_metrics)
         self._initialize_gemini()
         self._initialized = True
 
@@ -54,97 +248,251 @@ class GeminiService:
             genai.configure(api_key=settings.GEMINI_API_KEY)
             print(f"Gemini configured with API key: {settings.GEMINI_API_KEY[:10]}...")
 
-            response_schema = {
-                "type": "array",
-                "items": {
-                    "type": "object",
-                    "properties": {
-                        "type": {"type": "string", "enum": ["text", "ladder", "plc-code"]},
-                        "content": {"type": "string"},
-                        "validation": {
-                            "type": "object",
-                            "properties": {
-                                "status": {"type": "string", "enum": ["valid", "invalid", "unknown"]},
-                                "executable": {"type": "boolean"},
-                                "reason": {"type": "string"},
-                                "warnings": {"type": "array", "items": {"type": "string"}}
-                            },
-                            "required": ["status", "executable"],
-                        },
-                    },
-                    "required": ["type", "content"],
-                },
-            }
-
-            self.model = genai.GenerativeModel(
-                "gemini-2.0-flash",
-                generation_config=genai.GenerationConfig(
-                    temperature=0.3,
-                    max_output_tokens=2048,
-                    response_mime_type="application/json",
-                    response_schema=response_schema
+            # One prebuilt model per generation profile
+            self.models = {
+                name: genai.GenerativeModel(
+                    "gemini-2.0-flash",
+                    generation_config=genai.GenerationConfig(
+                        temperature=0.3,
+                        max_output_tokens=profile["max_output_tokens"],
+                        response_mime_type="application/json",
+                        response_schema=profile["response_schema"]
+                    )
                 )
-            )
+                for name, profile in GENERATION_PROFILES.items()
+            }
+            self.model = self.models["full"]
         else:
             print("Warning: GEMINI_API_KEY not found in environment variables")
+            self.models = {}
             self.model = None
 
     def is_available(self) -> bool:
         return self.model is not None and bool(settings.GEMINI_API_KEY)
 
-    def chat(self, message: str, conversation_history: List[Dict[str, str]] = None) -> str:
+    def _is_off_topic(self, message: str, conversation_history: List[Dict[str, str]] = None) -> bool:
+        """Local scope check; follow-ups are judged together with the previous user turn"""
+        score = self.scope_classifier.score(message)
+        previous = [msg for msg in (conversation_history or []) if msg.get("role") == "user"]
+        if previous:
+            score = max(score, self.scope_classifier.score(f"{previous[-1].get('content', '')} {message}"))
+        self._count_scope("checked")
+        return score < settings.SCOPE_GATE_THRESHOLD
+
+    def _record_shadow(self, predicted_off_topic: bool, ai_response: str):
+        """Compare the local decision with Gemini's own rejection (shadow mode)"""
+        rejected = is_off_topic_response(ai_response)
+        if predicted_off_topic:
+            self._count_scope("tp" if rejected else "fp")
+        else:
+            self._count_scope("fn" if rejected else "tn")
+
+    def _count_scope(self, key: str):
+        with self._scope_lock:
+            self.scope_stats[key] += 1
+
+    def _scope_gate_metrics(self) -> dict:
+        with self._scope_lock:
+            stats = dict(self.scope_stats)
+        predicted = stats["tp"] + stats["fp"]
+        actual = stats["tp"] + stats["fn"]
+        stats.update({
+            "mode": settings.SCOPE_GATE_MODE,
+            "threshold": settings.SCOPE_GATE_THRESHOLD,
+            "precision": stats["tp"] / predicted if predicted else None,
+            "recall": stats["tp"] / actual if actual else None,
+        })
+        return stats
+
+    def _record_profile(self, profile: str, started_at: float, truncated: bool = False):
+        elapsed_ms = (time.perf_counter() - started_at) * 1000
+        stats = self.profile_stats[profile]
+        stats["requests"] += 1
+        stats["total_ms"] += elapsed_ms
+        stats["max_ms"] = max(stats["max_ms"], elapsed_ms)
+        if truncated:
+            stats["truncated"] += 1
+
+    def _profile_metrics(self) -> dict:
+        total = sum(stats["requests"] for stats in self.profile_stats.values())
+        return {
+            name: {
+                "requests": stats["requests"],
+                "hit_rate": stats["requests"] / total if total else None,
+                "avg_ms": stats["total_ms"] / stats["requests"] if stats["requests"] else None,
+                "max_ms": stats["max_ms"],
+                "truncated": stats["truncated"],
+            }
+            for name, stats in self.profile_stats.items()
+        }
+
+    def _prepare_chat(
+        self,
+        message: str,
+        conversation_history: List[Dict[str, str]] = None,
+        session_id: str = None
+    ):
+        """Build the Gemini chat history and the KB-augmented user turn.
+
+        Without a session the retrieved passages are attached to the user turn.
+        With one, they go into a reference block ahead of the replayed history,
+        together with the previous turn's passages when this turn is a
+        follow-up (see SessionContextLedger).
+        Also returns the characters each prompt section contributed, for
+        token accounting.
+        """
+        # Retrieve KB context; follow-ups are expanded with the previous question
+        query = expand_query(message, conversation_history)
+        kb_contexts = self._kb_flight.do(
+            request_key(normalize_text(query)),
+            self.retriever.retrieve,
+            query
+        )
+
+        # Prepare conversation history
+        history = [{"role": "user", "parts": [SYSTEM_PROMPT]}]
+        history.append({"role": "model", "parts": ["Understood. I will respond only in valid JSON format with the specified types based on what you ask."]})
+        sections = {"system": sum(len(turn["parts"][0]) for turn in history)}
+
+        if session_id is None:
+            kb_text = "\n".join(kb_contexts) if kb_contexts else ""
+            message_with_context = f"Context from KB:\n{kb_text}\n\nUser Question: {message}"
+            sections["kb_context"] = len(message_with_context) - len(message)
+        else:
+            reference, _ = self.kb_context.update(session_id, kb_contexts or [], follow_up=query != message)
+            if reference:
+                history.append({"role": "user", "parts": [
+                    "Context from KB for this conversation:\n" + "\n\n".join(reference)
+                ]})
+                history.append({"role": "model", "parts": ["Understood. I will use this context where it is relevant."]})
+            message_with_context = f"User Question: {message}"
+            sections["kb_context"] = sum(len(turn["parts"][0]) for turn in history[2:])
+        sections["message"] = len(message)
+
+        replayed = len(history)
+        if conversation_history:
+            for msg in conversation_history[-8:]:
+                if msg.get("role") == "user":
+                    history.append({"role": "user", "parts": [message_text(msg.get("content", ""))]})
+                elif msg.get("role") == "assistant":
+                    history.append({"role": "model", "parts": [message_text(msg.get("content", ""))]})
+        sections["history"] = sum(len(turn["parts"][0]) for turn in history[replayed:])
+
+        return history, message_with_context, sections
+
+    def chat(
+        self,
+        message: str,
+        conversation_history: List[Dict[str, str]] = None,
+        session_id: str = None,
+        user_id: str = None,
+        source: str = "api"
+    ) -> str:
         if not self.is_available():
             raise ValueError("Gemini API key not configured")
 
         try:
-            # Retrieve KB context
-            kb_contexts = self.kb_retriever.retrieve(message)
-            kb_text = "\n".join(kb_contexts) if kb_contexts else ""
-            message_with_context = f"Context from KB:\n{kb_text}\n\nUser Question: {message}"
+            mode = settings.SCOPE_GATE_MODE
+            off_topic = mode != "off" and self._is_off_topic(message, conversation_history)
+            if off_topic and mode == "enforce":
+                self._count_scope("blocked")
+                return OFF_TOPIC_RESPONSE
 
-            # System prompt for IEC analyst
-            system_prompt = """You are an IEC 61131-3 programming analyst and expert. You specialize ONLY in PLC programming, ladder diagrams, and industrial automation. SCOPE RESTRICTION - VERY IMPORTANT: - You ONLY answer questions related to PLCs, IEC 61131-3, industrial automation, control systems, ladder diagrams, SCADA, HMI, and related industrial topics - For ANY question outside of PLC/industrial automation scope, you MUST politely decline with a specific rejection message - If a question is not related to PLCs or industrial automation, respond with: [{"type": "text", "content": "I'm sorry, but I can only answer questions related to PLCs, IEC 61131-3 programming, industrial automation, and control systems. Please ask me about ladder diagrams, PLC programming, SCADA systems, or other industrial automation topics."}] CRITICAL INSTRUCTIONS: 1. You MUST ALWAYS return a JSON array - NEVER any other format 2. NEVER use markdown, code blocks, or any formatting - only pure JSON array 3. Even for single responses, wrap in array format 4. Each array item must have "type" and "content" fields 5. When you output ladder or plc-code, INCLUDE a validation object that assesses executability and correctness 6. ALWAYS check if the question is PLC/industrial automation related FIRST before providing any technical answer RESPONSE FORMAT (ALWAYS AN ARRAY): [ {"type": "text", "content": "your text response"}, {"type": "ladder", "content": "ASCII ladder diagram", "validation": {"status": "valid|invalid|unknown", "executable": true/false, "reason": "why", "warnings": ["optional"]}}, {"type": "plc-code", "content": "PLC code in IEC 61131-3 format", "validation": {"status": "valid|invalid|unknown", "executable": true/false, "reason": "why", "warnings": ["optional"]}} ] VALID TYPES: "text", "ladder", "plc-code" LADDER DIAGRAM FORMATTING RULES: - Use proper ASCII art with lines, boxes, and connections - Use \\n for newlines (will be converted to actual newlines in frontend) - Use consistent spacing and alignment - Power rails: | (left) and | (right) - Horizontal lines: --- or ---- - Contacts: ] [ (NO) or ]/ [ (NC) - Coils: ( ) for outputs, (S) for set, (R) for reset - Function blocks: [TON], [CTU], etc. - Always show complete rungs with proper connections - Label inputs/outputs clearly - Use proper electrical symbols LADDER EXAMPLE FORMAT: "|----] [----] [----[TON]----( )-------|\\n| Start Stop Timer1 Output |\\n| |\\n|----]/[---------------------(S)------|\\n| Emergency Alarm |" VALIDATION RULES: - For ladder or plc-code, analyze syntax, required declarations, and typical runtime conditions - Set executable to true if it can compile/run as-is on common IEC 61131-3 runtimes; otherwise false - Set status accordingly and provide a concise reason; include warnings if applicable RULES: - ALWAYS return array format, even for single responses - Include text explanation when providing code or diagrams - Be concise and precise - NO markdown, NO
-json, NO extra text - ONLY JSON array
-- For ladder diagrams: Use proper ASCII art with \\n newlines and consistent formatting
+            history, message_with_context, sections = self._prepare_chat(message, conversation_history, session_id)
+            # Everything after the fixed system turns (KB block and replayed history) is part of the key
+            key = request_key(
+                normalize_text(message),
+                [(turn["role"], turn["parts"][0]) for turn in history[2:]]
+            )
+            # Coalesced callers share one Gemini call, accounted to the caller that made it
+            response_text = self._chat_flight.do(
+                key, self._send_chat, classify_request(message, conversation_history), history,
+                message_with_context, (user_id, session_id, source, sections)
+            )
+            if mode == "shadow":
+                self._record_shadow(off_topic, response_text)
+            return response_text
 
-EXAMPLES:
-PLC Related Question:
-User: "What is a timer?"
-Response: [{"type": "text", "content": "A timer is a device that delays actions in PLC programs. It counts time intervals and activates outputs when preset time is reached."}]
+        except Exception as e:
+            raise ValueError(f"Failed to get response from Gemini: {str(e)}")
 
-PLC Related Question:
-User: "Show me a timer implementation"
-Response: [
-  {"type": "text", "content": "Here's a complete timer implementation with ladder diagram and code:"},
-  {"type": "ladder", "content": "|----] [----] [----[TON]----( )-------|\\n|   Start   Stop  Timer1   Output    |\\n|                                      |\\n|           Timer1.IN := Start        |\\n|           Timer1.PT := T#5s          |\\n|           Output := Timer1.Q         |", "validation": {"status": "valid", "executable": true, "reason": "Standard TON usage with proper contacts and coil"}},
-  {"type": "plc-code", "content": "PROGRAM Timer_Example\\nVAR\\n  StartButton: BOOL;\\n  StopButton: BOOL;\\n  Timer1: TON;\\n  Output: BOOL;\\nEND_VAR\\n\\nTimer1(IN:=StartButton AND NOT StopButton, PT:=T#5s);\\nOutput := Timer1.Q;\\nEND_PROGRAM", "validation": {"status": "valid", "executable": true, "reason": "Compiles on IEC ST with proper declarations"}}
-]
+    def _send_chat(
+        self,
+        profile: str,
+        history: List[Dict[str, Any]],
+        message_with_context: str,
+        accounting: tuple
+    ) -> str:
+        # Start chat session with Gemini
+        started_at = time.perf_counter()
+        chat = self.models[profile].start_chat(history=history)
+        response = chat.send_message(message_with_context)
+        truncated = _truncated(response)
+        self._record_profile(profile, started_at, truncated)
+        self._record_usage(accounting, profile, response, started_at)
+        if truncated and profile != "full":
+            # A cut-off reply is not valid JSON; ask again with the full token budget
+            return self._send_chat("full", history, message_with_context, accounting)
+        return response.text
 
-NON-PLC Questions (REJECT THESE):
-User: "What's the weather like?"
-Response: [{"type": "text", "content": "I'm sorry, but I can only answer questions related to PLCs, IEC 61131-3 programming, industrial automation, and control systems. Please ask me about ladder diagrams, PLC programming, SCADA systems, or other industrial automation topics."}]
+    def _record_usage(self, accounting: tuple, profile: str, response, started_at: float):
+        user_id, session_id, source, sections = accounting
+        try:
+            usage_tracker.record(
+                user_id, session_id, source, profile,
+                getattr(response, "usage_metadata", None), sections,
+                (time.perf_counter() - started_at) * 1000
+            )
+        except Exception as e:
+            print(f"Error recording token usage: {str(e)}")
 
-User: "How do I cook pasta?"
-Response: [{"type": "text", "content": "I'm sorry, but I can only answer questions related to PLCs, IEC 61131-3 programming, industrial automation, and control systems. Please ask me about ladder diagrams, PLC programming, SCADA systems, or other industrial automation topics."}]
+    def chat_stream(
+        self,
+        message: str,
+        conversation_history: List[Dict[str, str]] = None,
+        session_id: str = None,
+        user_id: str = None,
+        source: str = "ws"
+    ) -> Iterator[str]:
+        """Same as chat(), but yields the response text as Gemini produces it.
 
-User: "Tell me about history"
-Response: [{"type": "text", "content": "I'm sorry, but I can only answer questions related to PLCs, IEC 61131-3 programming, industrial automation, and control systems. Please ask me about ladder diagrams, PLC programming, SCADA systems, or other industrial automation topics."}]"""
+        Yields RESTART_STREAM before regenerating a reply that ran out of
+        tokens; the text streamed before it should be discarded.
+        """
+        if not self.is_available():
+            raise ValueError("Gemini API key not configured")
+
+        try:
+            mode = settings.SCOPE_GATE_MODE
+            off_topic = mode != "off" and self._is_off_topic(message, conversation_history)
+            if off_topic and mode == "enforce":
+                self._count_scope("blocked")
+                yield OFF_TOPIC_RESPONSE
+                return
+
+            history, message_with_context, sections = self._prepare_chat(message, conversation_history, session_id)
+            profile = classify_request(message, conversation_history)
 
-            # Prepare conversation history
-            history = [{"role": "user", "parts": [system_prompt]}]
-            history.append({"role": "model", "parts": ["Understood. I will respond only in valid JSON format with the specified types based on what you ask."]})
-
-            if conversation_history:
-                for msg in conversation_history[-8:]:
-                    if msg.get("role") == "user":
-                        history.append({"role": "user", "parts": [msg.get("content", "")]})
-                    elif msg.get("role") == "assistant":
-                        history.append({"role": "model", "parts": [msg.get("content", "")]})
-
-            # Start chat session with Gemini
-            chat = self.model.start_chat(history=history)
-            response = chat.send_message(message_with_context)
-            return response.text
+            while True:
+                started_at = time.perf_counter()
+                chat = self.models[profile].start_chat(history=history)
+                chunks = []
+                response = chat.send_message(message_with_context, stream=True)
+                for chunk in response:
+                    if chunk.text:
+                        chunks.append(chunk.text)
+                        yield chunk.text
+                # Finish reason and usage metadata are complete once the stream has been consumed
+                truncated = _truncated(response)
+                self._record_profile(profile, started_at, truncated)
+                self._record_usage((user_id, session_id, source, sections), profile, response, started_at)
+                if not truncated or profile == "full":
+                    break
+                # A cut-off reply is not valid JSON; stream it again with the full token budget
+                profile = "full"
+                yield RESTART_STREAM
+            if mode == "shadow":
+                self._record_shadow(off_topic, "".join(chunks))
 
         except Exception as e:
             raise ValueError(f"Failed to get response from Gemini: {str(e)}")
@@ -0,0 +1,185 @@
+import asyncio
+import hashlib
+import time
+from datetime import datetime, timedelta
+from typing import Awaitable, Callable, Dict, Optional, Tuple
+from google.api_core.exceptions import AlreadyExists, FailedPrecondition, NotFound
+from starlette.concurrency import run_in_threadpool
+from app.core.config import settings
+from app.services.cache import TTLCache
+from app.services.firestore_service import firestore_service
+from app.services.metrics import metrics
+
+
+class IdempotencyInProgress(Exception):
+    """Another worker is still handling a request with the same key"""
+
+
+class IdempotencyStore:
+    """Idempotency-Key handling for send-message.
+
+    The first request for a key claims it with a create-only document in
+    ``chat_sessions/{id}/idempotency`` and runs normally; its response is
+    stored on the claim. Retries arriving on the same worker while it runs
+    await the same future, retries on other workers poll the claim, and
+    retries after completion replay the stored response without touching
+    Gemini. The response is stored in the background after it has been
+    returned. Completed keys expire after IDEMPOTENCY_TTL (``expires_at`` can
+    back a Firestore TTL policy).
+    """
+    _instance = None
+    _initialized = False
+
+    def __new__(cls):
+        if cls._instance is None:
+            cls._instance = super().__new__(cls)
+        return cls._instance
+
+    def __init__(self):
+        if not self._initialized:
+            self._inflight: Dict[tuple, asyncio.Future] = {}
+            self._completed = TTLCache(maxsize=settings.IDEMPOTENCY_CACHE_SIZE, ttl=settings.IDEMPOTENCY_TTL)
+            self._storing = set()  # background writes of completed responses
+            self.executed = 0
+            self.attached = 0
+            self.replayed = 0
+            metrics.register("idempotency", self.stats)
+            self._initialized = True
+
+    def _ref(self, session_id: str, key: str):
+        doc_id = hashlib.sha256(key.encode("utf-8")).hexdigest()
+        return (
+            firestore_service.db.collection("chat_sessions").document(session_id)
+            .collection("idempotency").document(doc_id)
+        )
+
+    async def run(
+        self,
+        session_id: str,
+        user_id: str,
+        key: str,
+        fn: Callable[[], Awaitable[dict]]
+    ) -> Tuple[dict, bool]:
+        """Run fn once per (session, key); returns (response, replayed)"""
+        local_key = (session_id, key)
+        record = self._completed.get(local_key)
+        if record is not None:
+            return self._replay(record, user_id)
+
+        future = self._inflight.get(local_key)
+        if future is not None:
+            self.attached += 1
+            record = await asyncio.shield(future)
+            return self._replay(record, user_id)
+
+        future = asyncio.get_running_loop().create_future()
+        self._inflight[local_key] = future
+        ref = self._ref(session_id, key)
+        claimed = False
+        try:
+            record = await self._claim_or_wait(ref, user_id)
+            if record is not None:
+                self._completed.set(local_key, record)
+                future.set_result(record)
+                return self._replay(record, user_id)
+
+            claimed = True
+            self.executed += 1
+            response = await fn()
+            record = {"user_id": user_id, "response": response}
+            self._completed.set(local_key, record)
+            future.set_result(record)
+            # Written after responding; retries on this worker replay from _completed meanwhile,
+            # and other workers keep polling the claim until it lands
+            task = asyncio.create_task(run_in_threadpool(self._store, ref, record))
+            self._storing.add(task)
+            task.add_done_callback(self._storing.discard)
+            return response, False
+        except BaseException as e:
+            if not future.done():
+                # Retries attached to this call see the same error
+                future.set_exception(e)
+                future.exception()
+                if claimed:
+                    await run_in_threadpool(self._release, ref)
+            raise
+        finally:
+            self._inflight.pop(local_key, None)
+
+    def _replay(self, record: dict, user_id: str) -> Tuple[dict, bool]:
+        if record["user_id"] != user_id:
+            raise ValueError("Session not found or access denied")
+        self.replayed += 1
+        return record["response"], True
+
+    async def _claim_or_wait(self, ref, user_id: str) -> Optional[dict]:
+        """Claim the key (returns None) or wait for the stored response of the worker holding it"""
+        deadline = time.monotonic() + settings.IDEMPOTENCY_WAIT
+        while True:
+            now = datetime.utcnow()
+            try:
+                await run_in_threadpool(ref.create, {
+                    "user_id": user_id,
+                    "status": "in_flight",
+                    "created_at": now,
+                    "expires_at": now + timedelta(seconds=settings.IDEMPOTENCY_TTL)
+                })
+                return None
+            except AlreadyExists:
+                pass
+            except Exception as e:
+                # Without the shared claim, still run the request (retries dedupe on this worker only)
+                print(f"Error claiming idempotency key: {str(e)}")
+                return None
+
+            doc = await run_in_threadpool(ref.get)
+            if not doc.exists:
+                continue
+            data = doc.to_dict()
+            expires_at = data["expires_at"].replace(tzinfo=None)
+            abandoned = data["status"] == "in_flight" and \
+                data["created_at"].replace(tzinfo=None) + timedelta(seconds=settings.IDEMPOTENCY_WAIT) < now
+            if expires_at < now or abandoned:
+                # Expired key or a claim whose worker died: take it over unless someone else just did
+                try:
+                    await run_in_threadpool(
+                        ref.delete,
+                        option=firestore_service.db.write_option(last_update_time=doc.update_time)
+                    )
+                except (FailedPrecondition, NotFound):
+                    pass
+                continue
+            if data["status"] == "completed":
+                return {"user_id": data["user_id"], "response": data["response"]}
+            if time.monotonic() >= deadline:
+                raise IdempotencyInProgress("A request with this Idempotency-Key is still in progress")
+            await asyncio.sleep(settings.IDEMPOTENCY_POLL_INTERVAL)
+
+    @staticmethod
+    def _store(ref, record: dict):
+        try:
+            ref.update({"status": "completed", "response": record["response"]})
+        except Exception as e:
+            print(f"Error storing idempotent response: {str(e)}")
+
+    @staticmethod
+    def _release(ref):
+        """Drop the claim of a failed request so a retry can run it again"""
+        try:
+            ref.delete()
+        except Exception as e:
+            print(f"Error releasing idempotency key: {str(e)}")
+
+    def stats(self) -> dict:
+        return {
+            "in_flight": len(self._inflight),
+            "storing": len(self._storing),
+            "completed_cached": len(self._completed),
+            "executed": self.executed,
+            "attached": self.attached,
+            "replayed": self.replayed,
+        }
+
+
+# Create singleton instance
+idempotency_store = IdempotencyStore()
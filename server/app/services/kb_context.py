@@ -0,0 +1,132 @@
+import hashlib
+import re
+import threading
+from typing import Dict, List, Optional, Tuple
+from app.core.config import settings
+from app.services.cache import TTLCache
+
+_WORD_RE = re.compile(r"[a-z0-9_]+")
+
+# Openers of follow-ups that lean on the previous turn ("now add a reset", "what about TOF?")
+_FOLLOW_UP_RE = re.compile(
+    r"^\s*(now|also|then|and|but|so|add|make|change|modify|extend|update|include|remove|instead|"
+    r"what about|how about|same|it|that|this|those|these|can you|could you)\b"
+)
+_FUNCTION_WORDS = {
+    "a", "an", "and", "are", "as", "at", "be", "but", "by", "can", "could", "do", "does", "for", "how",
+    "i", "in", "is", "it", "me", "my", "now", "of", "on", "or", "please", "so", "that", "the", "then",
+    "this", "to", "too", "what", "with", "you", "also", "about", "add", "make", "same", "one",
+}
+
+
+def estimate_tokens(text: str) -> int:
+    """Rough Gemini token count (about four characters per token)"""
+    return (len(text) + 3) // 4
+
+
+def passage_id(passage: str) -> str:
+    return hashlib.sha1(passage.encode("utf-8")).hexdigest()
+
+
+def expand_query(message: str, conversation_history: Optional[List[Dict[str, str]]] = None) -> str:
+    """Retrieval query for a turn: short or referential follow-ups borrow the previous user turn"""
+    previous = [msg.get("content", "") for msg in (conversation_history or []) if msg.get("role") == "user"]
+    if not previous:
+        return message
+    content_words = [w for w in _WORD_RE.findall(message.lower()) if w not in _FUNCTION_WORDS]
+    if len(content_words) >= settings.KB_FOLLOW_UP_MAX_WORDS and not _FOLLOW_UP_RE.search(message.lower()):
+        return message
+    return f"{previous[-1]} {message}"
+
+
+class SessionContextLedger:
+    """KB passages placed in a session's prompt, turn by turn.
+
+    Each turn sends the passages retrieved for it, once each, as a
+    reference block ahead of the replayed history. A follow-up turn (one
+    that leans on the previous question, see expand_query) also keeps the
+    previous turn's passages that were not retrieved again, up to
+    KB_CONTEXT_MAX_PASSAGES, so the code it refers to stays in view; other
+    turns carry nothing over. Savings are measured against the prompt
+    without a ledger, which attached every retrieved passage to the turn,
+    so they turn negative when carried passages cost more than duplicates
+    save. The ledger lives in a per-worker TTL cache; a worker that has not
+    seen the session simply starts a new one.
+    """
+
+    def __init__(self):
+        self._sessions = TTLCache(maxsize=settings.KB_CONTEXT_MAX_SESSIONS, ttl=settings.KB_CONTEXT_TTL)
+        self._lock = threading.Lock()
+        self.turns = 0
+        self.passages_new = 0
+        self.passages_reused = 0
+        self.passages_carried = 0
+        self.tokens_baseline = 0
+        self.tokens_sent = 0
+
+    def update(self, session_id: str, passages: List[str], follow_up: bool = False) -> Tuple[List[str], dict]:
+        """Record this turn's passages; returns the passages to send and the turn stats"""
+        with self._lock:
+            entry = self._sessions.get(session_id) or {
+                "passages": [], "turns": 0, "tokens_baseline": 0, "tokens_sent": 0
+            }
+            previous = {passage_id(p): p for p in entry["passages"]}
+            current: Dict[str, str] = {}
+            for passage in passages:
+                current.setdefault(passage_id(passage), passage)
+            reused = sum(1 for pid in current if pid in previous)
+
+            carried = []
+            if follow_up:
+                room = max(settings.KB_CONTEXT_MAX_PASSAGES - len(current), 0)
+                carried = [p for pid, p in previous.items() if pid not in current][-room:] if room else []
+            block = carried + list(current.values())
+            baseline = sum(estimate_tokens(p) for p in passages)
+            sent = sum(estimate_tokens(p) for p in block)
+
+            self._sessions.set(session_id, {
+                "passages": block,
+                "turns": entry["turns"] + 1,
+                "tokens_baseline": entry["tokens_baseline"] + baseline,
+                "tokens_sent": entry["tokens_sent"] + sent,
+            })
+
+            self.turns += 1
+            self.passages_new += len(current) - reused
+            self.passages_reused += reused
+            self.passages_carried += len(carried)
+            self.tokens_baseline += baseline
+            self.tokens_sent += sent
+            return block, {
+                "new": len(current) - reused,
+                "reused": reused,
+                "carried": len(carried),
+                "tokens_saved": baseline - sent,
+            }
+
+    def session_stats(self, session_id: str) -> Optional[dict]:
+        entry = self._sessions.get(session_id)
+        if entry is None:
+            return None
+        return {
+            "passages": len(entry["passages"]),
+            "turns": entry["turns"],
+            "context_tokens_baseline": entry["tokens_baseline"],
+            "context_tokens_sent": entry["tokens_sent"],
+            "context_tokens_saved": entry["tokens_baseline"] - entry["tokens_sent"],
+        }
+
+    def forget(self, session_id: str):
+        self._sessions.pop(session_id)
+
+    def stats(self) -> dict:
+        return {
+            "sessions": len(self._sessions),
+            "turns": self.turns,
+            "passages_new": self.passages_new,
+            "passages_reused": self.passages_reused,
+            "passages_carried": self.passages_carried,
+            "context_tokens_baseline": self.tokens_baseline,
+            "context_tokens_sent": self.tokens_sent,
+            "context_tokens_saved": self.tokens_baseline - self.tokens_sent,
+        }
@@ -0,0 +1,290 @@
+"""
+Persisted KB index.
+
+The index is built offline from the ``kb/`` directory and written to a single
+binary file that every worker memory-maps read-only, so the KB text, vocabulary
+and postings live in one shared page-cache copy instead of per-process strings.
+
+Build it with:
+
+    python -m app.services.kb_index build [--kb-path PATH] [--output PATH]
+
+The header records a hash of the ``kb/`` files it was built from; an index
+that no longer matches them is rebuilt by preload() and ignored (with a
+warning) by open_index(), which then falls back to the raw files.
+
+File layout (little-endian):
+
+    header    MAGIC, version, n_docs, n_terms, section offsets, source hash
+    docs      n_docs  x (name_off u64, name_len u32, text_off u64, text_len u32)
+    terms     n_terms x (term_off u64, term_len u32, post_off u64, post_count u32)
+              sorted by term bytes so lookups can binary-search the mapping
+    postings  u32 doc ids
+    blob      utf-8 names, texts and terms
+"""
+import argparse
+import hashlib
+import mmap
+import os
+import struct
+from typing import Dict, Iterable, List, Optional, Tuple
+
+MAGIC = b"KBIX"
+VERSION = 2
+
+_HEADER = struct.Struct("<4sIIIQQQQ32s")
+_NO_SOURCE = bytes(32)
+_DOC = struct.Struct("<QIQI")
+_TERM = struct.Struct("<QIQI")
+_POSTING = struct.Struct("<I")
+
+DEFAULT_KB_PATH = os.path.join(os.path.dirname(__file__), "kb")
+DEFAULT_INDEX_PATH = os.path.join(os.path.dirname(__file__), "kb.idx")
+
+# Indexes mapped by preload() in a pre-fork server, inherited by every worker
+_preloaded: Dict[str, "MappedKBIndex"] = {}
+
+
+def tokenize(text: str) -> List[str]:
+    """Tokenizer shared by the index builder and the retrievers"""
+    return text.lower().split()
+
+
+def load_kb_documents(kb_path: str = DEFAULT_KB_PATH) -> List[Tuple[str, str]]:
+    """Read (name, text) pairs for every file in the KB directory"""
+    docs = []
+    for file in sorted(os.listdir(kb_path)):
+        full_path = os.path.join(kb_path, file)
+        if os.path.isfile(full_path):
+            with open(full_path, "r", encoding="utf-8") as f:
+                docs.append((file, f.read()))
+    return docs
+
+
+def source_hash(docs: Iterable[Tuple[str, str]]) -> bytes:
+    """SHA-256 over the names and texts of the KB documents an index is built from"""
+    digest = hashlib.sha256()
+    for name, text in docs:
+        for part in (name, text):
+            raw = part.encode("utf-8")
+            digest.update(struct.pack("<Q", len(raw)))
+            digest.update(raw)
+    return digest.digest()
+
+
+def kb_source_hash(kb_path: str) -> Optional[bytes]:
+    """source_hash of the KB directory, or None when it cannot be read"""
+    try:
+        return source_hash(load_kb_documents(kb_path))
+    except OSError:
+        return None
+
+
+def build_from_kb(kb_path: str, output_path: str) -> Dict[str, int]:
+    """Build the index of a KB directory, recording its source hash"""
+    docs = load_kb_documents(kb_path)
+    return build_index(docs, output_path, source_hash(docs))
+
+
+def build_index(docs: Iterable[Tuple[str, str]], output_path: str, source: bytes = _NO_SOURCE) -> Dict[str, int]:
+    """Tokenize the documents once and write the binary index to output_path"""
+    docs = list(docs)
+    postings: Dict[str, List[int]] = {}
+    for doc_id, (_, text) in enumerate(docs):
+        for term in set(tokenize(text)):
+            postings.setdefault(term, []).append(doc_id)
+
+    terms = sorted(postings, key=lambda t: t.encode("utf-8"))
+
+    blob = bytearray()
+
+    def add_blob(value: str) -> Tuple[int, int]:
+        raw = value.encode("utf-8")
+        offset = len(blob)
+        blob.extend(raw)
+        return offset, len(raw)
+
+    doc_entries = []
+    for name, text in docs:
+        name_off, name_len = add_blob(name)
+        text_off, text_len = add_blob(text)
+        doc_entries.append((name_off, name_len, text_off, text_len))
+
+    posting_data = bytearray()
+    term_entries = []
+    for term in terms:
+        term_off, term_len = add_blob(term)
+        doc_ids = postings[term]
+        term_entries.append((term_off, term_len, len(posting_data) // _POSTING.size, len(doc_ids)))
+        for doc_id in doc_ids:
+            posting_data.extend(_POSTING.pack(doc_id))
+
+    docs_off = _HEADER.size
+    terms_off = docs_off + _DOC.size * len(doc_entries)
+    postings_off = terms_off + _TERM.size * len(term_entries)
+    blob_off = postings_off + len(posting_data)
+
+    tmp_path = f"{output_path}.tmp"
+    with open(tmp_path, "wb") as f:
+        f.write(_HEADER.pack(
+            MAGIC, VERSION, len(doc_entries), len(term_entries),
+            docs_off, terms_off, postings_off, blob_off, source
+        ))
+        for entry in doc_entries:
+            f.write(_DOC.pack(*entry))
+        for entry in term_entries:
+            f.write(_TERM.pack(*entry))
+        f.write(posting_data)
+        f.write(blob)
+    # Atomic swap so running workers keep their old mapping intact
+    os.replace(tmp_path, output_path)
+
+    return {
+        "documents": len(doc_entries),
+        "terms": len(term_entries),
+        "bytes": blob_off + len(blob),
+    }
+
+
+class MappedKBIndex:
+    """Read-only view over a persisted KB index file"""
+
+    def __init__(self, index_path: str):
+        self.index_path = os.path.abspath(index_path)
+        with open(self.index_path, "rb") as f:
+            self._mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+        magic, version, n_docs, n_terms, docs_off, terms_off, postings_off, blob_off, source = (
+            _HEADER.unpack_from(self._mm, 0)
+        )
+        if magic != MAGIC or version != VERSION:
+            self._mm.close()
+            raise ValueError(f"Unsupported KB index file: {self.index_path}")
+
+        self.n_docs = n_docs
+        self.n_terms = n_terms
+        self.source = source
+        self._docs_off = docs_off
+        self._terms_off = terms_off
+        self._postings_off = postings_off
+        self._blob_off = blob_off
+
+    def __len__(self) -> int:
+        return self.n_docs
+
+    def matches(self, source: Optional[bytes]) -> bool:
+        """Whether the index was built from KB files with this source hash (unknown sources match)"""
+        return source is None or self.source == source
+
+    def close(self):
+        self._mm.close()
+
+    def warm(self) -> int:
+        """Read every page once so workers start on a hot page cache; returns bytes touched"""
+        size = len(self._mm)
+        for offset in range(0, size, mmap.PAGESIZE):
+            self._mm[offset]
+        return size
+
+    def _blob_bytes(self, offset: int, length: int) -> bytes:
+        start = self._blob_off + offset
+        return self._mm[start:start + length]
+
+    def _term_entry(self, index: int) -> Tuple[int, int, int, int]:
+        return _TERM.unpack_from(self._mm, self._terms_off + index * _TERM.size)
+
+    def document(self, doc_id: int) -> str:
+        _, _, text_off, text_len = _DOC.unpack_from(self._mm, self._docs_off + doc_id * _DOC.size)
+        return self._blob_bytes(text_off, text_len).decode("utf-8")
+
+    def document_name(self, doc_id: int) -> str:
+        name_off, name_len, _, _ = _DOC.unpack_from(self._mm, self._docs_off + doc_id * _DOC.size)
+        return self._blob_bytes(name_off, name_len).decode("utf-8")
+
+    def term(self, index: int) -> str:
+        term_off, term_len, _, _ = self._term_entry(index)
+        return self._blob_bytes(term_off, term_len).decode("utf-8")
+
+    def postings(self, term: str) -> List[int]:
+        """Doc ids containing term, found by binary search over the sorted term table"""
+        target = term.encode("utf-8")
+        lo, hi = 0, self.n_terms
+        while lo < hi:
+            mid = (lo + hi) // 2
+            term_off, term_len, post_off, post_count = self._term_entry(mid)
+            current = self._blob_bytes(term_off, term_len)
+            if current < target:
+                lo = mid + 1
+            elif current > target:
+                hi = mid
+            else:
+                start = self._postings_off + post_off * _POSTING.size
+                return list(struct.unpack_from(f"<{post_count}I", self._mm, start))
+        return []
+
+
+def open_index(index_path: str, kb_path: Optional[str] = None) -> Optional[MappedKBIndex]:
+    """Map the index if it exists and still matches kb_path; None tells callers to fall back to raw files"""
+    if not index_path:
+        return None
+    index = _preloaded.get(os.path.abspath(index_path))
+    if index is None:
+        if not os.path.exists(index_path):
+            return None
+        try:
+            index = MappedKBIndex(index_path)
+        except Exception as e:
+            print(f"Could not open KB index {index_path}: {e}")
+            return None
+    if kb_path is not None and not index.matches(kb_source_hash(kb_path)):
+        print(f"KB index {index_path} is stale (kb/ changed since it was built); "
+              f"reading kb/ files instead. Rebuild with `python -m app.services.kb_index build`.")
+        return None
+    return index
+
+
+def preload(index_path: str, kb_path: str = DEFAULT_KB_PATH) -> Optional[MappedKBIndex]:
+    """Map and warm the index before workers fork, (re)building it from kb/ if it is missing or stale.
+
+    Workers forked afterwards get the mapping from open_index() without
+    reopening the file, and all of them share one page-cache copy.
+    """
+    index_path = os.path.abspath(index_path)
+    if open_index(index_path, kb_path) is None:
+        _preloaded.pop(index_path, None)
+        try:
+            stats = build_from_kb(kb_path, index_path)
+            print(f"KB index built at {index_path}: {stats['documents']} documents")
+        except OSError as e:
+            print(f"Could not build KB index {index_path}, workers will read kb/ files: {e}")
+            return None
+    index = open_index(index_path, kb_path)
+    if index is not None:
+        index.warm()
+        _preloaded[index_path] = index
+    return index
+
+
+def main(argv: Optional[List[str]] = None):
+    parser = argparse.ArgumentParser(description="KB index tools")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    build = subparsers.add_parser("build", help="Build the memory-mapped KB index")
+    build.add_argument("--kb-path", default=DEFAULT_KB_PATH)
+    build.add_argument("--output", default=None)
+
+    args = parser.parse_args(argv)
+
+    if args.command == "build":
+        output = args.output
+        if output is None:
+            # Imported lazily so the builder works without a configured .env
+            from app.core.config import settings
+            output = settings.KB_INDEX_PATH
+        stats = build_from_kb(args.kb_path, output)
+        print(f"KB index written to {output}: {stats['documents']} documents, "
+              f"{stats['terms']} terms, {stats['bytes']} bytes")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,96 @@
+"""
+Duplicate detection for knowledge library entries.
+
+Exact duplicates share a content hash of the normalized question and
+answer, which is also the document id of new entries. Near-duplicates are
+found with MinHash signatures over word 3-gram shingles of question and
+answer, bucketed by LSH bands: each entry stores its band keys in
+``lsh_bands`` so candidates come back from one ``array_contains_any``
+query, and the signatures then estimate Jaccard similarity.
+
+Dedupe the existing collection with:
+
+    python -m app.services.library_dedup backfill [--dry-run]
+"""
+import argparse
+import hashlib
+import random
+import re
+from typing import List, Optional
+from app.core.config import settings
+from app.services.single_flight import normalize_text, request_key
+
+_WORD_RE = re.compile(r"[a-z0-9_]+")
+_PRIME = (1 << 61) - 1
+_MAX_HASH = (1 << 32) - 1
+
+
+def _permutations(count: int) -> List[tuple]:
+    # Fixed seed: signatures stored by one worker must match those computed by every other
+    rng = random.Random(61131)
+    return [(rng.randrange(1, _PRIME), rng.randrange(0, _PRIME)) for _ in range(count)]
+
+
+_PERMUTATIONS = _permutations(settings.LIBRARY_MINHASH_PERMUTATIONS)
+
+
+def content_hash(user_question: str, assistant_response: str) -> str:
+    """Exact-duplicate key, insensitive to case and whitespace"""
+    return request_key("library", normalize_text(user_question), normalize_text(assistant_response))
+
+
+def shingles(text: str) -> set:
+    words = _WORD_RE.findall(text.lower())
+    if len(words) < 3:
+        return set(words)
+    return {" ".join(words[i:i + 3]) for i in range(len(words) - 2)}
+
+
+def minhash(user_question: str, assistant_response: str) -> List[int]:
+    """MinHash signature of the question and answer text"""
+    hashes = [
+        int.from_bytes(hashlib.blake2b(shingle.encode("utf-8"), digest_size=4).digest(), "little")
+        for shingle in shingles(f"{user_question}\n{assistant_response}")
+    ]
+    if not hashes:
+        return [_MAX_HASH] * len(_PERMUTATIONS)
+    # Reduced to 32 bits so signatures stay small when stored
+    return [min((a * h + b) % _PRIME for h in hashes) & _MAX_HASH for a, b in _PERMUTATIONS]
+
+
+def lsh_bands(signature: List[int]) -> List[str]:
+    """Band keys: entries sharing any key are near-duplicate candidates"""
+    bands = settings.LIBRARY_LSH_BANDS
+    rows = len(signature) // bands
+    return [
+        f"{band}:" + hashlib.blake2b(
+            ",".join(str(value) for value in signature[band * rows:(band + 1) * rows]).encode("ascii"),
+            digest_size=8
+        ).hexdigest()
+        for band in range(bands)
+    ]
+
+
+def similarity(first: List[int], second: List[int]) -> float:
+    """Estimated Jaccard similarity of two signatures"""
+    if not first or len(first) != len(second):
+        return 0.0
+    return sum(1 for a, b in zip(first, second) if a == b) / len(first)
+
+
+def main(argv: Optional[List[str]] = None):
+    parser = argparse.ArgumentParser(description="Knowledge library deduplication")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    backfill = subparsers.add_parser("backfill", help="Merge duplicate entries of the existing library")
+    backfill.add_argument("--dry-run", action="store_true", help="report what would be merged without writing")
+    args = parser.parse_args(argv)
+
+    if args.command == "backfill":
+        # Imported lazily: the service initializes Firestore
+        from app.services.library_service import library_service
+        stats = library_service.dedupe_existing(dry_run=args.dry_run)
+        print(("Dry run: " if args.dry_run else "") + ", ".join(f"{key}={value}" for key, value in stats.items()))
+
+
+if __name__ == "__main__":
+    main()
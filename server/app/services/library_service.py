@@ -0,0 +1,452 @@
+import argparse
+from datetime import datetime
+from typing import List, Optional
+from firebase_admin import firestore
+from google.api_core.exceptions import AlreadyExists, NotFound
+from google.cloud.firestore import FieldFilter
+from app.core.config import settings
+from app.models.library import LibraryEntryResponse, LibraryEntrySummary
+from app.services.cache import StaleWhileRevalidateCache
+from app.services.firestore_service import firestore_service
+from app.services.library_dedup import content_hash, lsh_bands, minhash, similarity
+from app.services.message_format import message_preview, parse_legacy_content
+from app.services.metrics import metrics
+
+# Fields fetched for list views; assistant_response is deliberately left out
+SUMMARY_FIELDS = [
+    "entry_id", "user_name", "user_question", "response_preview",
+    "session_id", "created_at", "tags", "category", "save_count", "contributors"
+]
+# Fields of an entry in the full list and search views (skips the dedup signature and band keys)
+ENTRY_FIELDS = [
+    "entry_id", "user_name", "user_question", "assistant_response",
+    "session_id", "created_at", "tags", "category", "save_count", "contributors"
+]
+# A single entry also carries its near-duplicate variants
+DETAIL_FIELDS = ENTRY_FIELDS + ["variants"]
+# Fields the dedup backfill reads and merges
+DEDUP_FIELDS = [
+    "entry_id", "user_id", "user_name", "user_question", "assistant_response", "created_at",
+    "save_count", "contributor_ids", "contributors", "inaccurate_count", "content_hash", "minhash",
+    "variants", "variant_hashes"
+]
+# Fields a save reads to decide how it merges
+MERGE_FIELDS = ["content_hash", "variant_hashes", "contributor_ids"]
+
+
+def make_preview(assistant_response: str) -> str:
+    """Truncated answer text stored alongside each entry for list views (item arrays are unwrapped)"""
+    items = parse_legacy_content(assistant_response.strip())
+    return message_preview(items if items is not None else assistant_response, settings.LIBRARY_PREVIEW_CHARS)
+
+
+class LibraryService:
+    """Shared helpers for the global knowledge library.
+
+    Keeps a version counter for the library in ``library_meta/version`` that
+    is bumped on every write, so readers can tell whether anything changed
+    without scanning ``knowledge_library``. Reads go through
+    stale-while-revalidate caches: each cached result remembers the version
+    it was read at and is only reused while that is still the current
+    version, and when Firestore is slow or failing the last result is served
+    (marked stale) instead of an error.
+    """
+    _instance = None
+    _initialized = False
+
+    def __new__(cls):
+        if cls._instance is None:
+            cls._instance = super().__new__(cls)
+        return cls._instance
+
+    def __init__(self):
+        if not self._initialized:
+            self._version_cache = StaleWhileRevalidateCache(
+                "library_version", maxsize=1,
+                soft_ttl=settings.LIBRARY_VERSION_TTL,
+                hard_ttl=settings.LIBRARY_CACHE_HARD_TTL,
+                deadline=settings.FIRESTORE_READ_DEADLINE
+            )
+            self._reads = StaleWhileRevalidateCache(
+                "library", maxsize=256,
+                soft_ttl=settings.LIBRARY_CACHE_TTL,
+                hard_ttl=settings.LIBRARY_CACHE_HARD_TTL,
+                deadline=settings.LIBRARY_READ_DEADLINE
+            )
+            metrics.register("library_cache", lambda: {
+                "version": self._version_cache.stats(),
+                "reads": self._reads.stats(),
+            })
+            self._initialized = True
+
+    def _version_ref(self):
+        return firestore_service.db.collection("library_meta").document("version")
+
+    def get_version(self) -> int:
+        """Current library version, refreshed in the background every LIBRARY_VERSION_TTL seconds"""
+        return self._version_cache.read("version", self._read_version)
+
+    def _read_version(self) -> int:
+        doc = self._version_ref().get()
+        return (doc.to_dict() or {}).get("version", 0) if doc.exists else 0
+
+    def _cached(self, key: tuple, loader, *args):
+        """Result of loader(*args) for the current library version"""
+        version = self.get_version()
+        entry = self._reads.read(
+            key, lambda: {"version": version, "value": loader(*args)},
+            usable=lambda cached: cached["version"] == version,
+            flight=version
+        )
+        return entry["value"]
+
+    @property
+    def collection(self):
+        return firestore_service.db.collection("knowledge_library")
+
+    def list_entries(self, limit: int = 50, summary: bool = False) -> list:
+        """Newest entries first; summary mode projects away the full answer"""
+        return self._cached(("entries", limit, summary), self._query_entries, limit, summary)
+
+    def _query_entries(self, limit: int, summary: bool) -> list:
+        query = self.collection.order_by("created_at", direction=firestore.Query.DESCENDING).limit(limit)
+        if summary:
+            return self._summaries(query.select(SUMMARY_FIELDS).stream())
+        return [self._entry_response(doc.to_dict()) for doc in query.select(ENTRY_FIELDS).stream()]
+
+    def all_entries(self, summary: bool = False) -> list:
+        """Every entry (search is filtered client-side)"""
+        return self._cached(("all", summary), self._query_all_entries, summary)
+
+    def _query_all_entries(self, summary: bool) -> list:
+        if summary:
+            return self._summaries(self.collection.select(SUMMARY_FIELDS).stream())
+        return [self._entry_response(doc.to_dict()) for doc in self.collection.select(ENTRY_FIELDS).stream()]
+
+    def get_entry(self, entry_id: str) -> Optional[LibraryEntryResponse]:
+        return self._cached(("entry", entry_id), self._read_entry, entry_id)
+
+    def _read_entry(self, entry_id: str) -> Optional[LibraryEntryResponse]:
+        doc = self.collection.document(entry_id).get(field_paths=DETAIL_FIELDS)
+        if not doc.exists:
+            return None
+        return self._entry_response(doc.to_dict())
+
+    def category_counts(self) -> dict:
+        """Entry count per category, reading only the category field"""
+        return dict(self._cached(("categories",), self._count_categories))
+
+    def _count_categories(self) -> dict:
+        counts = {}
+        for doc in self.collection.select(["category"]).stream():
+            category = (doc.to_dict() or {}).get("category") or "General"
+            counts[category] = counts.get(category, 0) + 1
+        return counts
+
+    @staticmethod
+    def _summaries(docs) -> List[LibraryEntrySummary]:
+        # Entries saved before previews were stored have none until `backfill-previews` runs
+        rows = [doc.to_dict() for doc in docs]
+        return [
+            LibraryEntrySummary(
+                entry_id=data["entry_id"],
+                user_name=data.get("user_name", "Anonymous User"),
+                user_question=data["user_question"],
+                response_preview=data.get("response_preview") or "",
+                session_id=data["session_id"],
+                created_at=data["created_at"],
+                tags=data.get("tags", []),
+                category=data.get("category"),
+                save_count=data.get("save_count", 1),
+                contributors=data.get("contributors") or [data.get("user_name", "Anonymous User")]
+            )
+            for data in rows
+        ]
+
+    @staticmethod
+    def _entry_response(data: dict) -> LibraryEntryResponse:
+        return LibraryEntryResponse(
+            entry_id=data["entry_id"],
+            user_name=data.get("user_name", "Anonymous User"),
+            user_question=data["user_question"],
+            assistant_response=data["assistant_response"],
+            session_id=data["session_id"],
+            created_at=data["created_at"],
+            tags=data.get("tags", []),
+            category=data.get("category"),
+            save_count=data.get("save_count", 1),
+            contributors=data.get("contributors") or [data.get("user_name", "Anonymous User")],
+            variants=data.get("variants", [])
+        )
+
+    def save_entry(self, entry_data: dict) -> dict:
+        """Store a new entry, or merge it into an existing exact or near-duplicate one.
+
+        New entries use their content hash as document id, so repeated saves
+        of the same answer land on the same document. A near-duplicate with
+        different wording is kept as a variant of the entry it matched (up to
+        LIBRARY_MAX_VARIANTS). Returns the entry id and how the save was
+        resolved ("exact", "near" or None for a new entry).
+        """
+        question = entry_data["user_question"]
+        answer = entry_data["assistant_response"]
+        digest = content_hash(question, answer)
+        ref = self.collection.document(digest)
+        if self._merge_save(ref, entry_data, digest):
+            return {"entry_id": digest, "duplicate": "exact"}
+
+        signature = minhash(question, answer)
+        bands = lsh_bands(signature)
+        match = self._find_near_duplicate(signature, bands)
+        if match is not None:
+            # Entries from before deduplication keep their old ids but carry the hash after the backfill
+            resolution = self._merge_save(match.reference, entry_data, digest)
+            if resolution:
+                return {"entry_id": match.id, "duplicate": resolution}
+
+        try:
+            ref.create({
+                **entry_data,
+                "entry_id": digest,
+                "content_hash": digest,
+                "minhash": signature,
+                "lsh_bands": bands,
+                "save_count": 1,
+                "contributor_ids": [entry_data["user_id"]],
+                "contributors": [entry_data.get("user_name") or "Anonymous User"],
+            })
+        except AlreadyExists:
+            # Saved concurrently by someone else
+            if self._merge_save(ref, entry_data, digest):
+                return {"entry_id": digest, "duplicate": "exact"}
+            raise
+        self.bump_version()
+        return {"entry_id": digest, "duplicate": None}
+
+    def _merge_save(self, ref, entry_data: dict, digest: str) -> Optional[str]:
+        """Merge a save into an existing entry.
+
+        Returns "exact" when the entry (or one of its variants) has the same
+        content hash, "near" when the save was recorded as a new variant, and
+        None when the entry does not exist or has no room for another variant.
+        save_count counts each contributor once, however often they save.
+        """
+        user_id = entry_data["user_id"]
+        user_name = entry_data.get("user_name") or "Anonymous User"
+
+        @firestore.transactional
+        def merge(transaction):
+            snapshot = ref.get(field_paths=MERGE_FIELDS, transaction=transaction)
+            if not snapshot.exists:
+                return None, False
+            data = snapshot.to_dict() or {}
+            variant_hashes = data.get("variant_hashes") or []
+            update = {"last_saved_at": datetime.utcnow()}
+            resolution = "exact"
+            if data.get("content_hash") != digest and digest not in variant_hashes:
+                if len(variant_hashes) >= settings.LIBRARY_MAX_VARIANTS:
+                    return None, False
+                resolution = "near"
+                update["variants"] = firestore.ArrayUnion([{
+                    "user_id": user_id,
+                    "user_name": user_name,
+                    "user_question": entry_data["user_question"],
+                    "assistant_response": entry_data["assistant_response"],
+                    "content_hash": digest,
+                    "saved_at": update["last_saved_at"],
+                }])
+                update["variant_hashes"] = firestore.ArrayUnion([digest])
+            if user_id not in (data.get("contributor_ids") or []):
+                update.update({
+                    "save_count": firestore.Increment(1),
+                    "contributor_ids": firestore.ArrayUnion([user_id]),
+                    "contributors": firestore.ArrayUnion([user_name]),
+                })
+            transaction.update(ref, update)
+            return resolution, len(update) > 1
+
+        try:
+            resolution, changed = merge(firestore_service.db.transaction())
+        except NotFound:
+            return None
+        if changed:
+            self.bump_version()
+        return resolution
+
+    def _find_near_duplicate(self, signature: List[int], bands: List[str]):
+        """Most similar entry sharing an LSH band, if it passes LIBRARY_DEDUP_THRESHOLD"""
+        query = self.collection.where(
+            filter=FieldFilter("lsh_bands", "array_contains_any", bands)
+        ).select(["minhash", "content_hash"]).limit(settings.LIBRARY_DEDUP_CANDIDATES)
+        best, best_score = None, settings.LIBRARY_DEDUP_THRESHOLD
+        for doc in query.stream():
+            score = similarity(signature, (doc.to_dict() or {}).get("minhash") or [])
+            if score >= best_score:
+                best, best_score = doc, score
+        return best
+
+    def dedupe_existing(self, dry_run: bool = False) -> dict:
+        """Merge duplicates already in the collection into their oldest entry.
+
+        Every kept entry also gets its content hash, signature and band keys,
+        so later saves find it. Duplicates add their contributors and
+        inaccurate ratings to the kept entry and are deleted; differently
+        worded near-duplicates are kept on it as variants, and once it holds
+        LIBRARY_MAX_VARIANTS further ones stay entries of their own.
+        """
+        rows = [(doc.reference, doc.to_dict()) for doc in self.collection.select(DEDUP_FIELDS).stream()]
+        rows.sort(key=lambda row: row[1].get("created_at") or datetime.min)
+
+        kept: List[dict] = []
+        by_hash = {}
+        buckets = {}
+        stats = {"scanned": len(rows), "kept": 0, "exact_duplicates": 0, "near_duplicates": 0, "updated": 0}
+        for ref, data in rows:
+            question = data.get("user_question", "")
+            answer = data.get("assistant_response", "")
+            digest = content_hash(question, answer)
+            signature = data.get("minhash")
+            if not signature or len(signature) != settings.LIBRARY_MINHASH_PERMUTATIONS:
+                signature = minhash(question, answer)
+            bands = lsh_bands(signature)
+
+            target = by_hash.get(digest)
+            if target is not None:
+                stats["exact_duplicates"] += 1
+                target["duplicates"].append((ref, data))
+                continue
+            candidates = {id(entry): entry for band in bands for entry in buckets.get(band, [])}
+            best_score = settings.LIBRARY_DEDUP_THRESHOLD
+            for entry in candidates.values():
+                score = similarity(signature, entry["signature"])
+                if score >= best_score:
+                    target, best_score = entry, score
+            variant_hashes = [digest] + [h for h in data.get("variant_hashes") or [] if h != digest]
+            if target is not None and len(target["variant_hashes"]) + len(variant_hashes) <= settings.LIBRARY_MAX_VARIANTS:
+                stats["near_duplicates"] += 1
+                target["duplicates"].append((ref, data))
+                target["variant_hashes"].extend(variant_hashes)
+                for variant_hash in variant_hashes:
+                    by_hash[variant_hash] = target
+                continue
+
+            entry = {"ref": ref, "data": data, "digest": digest, "signature": signature,
+                     "bands": bands, "duplicates": [], "variant_hashes": list(data.get("variant_hashes") or [])}
+            kept.append(entry)
+            for entry_hash in [digest] + entry["variant_hashes"]:
+                by_hash[entry_hash] = entry
+            for band in bands:
+                buckets.setdefault(band, []).append(entry)
+        stats["kept"] = len(kept)
+
+        if dry_run:
+            return stats
+
+        operations = []
+        for entry in kept:
+            data = entry["data"]
+            update = {}
+            if data.get("content_hash") != entry["digest"] or data.get("minhash") != entry["signature"]:
+                update.update({"content_hash": entry["digest"], "minhash": entry["signature"], "lsh_bands": entry["bands"]})
+            if entry["duplicates"]:
+                group = [data] + [duplicate for _, duplicate in entry["duplicates"]]
+                contributor_ids, contributors = [], []
+                for member in group:
+                    for uid in member.get("contributor_ids") or [member.get("user_id")]:
+                        if uid and uid not in contributor_ids:
+                            contributor_ids.append(uid)
+                    for name in member.get("contributors") or [member.get("user_name") or "Anonymous User"]:
+                        if name not in contributors:
+                            contributors.append(name)
+                variants = list(data.get("variants") or [])
+                known = {entry["digest"]} | {variant.get("content_hash") for variant in variants}
+                for _, member in entry["duplicates"]:
+                    member_hash = content_hash(member.get("user_question", ""), member.get("assistant_response", ""))
+                    if member_hash not in known:
+                        known.add(member_hash)
+                        variants.append({
+                            "user_id": member.get("user_id"),
+                            "user_name": member.get("user_name") or "Anonymous User",
+                            "user_question": member.get("user_question", ""),
+                            "assistant_response": member.get("assistant_response", ""),
+                            "content_hash": member_hash,
+                            "saved_at": member.get("created_at"),
+                        })
+                    for variant in member.get("variants") or []:
+                        if variant.get("content_hash") not in known:
+                            known.add(variant.get("content_hash"))
+                            variants.append(variant)
+                update.update({
+                    "save_count": len(contributor_ids) or 1,
+                    "contributor_ids": contributor_ids,
+                    "contributors": contributors,
+                    "inaccurate_count": sum(member.get("inaccurate_count", 0) for member in group),
+                    "variants": variants,
+                    "variant_hashes": [variant["content_hash"] for variant in variants],
+                })
+            if update:
+                # The kept entry is updated before (or in the same batch as) its duplicates are deleted
+                operations.append(("update", entry["ref"], update))
+                stats["updated"] += 1
+            operations.extend(("delete", ref, None) for ref, _ in entry["duplicates"])
+
+        for start in range(0, len(operations), 400):
+            batch = firestore_service.db.batch()
+            for action, ref, update in operations[start:start + 400]:
+                if action == "update":
+                    batch.update(ref, update)
+                else:
+                    batch.delete(ref)
+            batch.commit()
+        if stats["exact_duplicates"] or stats["near_duplicates"]:
+            self.bump_version()
+        return stats
+
+    def backfill_previews(self, dry_run: bool = False) -> dict:
+        """Store (or rebuild) the list-view preview of every entry whose stored one is missing or stale"""
+        stats = {"scanned": 0, "updated": 0}
+        updates = []
+        for doc in self.collection.select(["assistant_response", "response_preview"]).stream():
+            data = doc.to_dict() or {}
+            stats["scanned"] += 1
+            preview = make_preview(data.get("assistant_response", ""))
+            if data.get("response_preview") != preview:
+                updates.append((doc.reference, preview))
+        stats["updated"] = len(updates)
+
+        if dry_run:
+            return stats
+        for start in range(0, len(updates), 400):
+            batch = firestore_service.db.batch()
+            for ref, preview in updates[start:start + 400]:
+                batch.update(ref, {"response_preview": preview})
+            batch.commit()
+        if updates:
+            self.bump_version()
+        return stats
+
+    def bump_version(self):
+        """Record a library write so cached versions and ETags change"""
+        self._version_ref().set({"version": firestore.Increment(1)}, merge=True)
+        # Force the next reader to pick up the committed counter
+        self._version_cache.expire("version")
+
+
+# Create singleton instance
+library_service = LibraryService()
+
+
+def main(argv: Optional[List[str]] = None):
+    parser = argparse.ArgumentParser(description="Knowledge library maintenance")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    previews = subparsers.add_parser("backfill-previews", help="Store or rebuild the list-view preview of every entry")
+    previews.add_argument("--dry-run", action="store_true", help="count what would be written")
+    args = parser.parse_args(argv)
+
+    if args.command == "backfill-previews":
+        stats = library_service.backfill_previews(dry_run=args.dry_run)
+        print(("Dry run: " if args.dry_run else "") + ", ".join(f"{key}={value}" for key, value in stats.items()))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,188 @@
+import json
+import threading
+import time
+import zlib
+from datetime import datetime
+from typing import Dict, List, Optional
+from firebase_admin import firestore
+from app.core.config import settings
+
+# Firestore rejects documents over 1 MiB; leave room for the other bucket fields
+MAX_BUCKET_DATA_BYTES = 900_000
+
+
+def pack_messages(messages: List[dict]) -> bytes:
+    """Compress stored message documents (either schema, see message_format) for a bucket document"""
+    rows = [{**m, "timestamp": m["timestamp"].isoformat()} for m in messages]
+    return zlib.compress(json.dumps(rows, separators=(",", ":")).encode("utf-8"), 6)
+
+
+def unpack_messages(data: bytes) -> List[dict]:
+    rows = json.loads(zlib.decompress(data).decode("utf-8"))
+    for row in rows:
+        row["timestamp"] = datetime.fromisoformat(row["timestamp"])
+    return rows
+
+
+class MessageArchive:
+    """Packs old chat messages into compressed bucket documents.
+
+    A session keeps its newest ARCHIVE_HOT_MESSAGES messages as one document
+    per turn under ``messages``; older ones are moved, ARCHIVE_BUCKET_MESSAGES
+    at a time, into zlib-compressed JSON buckets under
+    ``chat_sessions/{id}/archive/{seq:06d}``. The session document tracks
+    ``archive_buckets`` and ``archived_count``. Compaction runs on a
+    background thread for sessions handed to schedule().
+    """
+
+    def __init__(self, db):
+        self.db = db
+        self._cond = threading.Condition()
+        self._scheduled: Dict[str, float] = {}
+        self._thread: Optional[threading.Thread] = None
+        self._stopping = False
+        self.buckets_written = 0
+        self.messages_archived = 0
+        self.failures = 0
+
+    def _session_ref(self, session_id: str):
+        return self.db.collection("chat_sessions").document(session_id)
+
+    def read_buckets(self, session_id: str, newest_first: bool = False, limit: Optional[int] = None) -> List[dict]:
+        """Archived messages of a session in bucket order (oldest first unless newest_first)"""
+        query = self._session_ref(session_id).collection("archive").order_by(
+            "seq", direction=firestore.Query.DESCENDING if newest_first else firestore.Query.ASCENDING
+        )
+        messages = []
+        for doc in query.stream():
+            rows = unpack_messages(doc.to_dict()["data"])
+            if newest_first:
+                messages[:0] = rows
+            else:
+                messages.extend(rows)
+            if limit is not None and len(messages) >= limit:
+                break
+        return messages
+
+    def delete_buckets(self, session_id: str):
+        for doc in self._session_ref(session_id).collection("archive").stream():
+            doc.reference.delete()
+
+    def schedule(self, session_id: str):
+        """Queue a session for compaction on the background thread"""
+        with self._cond:
+            if self._stopping:
+                return
+            self._scheduled.setdefault(session_id, time.monotonic())
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._run, name="message-archive", daemon=True)
+                self._thread.start()
+            self._cond.notify_all()
+
+    def discard(self, session_id: str):
+        with self._cond:
+            self._scheduled.pop(session_id, None)
+
+    def pending(self) -> int:
+        with self._cond:
+            return len(self._scheduled)
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while not self._scheduled and not self._stopping:
+                    self._cond.wait()
+                if self._stopping:
+                    return
+                session_id = next(iter(self._scheduled))
+                del self._scheduled[session_id]
+            try:
+                self.compact_session(session_id)
+            except Exception as e:
+                self.failures += 1
+                print(f"Error compacting session {session_id}: {str(e)}")
+            # Compaction is housekeeping; don't compete with request traffic
+            time.sleep(settings.ARCHIVE_COMPACTION_PAUSE)
+
+    def compact_session(self, session_id: str) -> int:
+        """Archive everything but the hot tail in full buckets; returns messages archived"""
+        session_ref = self._session_ref(session_id)
+        session_doc = session_ref.get()
+        if not session_doc.exists:
+            return 0
+
+        bucket_size = settings.ARCHIVE_BUCKET_MESSAGES
+        hot = [
+            {**doc.to_dict(), "message_id": doc.id}
+            for doc in session_ref.collection("messages").order_by("timestamp").stream()
+        ]
+        archivable = len(hot) - settings.ARCHIVE_HOT_MESSAGES
+        if archivable < bucket_size:
+            return 0
+
+        seq = (session_doc.to_dict() or {}).get("archive_buckets", 0)
+        archived = 0
+        for start in range(0, archivable - archivable % bucket_size, bucket_size):
+            for chunk in self._split(hot[start:start + bucket_size]):
+                if not self._commit_bucket(session_ref, seq, chunk):
+                    # Another worker compacted this session concurrently
+                    return archived
+                seq += 1
+                archived += len(chunk)
+        return archived
+
+    @staticmethod
+    def _split(messages: List[dict]) -> List[List[dict]]:
+        """Halve a chunk until each compressed bucket fits in a Firestore document"""
+        if len(messages) <= 1 or len(pack_messages(messages)) <= MAX_BUCKET_DATA_BYTES:
+            return [messages]
+        middle = len(messages) // 2
+        return MessageArchive._split(messages[:middle]) + MessageArchive._split(messages[middle:])
+
+    def _commit_bucket(self, session_ref, seq: int, messages: List[dict]) -> bool:
+        """Write one bucket and delete its hot documents atomically"""
+        transaction = self.db.transaction()
+
+        @firestore.transactional
+        def commit(transaction) -> bool:
+            snapshot = session_ref.get(transaction=transaction)
+            if not snapshot.exists or (snapshot.to_dict() or {}).get("archive_buckets", 0) != seq:
+                return False
+            transaction.set(session_ref.collection("archive").document(f"{seq:06d}"), {
+                "seq": seq,
+                "count": len(messages),
+                "first_timestamp": messages[0]["timestamp"],
+                "last_timestamp": messages[-1]["timestamp"],
+                "codec": "zlib+json",
+                "data": pack_messages(messages),
+            })
+            for message in messages:
+                transaction.delete(session_ref.collection("messages").document(message["message_id"]))
+            transaction.update(session_ref, {
+                "archive_buckets": seq + 1,
+                "archived_count": firestore.Increment(len(messages)),
+            })
+            return True
+
+        if not commit(transaction):
+            return False
+        self.buckets_written += 1
+        self.messages_archived += len(messages)
+        return True
+
+    def stats(self) -> dict:
+        return {
+            "scheduled": self.pending(),
+            "buckets_written": self.buckets_written,
+            "messages_archived": self.messages_archived,
+            "failures": self.failures,
+        }
+
+    def stop(self, timeout: float = 5.0):
+        """Stop the compaction thread; scheduled sessions are picked up again on later reads"""
+        with self._cond:
+            self._stopping = True
+            self._cond.notify_all()
+            thread = self._thread
+        if thread is not None:
+            thread.join(timeout)
@@ -0,0 +1,304 @@
+"""
+Storage format of chat messages.
+
+Schema 1 (legacy) stores every message as ``content`` text; structured
+assistant replies are the json.dumps string of their item array.
+Schema 2 stores a structured reply natively as ``items`` (type, content and
+validation for each), so reads need no second JSON parse. Ladder and code
+contents of MESSAGE_BLOB_MIN_CHARS or more are moved into the shared
+``message_blobs/{sha256}`` collection and replaced by ``content_ref``, so a
+block repeated across turns and sessions is stored once. User messages and
+plain-text replies keep ``content``.
+
+In memory and in the API, ``content`` is either text or the full item
+array. Legacy documents are decoded to the same shape when they are read,
+and can be rewritten in place with:
+
+    python -m app.services.message_format migrate [--dry-run]
+
+Blobs are shared, so deleting a session leaves its blobs in place; the ones
+no stored message references any more are deleted with:
+
+    python -m app.services.message_format sweep [--dry-run]
+"""
+import argparse
+import hashlib
+import json
+from datetime import datetime, timedelta, timezone
+from typing import Dict, Iterable, List, Optional, Tuple, Union
+from firebase_admin import firestore
+from google.api_core.exceptions import FailedPrecondition, NotFound
+from app.core.config import settings
+from app.services.cache import TTLCache
+from app.services.response_parser import is_valid_item
+
+SCHEMA_VERSION = 2
+BLOB_COLLECTION = "message_blobs"
+# Item types whose content is large enough to be worth sharing
+BLOB_TYPES = ("ladder", "plc-code")
+
+Content = Union[str, List[dict]]
+
+
+def message_text(content: Content) -> str:
+    """Content as prompt text: items are sent in the compact form the model itself answers with"""
+    if isinstance(content, str):
+        return content
+    return json.dumps(content, ensure_ascii=False, separators=(",", ":"))
+
+
+def message_preview(content: Content, length: int = 100) -> str:
+    """Sidebar preview (last_message) of a message"""
+    text = content if isinstance(content, str) else "\n".join(item.get("content", "") for item in content)
+    return text[:length] + "..." if len(text) > length else text
+
+
+def _blob_key(text: str) -> str:
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+
+def _is_blob(item: dict) -> bool:
+    text = item.get("content")
+    return item.get("type") in BLOB_TYPES and isinstance(text, str) and len(text) >= settings.MESSAGE_BLOB_MIN_CHARS
+
+
+def blob_count(message: dict) -> int:
+    """Blob documents written along with a message (for sizing Firestore batches)"""
+    content = message.get("content")
+    return 0 if isinstance(content, str) else sum(1 for item in content or [] if _is_blob(item))
+
+
+def encode_message(message: dict) -> Tuple[dict, Dict[str, str]]:
+    """(Firestore document, blobs by key) for a message in memory form (schema 2 documents pass through)"""
+    if message.get("schema") == SCHEMA_VERSION:
+        return dict(message), {}
+    content = message["content"]
+    if isinstance(content, str):
+        return dict(message), {}
+    items, blobs = [], {}
+    for item in content:
+        if _is_blob(item):
+            key = _blob_key(item["content"])
+            blobs[key] = item["content"]
+            item = {**{name: value for name, value in item.items() if name != "content"}, "content_ref": key}
+        items.append(item)
+    document = {name: value for name, value in message.items() if name != "content"}
+    document.update({"schema": SCHEMA_VERSION, "items": items})
+    return document, blobs
+
+
+def parse_legacy_content(text: str) -> Optional[List[dict]]:
+    """Item array of a schema 1 structured reply, or None for plain text"""
+    if not text.startswith("["):
+        return None
+    try:
+        items = json.loads(text)
+    except json.JSONDecodeError:
+        return None
+    if isinstance(items, list) and items and all(is_valid_item(item) for item in items):
+        return items
+    return None
+
+
+def blob_refs(documents: Iterable[dict]) -> set:
+    return {
+        item["content_ref"]
+        for document in documents if document.get("schema") == SCHEMA_VERSION
+        for item in document["items"] if "content_ref" in item
+    }
+
+
+def decode_message(document: dict, blobs: Dict[str, str]) -> dict:
+    """Memory form of a stored message of any schema (messages already in memory form pass through)"""
+    if document.get("schema") == SCHEMA_VERSION:
+        items = []
+        for item in document["items"]:
+            if "content_ref" in item:
+                ref = item["content_ref"]
+                item = {name: value for name, value in item.items() if name != "content_ref"}
+                item["content"] = blobs.get(ref, "")
+            items.append(item)
+        message = {name: value for name, value in document.items() if name not in ("schema", "items")}
+        message["content"] = items
+        return message
+    content = document.get("content", "")
+    if isinstance(content, str) and document.get("role") == "assistant":
+        items = parse_legacy_content(content)
+        if items is not None:
+            return {**document, "content": items}
+    return document
+
+
+class MessageBlobStore:
+    """Shared code blocks of schema 2 messages, cached in memory (blobs never change)"""
+
+    def __init__(self, db):
+        self.db = db
+        self._cache = TTLCache(maxsize=settings.MESSAGE_BLOB_CACHE_SIZE, ttl=settings.MESSAGE_BLOB_CACHE_TTL)
+        self.fetched = 0
+        self.missing = 0
+
+    def _ref(self, key: str):
+        return self.db.collection(BLOB_COLLECTION).document(key)
+
+    def fetch(self, keys: Iterable[str]) -> Dict[str, str]:
+        """Contents by key, reading the uncached ones in one round trip"""
+        found, missing = {}, []
+        for key in keys:
+            cached = self._cache.get(key)
+            if cached is not None:
+                found[key] = cached
+            else:
+                missing.append(key)
+        if missing:
+            for doc in self.db.get_all([self._ref(key) for key in missing]):
+                if doc.exists:
+                    content = doc.to_dict()["content"]
+                    self._cache.set(doc.id, content)
+                    found[doc.id] = content
+                else:
+                    self.missing += 1
+            self.fetched += len(missing)
+        return found
+
+    def decode(self, documents: List[dict]) -> List[dict]:
+        """Memory form of stored messages, resolving their blob references"""
+        refs = blob_refs(documents)
+        blobs = self.fetch(refs) if refs else {}
+        return [decode_message(document, blobs) for document in documents]
+
+    def write(self, batch, message: dict) -> dict:
+        """Add a message's blobs to a batch and return the document to store for it"""
+        document, blobs = encode_message(message)
+        for key, content in blobs.items():
+            # Content-addressed, so rewriting an existing blob is harmless; written_at
+            # tells sweep() the blob was just referenced again
+            batch.set(self._ref(key), {"content": content, "size": len(content), "written_at": firestore.SERVER_TIMESTAMP})
+            self._cache.set(key, content)
+        return document
+
+    def stats(self) -> dict:
+        return {"cached": len(self._cache), "fetched": self.fetched, "missing": self.missing}
+
+
+def _convert(document: dict) -> Optional[dict]:
+    """Memory form of a legacy structured reply that should be rewritten, else None"""
+    if document.get("schema") == SCHEMA_VERSION or document.get("role") != "assistant":
+        return None
+    items = parse_legacy_content(document.get("content", ""))
+    return {**document, "content": items} if items is not None else None
+
+
+def migrate(dry_run: bool = False) -> dict:
+    """Rewrite legacy structured replies (hot documents and archive buckets) as schema 2"""
+    # Imported lazily: the services initialize Firestore
+    from firebase_admin import firestore
+    from app.services.bulk_transfer import paged_documents
+    from app.services.firestore_service import firestore_service
+    from app.services.message_archive import pack_messages, unpack_messages
+
+    db = firestore_service.db
+    blobs = firestore_service.blobs
+    stats = {"sessions": 0, "messages": 0, "buckets": 0, "failed_sessions": 0}
+    for session in paged_documents(db.collection("chat_sessions"), settings.EXPORT_PAGE_SIZE):
+        stats["sessions"] += 1
+        # (document, converted messages, whether it is an archive bucket)
+        updates = []
+        for doc in session.reference.collection("messages").stream():
+            message = _convert({**doc.to_dict(), "message_id": doc.id})
+            if message is not None:
+                updates.append((doc.reference, [message], False))
+                stats["messages"] += 1
+        for doc in session.reference.collection("archive").stream():
+            rows = unpack_messages(doc.to_dict()["data"])
+            converted = [_convert(row) for row in rows]
+            if any(message is not None for message in converted):
+                updates.append((doc.reference, [message or row for message, row in zip(converted, rows)], True))
+                stats["messages"] += sum(1 for message in converted if message is not None)
+                stats["buckets"] += 1
+        if dry_run or not updates:
+            continue
+
+        try:
+            batch, writes = db.batch(), 0
+            for ref, messages, is_bucket in updates:
+                count = 1 + sum(blob_count(message) for message in messages)
+                if writes and writes + count > 400:
+                    batch.commit()
+                    batch, writes = db.batch(), 0
+                if is_bucket:
+                    batch.update(ref, {"data": pack_messages([blobs.write(batch, message) for message in messages])})
+                else:
+                    # update, not set: a document archived meanwhile fails the batch instead of reappearing
+                    batch.update(ref, {**blobs.write(batch, messages[0]), "content": firestore.DELETE_FIELD})
+                writes += count
+            batch.commit()
+        except Exception as e:
+            # Rerunning the migration picks the session up again
+            stats["failed_sessions"] += 1
+            print(f"Error migrating session {session.id}: {str(e)}")
+    return stats
+
+
+def sweep(dry_run: bool = False) -> dict:
+    """Delete the blobs no hot message or archive bucket references (mark and sweep).
+
+    Blobs written within MESSAGE_BLOB_SWEEP_GRACE of the start are kept, since
+    messages written during the scan rewrite the blobs they reference, and
+    each delete is conditional on the blob not having been rewritten since
+    it was listed.
+    """
+    # Imported lazily: the services initialize Firestore
+    from app.services.bulk_transfer import ARCHIVE_PAGE_SIZE, paged_documents
+    from app.services.firestore_service import firestore_service
+    from app.services.message_archive import unpack_messages
+
+    db = firestore_service.db
+    cutoff = datetime.now(timezone.utc) - timedelta(seconds=settings.MESSAGE_BLOB_SWEEP_GRACE)
+    stats = {"sessions": 0, "referenced": 0, "blobs": 0, "deleted": 0, "skipped": 0}
+    referenced = set()
+    # Hot messages before archive buckets: a message compacted meanwhile is seen in one or the other
+    for session in paged_documents(db.collection("chat_sessions"), settings.EXPORT_PAGE_SIZE):
+        stats["sessions"] += 1
+        messages = session.reference.collection("messages").select(["schema", "items"])
+        referenced |= blob_refs(doc.to_dict() for doc in paged_documents(messages, settings.EXPORT_PAGE_SIZE))
+        for doc in paged_documents(session.reference.collection("archive"), ARCHIVE_PAGE_SIZE):
+            referenced |= blob_refs(unpack_messages(doc.to_dict()["data"]))
+    stats["referenced"] = len(referenced)
+
+    blobs = db.collection(BLOB_COLLECTION).select(["size"])
+    for doc in paged_documents(blobs, settings.EXPORT_PAGE_SIZE):
+        stats["blobs"] += 1
+        if doc.id in referenced or doc.update_time >= cutoff:
+            continue
+        if dry_run:
+            stats["deleted"] += 1
+            continue
+        try:
+            doc.reference.delete(option=db.write_option(last_update_time=doc.update_time))
+            stats["deleted"] += 1
+        except (FailedPrecondition, NotFound):
+            # Rewritten (so referenced again) or deleted since it was listed
+            stats["skipped"] += 1
+    return stats
+
+
+def main(argv: Optional[List[str]] = None):
+    parser = argparse.ArgumentParser(description="Chat message storage format")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    migrate_parser = subparsers.add_parser("migrate", help="Rewrite legacy structured replies as schema 2")
+    migrate_parser.add_argument("--dry-run", action="store_true", help="count what would be rewritten")
+    sweep_parser = subparsers.add_parser("sweep", help="Delete code blocks no stored message references")
+    sweep_parser.add_argument("--dry-run", action="store_true", help="count what would be deleted")
+    args = parser.parse_args(argv)
+
+    if args.command == "migrate":
+        stats = migrate(dry_run=args.dry_run)
+        print(("Dry run: " if args.dry_run else "") + ", ".join(f"{key}={value}" for key, value in stats.items()))
+    elif args.command == "sweep":
+        stats = sweep(dry_run=args.dry_run)
+        print(("Dry run: " if args.dry_run else "") + ", ".join(f"{key}={value}" for key, value in stats.items()))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,43 @@
+import threading
+from typing import Callable, Dict
+
+
+class MetricsRegistry:
+    """Process-wide registry of metric collectors exposed by the metrics endpoint.
+
+    Services register a callable returning a dict of current values; the
+    endpoint snapshots every collector on demand, so nothing is computed
+    unless someone asks.
+    """
+    _instance = None
+    _initialized = False
+
+    def __new__(cls):
+        if cls._instance is None:
+            cls._instance = super().__new__(cls)
+        return cls._instance
+
+    def __init__(self):
+        if not self._initialized:
+            self._lock = threading.Lock()
+            self._collectors: Dict[str, Callable[[], dict]] = {}
+            self._initialized = True
+
+    def register(self, name: str, collector: Callable[[], dict]):
+        with self._lock:
+            self._collectors[name] = collector
+
+    def snapshot(self) -> Dict[str, dict]:
+        with self._lock:
+            collectors = dict(self._collectors)
+        result = {}
+        for name, collector in collectors.items():
+            try:
+                result[name] = collector()
+            except Exception as e:
+                result[name] = {"error": str(e)}
+        return result
+
+
+# Create singleton instance
+metrics = MetricsRegistry()
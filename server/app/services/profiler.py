@@ -0,0 +1,192 @@
+import os
+import sys
+import threading
+import time
+import uuid
+from collections import deque
+from datetime import datetime
+from typing import Deque, Dict, List, Optional
+from app.core.config import settings
+from app.services.metrics import metrics
+
+# Leaf functions of threads that are parked rather than working (event loop select, idle pool workers)
+_IDLE_LEAVES = {
+    ("selectors.py", "select"),
+    ("threading.py", "wait"),
+    ("threading.py", "_wait_for_tstate_lock"),
+    ("queue.py", "get"),
+    ("thread.py", "_worker"),
+}
+
+
+def _frame_label(frame) -> str:
+    code = frame.f_code
+    path = code.co_filename.replace(os.sep, "/").split("/")
+    return f"{code.co_name} ({'/'.join(path[-2:])}:{code.co_firstlineno})"
+
+
+class SamplingProfiler:
+    """Samples the Python stacks of every busy thread at a fixed interval.
+
+    Work for one request runs on the event loop thread and on threadpool
+    threads, so all threads are sampled; parked threads are skipped, but
+    requests running concurrently on the same worker show up as well.
+    Stacks are kept in collapsed ("folded") form, one count per distinct
+    stack, which flamegraph.pl and speedscope read directly.
+    """
+
+    def __init__(self, interval: float, max_stacks: int):
+        self.interval = interval
+        self.max_stacks = max_stacks
+        self.stacks: Dict[str, int] = {}
+        self.samples = 0
+        self.dropped = 0
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name="request-profiler", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+
+    def _run(self):
+        own = threading.get_ident()
+        while not self._stop.wait(self.interval):
+            names = {thread.ident: thread.name for thread in threading.enumerate()}
+            for ident, frame in sys._current_frames().items():
+                if ident == own:
+                    continue
+                code = frame.f_code
+                if (os.path.basename(code.co_filename), code.co_name) in _IDLE_LEAVES:
+                    continue
+                labels = []
+                while frame is not None:
+                    labels.append(_frame_label(frame))
+                    frame = frame.f_back
+                labels.append(names.get(ident, f"thread-{ident}"))
+                key = ";".join(reversed(labels))
+                if key in self.stacks:
+                    self.stacks[key] += 1
+                elif len(self.stacks) < self.max_stacks:
+                    self.stacks[key] = 1
+                else:
+                    self.dropped += 1
+                    continue
+                self.samples += 1
+
+    def folded(self) -> str:
+        return "".join(f"{stack} {count}\n" for stack, count in sorted(self.stacks.items()))
+
+    def top_functions(self, limit: int = 30) -> List[dict]:
+        """Functions by inclusive samples, with the samples where they were the leaf (pstats-style)"""
+        total: Dict[str, int] = {}
+        own: Dict[str, int] = {}
+        for stack, count in self.stacks.items():
+            frames = stack.split(";")[1:]
+            for label in set(frames):
+                total[label] = total.get(label, 0) + count
+            if frames:
+                own[frames[-1]] = own.get(frames[-1], 0) + count
+        ranked = sorted(total.items(), key=lambda item: -item[1])[:limit]
+        return [
+            {"function": label, "total_samples": count, "self_samples": own.get(label, 0)}
+            for label, count in ranked
+        ]
+
+
+class ProfileStore:
+    """Bounded ring buffer of request profiles for this worker.
+
+    At most one request is profiled at a time; a request that would
+    overlap another profile simply runs unprofiled.
+    """
+    _instance = None
+    _initialized = False
+
+    def __new__(cls):
+        if cls._instance is None:
+            cls._instance = super().__new__(cls)
+        return cls._instance
+
+    def __init__(self):
+        if not self._initialized:
+            self._profiles: Deque[dict] = deque(maxlen=settings.PROFILE_BUFFER_SIZE)
+            self._lock = threading.Lock()
+            self._active = threading.Lock()
+            self.profiled = 0
+            self.skipped_busy = 0
+            metrics.register("profiler", self.stats)
+            self._initialized = True
+
+    def begin(self) -> Optional[SamplingProfiler]:
+        """Start sampling, or None while another request is being profiled"""
+        if not self._active.acquire(blocking=False):
+            self.skipped_busy += 1
+            return None
+        profiler = SamplingProfiler(settings.PROFILE_INTERVAL, settings.PROFILE_MAX_STACKS)
+        profiler.start()
+        return profiler
+
+    def finish(self, profiler: SamplingProfiler, profile_id: str, method: str, path: str,
+               status_code: Optional[int], trigger: str, started_at: float):
+        duration_ms = (time.perf_counter() - started_at) * 1000
+        try:
+            profiler.stop()
+        finally:
+            self._active.release()
+        profile = {
+            "profile_id": profile_id,
+            "method": method,
+            "path": path,
+            "status_code": status_code,
+            "trigger": trigger,
+            "created_at": datetime.utcnow(),
+            "duration_ms": round(duration_ms, 2),
+            "interval_ms": settings.PROFILE_INTERVAL * 1000,
+            "samples": profiler.samples,
+            "dropped_samples": profiler.dropped,
+            "folded": profiler.folded(),
+            "top_functions": profiler.top_functions(),
+        }
+        with self._lock:
+            self._profiles.append(profile)
+            self.profiled += 1
+
+    def list(self) -> List[dict]:
+        """Profile metadata, newest first"""
+        with self._lock:
+            profiles = list(self._profiles)
+        return [
+            {key: value for key, value in profile.items() if key not in ("folded", "top_functions")}
+            for profile in reversed(profiles)
+        ]
+
+    def get(self, profile_id: str) -> Optional[dict]:
+        with self._lock:
+            for profile in self._profiles:
+                if profile["profile_id"] == profile_id:
+                    return profile
+        return None
+
+    @staticmethod
+    def new_id() -> str:
+        return uuid.uuid4().hex[:16]
+
+    def stats(self) -> dict:
+        with self._lock:
+            stored = len(self._profiles)
+        return {
+            "stored": stored,
+            "capacity": self._profiles.maxlen,
+            "profiled": self.profiled,
+            "skipped_busy": self.skipped_busy,
+            "sample_rate": settings.PROFILE_SAMPLE_RATE,
+        }
+
+
+# Create singleton instance
+profile_store = ProfileStore()
@@ -0,0 +1,100 @@
+import json
+from typing import List, Optional, Tuple
+
+VALID_TYPES = ["text", "ladder", "plc-code"]
+
+
+def clean_ai_response(ai_response: str) -> str:
+    """Strip markdown code fences the model sometimes wraps around its JSON"""
+    clean_response = ai_response.strip()
+
+    # Remove markdown code blocks if present
+    if clean_response.startswith('```json'):
+        clean_response = clean_response[7:]  # Remove ```json
+    if clean_response.startswith('```'):
+        clean_response = clean_response[3:]   # Remove ```
+    if clean_response.endswith('```'):
+        clean_response = clean_response[:-3]  # Remove ending ```
+
+    return clean_response.strip()
+
+
+def is_valid_item(item) -> bool:
+    return (isinstance(item, dict) and
+            "type" in item and "content" in item and
+            item["type"] in VALID_TYPES)
+
+
+def parse_ai_response(ai_response: str) -> Tuple[str, Optional[List[dict]]]:
+    """Return (content_to_store, items).
+
+    items is the parsed response array when every entry is a valid structured
+    item; content_to_store is then its JSON encoding. Otherwise items is None
+    and the cleaned text is stored as-is.
+    """
+    clean_response = clean_ai_response(ai_response)
+
+    try:
+        # Parse the response as JSON array (enforced by schema)
+        parsed_response = json.loads(clean_response)
+    except json.JSONDecodeError:
+        # If not valid JSON, treat as plain text
+        return clean_response, None
+
+    # Response should always be an array due to schema enforcement
+    if isinstance(parsed_response, list) and parsed_response and \
+            all(is_valid_item(item) for item in parsed_response):
+        # Store the structured response as JSON for consistency
+        return json.dumps(parsed_response), parsed_response
+
+    # Unexpected format or failed validation, fall back to plain text
+    return clean_response, None
+
+
+class StreamingItemParser:
+    """Incrementally pull complete items out of a streamed JSON array.
+
+    Feed raw text chunks as they arrive; each call returns the array items
+    that became complete with that chunk.
+    """
+
+    def __init__(self):
+        self._decoder = json.JSONDecoder()
+        self._buffer = ""
+        self._pos = None  # index just inside the opening '[' once seen
+        self._done = False
+
+    def feed(self, chunk: str) -> List[dict]:
+        self._buffer += chunk
+        items = []
+        if self._done:
+            return items
+
+        if self._pos is None:
+            start = self._buffer.find("[")
+            if start == -1:
+                return items
+            self._pos = start + 1
+
+        while True:
+            # Skip separators between items
+            while self._pos < len(self._buffer) and self._buffer[self._pos] in " \t\r\n,":
+                self._pos += 1
+            if self._pos >= len(self._buffer):
+                break
+            if self._buffer[self._pos] == "]":
+                self._done = True
+                break
+            try:
+                item, end = self._decoder.raw_decode(self._buffer, self._pos)
+            except json.JSONDecodeError:
+                # Item not complete yet; wait for more text
+                break
+            self._pos = end
+            if is_valid_item(item):
+                items.append(item)
+        return items
+
+    @property
+    def text(self) -> str:
+        return self._buffer
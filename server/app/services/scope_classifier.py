@@ -0,0 +1,125 @@
+import json
+import math
+import os
+import random
+import re
+import zlib
+from typing import Dict, Iterable, List
+
+# Canned answer the system prompt asks Gemini to give for non-PLC questions
+OFF_TOPIC_MESSAGE = (
+    "I'm sorry, but I can only answer questions related to PLCs, IEC 61131-3 programming, "
+    "industrial automation, and control systems. Please ask me about ladder diagrams, "
+    "PLC programming, SCADA systems, or other industrial automation topics."
+)
+OFF_TOPIC_RESPONSE = json.dumps([{"type": "text", "content": OFF_TOPIC_MESSAGE}])
+
+DEFAULT_TRAINING_PATH = os.path.join(os.path.dirname(__file__), "scope_training.json")
+
+# Core IEC 61131-3 / industrial automation vocabulary; KB index terms are added on top
+IEC_VOCABULARY = {
+    "plc", "plcs", "iec", "61131", "61131-3", "ladder", "rung", "rungs", "coil", "coils",
+    "contact", "contacts", "latch", "unlatch", "interlock", "ton", "tof", "tonr", "tp",
+    "ctu", "ctd", "ctud", "r_trig", "f_trig", "timer", "timers", "counter", "counters",
+    "st", "fbd", "sfc", "il", "structured", "function", "block", "blocks", "var",
+    "var_input", "var_output", "end_var", "program", "bool", "real", "int", "dint",
+    "scada", "hmi", "dcs", "modbus", "profibus", "profinet", "ethercat", "opc", "ua",
+    "sensor", "sensors", "actuator", "actuators", "motor", "motors", "conveyor", "valve",
+    "valves", "pump", "pumps", "pid", "setpoint", "deadband", "hysteresis", "alarm",
+    "alarms", "interlocks", "i/o", "io", "analog", "digital", "input", "inputs", "output",
+    "outputs", "scan", "watchdog", "sil", "e-stop", "estop", "emergency", "starter",
+    "overload", "relay", "relays", "drive", "drives", "vfd", "encoder", "automation",
+    "industrial", "control", "controller", "fault", "reset", "preset", "retentive",
+    # Vendors, platforms and engineering tools
+    "siemens", "simatic", "s7", "s7-300", "s7-400", "s7-1200", "s7-1500", "tia", "step7", "logo",
+    "rockwell", "allen-bradley", "studio", "5000", "rslogix", "logix", "controllogix",
+    "compactlogix", "micrologix", "beckhoff", "twincat", "ads", "codesys", "omron", "sysmac",
+    "cx-programmer", "mitsubishi", "melsec", "gx", "schneider", "modicon", "ecostruxure", "wago",
+    "plcnext", "b&r", "ac500", "ethernet/ip", "gsd", "eds", "ob1", "ob35", "task", "cycle",
+    # Process and machine control
+    "tag", "tags", "loop", "loops", "tuning", "sequence", "sequencer", "machine", "machines",
+    "process", "batch", "temperature", "pressure", "level", "flow", "tank", "furnace",
+    "boiler", "compressor", "commissioning", "wiring", "panel", "firmware", "network",
+}
+
+_TOKEN_RE = re.compile(r"[a-z0-9_/\-]+")
+_FEATURES = 1 << 16
+
+
+def _tokens(text: str) -> List[str]:
+    return _TOKEN_RE.findall(text.lower())
+
+
+def _hash(feature: str) -> int:
+    return zlib.crc32(feature.encode("utf-8")) % _FEATURES
+
+
+class ScopeClassifier:
+    """Small logistic-regression scope classifier.
+
+    Features are hashed unigrams/bigrams plus the (log) count of IEC/KB
+    vocabulary hits. The model is trained at startup on a bundled seed set,
+    which takes a few milliseconds.
+    """
+
+    def __init__(self, kb_terms: Iterable[str] = (), training_path: str = DEFAULT_TRAINING_PATH):
+        self.vocabulary = set(IEC_VOCABULARY)
+        self.vocabulary.update(
+            term for term in kb_terms
+            if len(term) >= 3 and term.isalpha()
+        )
+        self.weights: Dict[int, float] = {}
+        self.vocab_weight = 0.0
+        self.bias = 0.0
+        with open(training_path, "r", encoding="utf-8") as f:
+            examples = json.load(f)
+        self._train([(example["text"], 1.0 if example["on_topic"] else 0.0) for example in examples])
+
+    def _features(self, text: str):
+        tokens = _tokens(text)
+        hashed: Dict[int, float] = {}
+        for token in tokens:
+            index = _hash(token)
+            hashed[index] = hashed.get(index, 0.0) + 1.0
+        for first, second in zip(tokens, tokens[1:]):
+            index = _hash(f"{first} {second}")
+            hashed[index] = hashed.get(index, 0.0) + 1.0
+        # L2-normalize so long prompts don't dominate
+        norm = math.sqrt(sum(v * v for v in hashed.values())) or 1.0
+        hashed = {k: v / norm for k, v in hashed.items()}
+        vocab_hits = math.log1p(sum(1 for token in tokens if token in self.vocabulary))
+        return hashed, vocab_hits
+
+    def _logit(self, hashed: Dict[int, float], vocab_hits: float) -> float:
+        return self.bias + self.vocab_weight * vocab_hits + sum(
+            self.weights.get(k, 0.0) * v for k, v in hashed.items()
+        )
+
+    def _train(self, examples, epochs: int = 40, learning_rate: float = 0.5, l2: float = 1e-4):
+        featurized = [(self._features(text), label) for text, label in examples]
+        rng = random.Random(13)
+        for _ in range(epochs):
+            rng.shuffle(featurized)
+            for (hashed, vocab_hits), label in featurized:
+                error = label - _sigmoid(self._logit(hashed, vocab_hits))
+                self.bias += learning_rate * error
+                self.vocab_weight += learning_rate * (error * vocab_hits - l2 * self.vocab_weight)
+                for k, v in hashed.items():
+                    w = self.weights.get(k, 0.0)
+                    self.weights[k] = w + learning_rate * (error * v - l2 * w)
+
+    def score(self, text: str) -> float:
+        """Probability that text is a PLC / industrial automation question"""
+        hashed, vocab_hits = self._features(text)
+        return _sigmoid(self._logit(hashed, vocab_hits))
+
+
+def _sigmoid(x: float) -> float:
+    if x < -60:
+        return 0.0
+    return 1.0 / (1.0 + math.exp(-x))
+
+
+def is_off_topic_response(ai_response: str) -> bool:
+    """True when Gemini answered with the canned off-topic rejection"""
+    return "I'm sorry, but I can only answer questions related to PLCs" in (ai_response or "")
@@ -0,0 +1,288 @@
+import threading
+from datetime import datetime, timedelta
+from typing import Dict, Optional, Tuple
+from firebase_admin import firestore
+from google.cloud.firestore import FieldFilter
+from app.core.config import settings
+from app.models.usage import SessionUsage, UsageReport, UsageTotals, UserUsage
+from app.services.firestore_service import firestore_service
+from app.services.metrics import metrics
+
+# Parts of a Gemini prompt that token counts are attributed to
+SECTIONS = ("system", "kb_context", "history", "message")
+COUNTERS = ("calls", "prompt_tokens", "output_tokens", "cached_tokens", "cost_usd", "latency_ms")
+
+
+def usage_counts(usage_metadata) -> Dict[str, int]:
+    """Token counts from a Gemini response's usage_metadata (zeros when it is missing)"""
+    return {
+        "prompt_tokens": int(getattr(usage_metadata, "prompt_token_count", 0) or 0),
+        "output_tokens": int(getattr(usage_metadata, "candidates_token_count", 0) or 0),
+        "cached_tokens": int(getattr(usage_metadata, "cached_content_token_count", 0) or 0),
+    }
+
+
+def token_cost(prompt_tokens: int, output_tokens: int, cached_tokens: int) -> float:
+    """Estimated USD cost of one call from the configured per-million-token prices"""
+    return (
+        (prompt_tokens - cached_tokens) * settings.GEMINI_INPUT_COST_PER_MTOK
+        + cached_tokens * settings.GEMINI_CACHED_COST_PER_MTOK
+        + output_tokens * settings.GEMINI_OUTPUT_COST_PER_MTOK
+    ) / 1_000_000
+
+
+def split_prompt_tokens(prompt_tokens: int, section_chars: Dict[str, int]) -> Dict[str, int]:
+    """Attribute a call's prompt tokens to sections in proportion to their characters"""
+    total_chars = sum(section_chars.values())
+    if not total_chars:
+        return {section: 0 for section in SECTIONS}
+    split = {
+        section: prompt_tokens * section_chars.get(section, 0) // total_chars
+        for section in SECTIONS
+    }
+    # Rounding remainder goes to the largest section so the parts add up
+    largest = max(SECTIONS, key=lambda section: section_chars.get(section, 0))
+    split[largest] += prompt_tokens - sum(split.values())
+    return split
+
+
+def _empty() -> dict:
+    return {
+        **{counter: 0 for counter in COUNTERS},
+        "sections": {section: 0 for section in SECTIONS},
+        "sources": {},
+        "profiles": {},
+    }
+
+
+def _add(aggregate: dict, call: dict):
+    for counter in COUNTERS:
+        aggregate[counter] += call[counter]
+    for section, tokens in call["sections"].items():
+        aggregate["sections"][section] += tokens
+    aggregate["sources"][call["source"]] = aggregate["sources"].get(call["source"], 0) + 1
+    aggregate["profiles"][call["profile"]] = aggregate["profiles"].get(call["profile"], 0) + 1
+
+
+class UsageTracker:
+    """Gemini token usage per user, session, prompt section and request type.
+
+    record() folds each call into in-memory aggregates: process-wide totals
+    for the metrics surface, plus pending per-user-per-day and per-session
+    deltas. A background thread writes the pending deltas every
+    USAGE_FLUSH_INTERVAL seconds as Increments on ``usage_daily/{day}_{uid}``
+    and ``usage_sessions/{session_id}``, so each user or session costs one
+    write per flush no matter how many calls it made.
+
+    Gemini reports one prompt token count per call; the split across system
+    prompt, KB context, replayed history and the user's message is
+    proportional to the characters each contributed.
+    """
+    _instance = None
+    _initialized = False
+
+    def __new__(cls):
+        if cls._instance is None:
+            cls._instance = super().__new__(cls)
+        return cls._instance
+
+    def __init__(self):
+        if not self._initialized:
+            self._cond = threading.Condition()
+            self._totals = _empty()
+            self._pending_users: Dict[Tuple[str, str], dict] = {}
+            self._pending_sessions: Dict[str, dict] = {}
+            self._thread: Optional[threading.Thread] = None
+            self._stopping = False
+            self.flushes = 0
+            self.failed_flushes = 0
+            self.dropped = 0
+            metrics.register("token_usage", self.stats)
+            self._initialized = True
+
+    @property
+    def db(self):
+        return firestore_service.db
+
+    def record(
+        self,
+        user_id: Optional[str],
+        session_id: Optional[str],
+        source: str,
+        profile: str,
+        usage_metadata,
+        section_chars: Dict[str, int],
+        latency_ms: float
+    ):
+        """Account one Gemini call"""
+        counts = usage_counts(usage_metadata)
+        call = {
+            "calls": 1,
+            **counts,
+            "cost_usd": token_cost(counts["prompt_tokens"], counts["output_tokens"], counts["cached_tokens"]),
+            "latency_ms": latency_ms,
+            "sections": split_prompt_tokens(counts["prompt_tokens"], section_chars),
+            "source": source,
+            "profile": profile,
+        }
+        day = datetime.utcnow().strftime("%Y-%m-%d")
+        with self._cond:
+            _add(self._totals, call)
+            if user_id:
+                key = (day, user_id)
+                if key not in self._pending_users and self._pending_full():
+                    self.dropped += 1
+                else:
+                    _add(self._pending_users.setdefault(key, _empty()), call)
+            if session_id:
+                if session_id not in self._pending_sessions and self._pending_full():
+                    self.dropped += 1
+                else:
+                    pending = self._pending_sessions.setdefault(session_id, _empty())
+                    pending["user_id"] = user_id
+                    _add(pending, call)
+            if self._thread is None or not self._thread.is_alive():
+                self._stopping = False
+                self._thread = threading.Thread(target=self._run, name="usage-flusher", daemon=True)
+                self._thread.start()
+
+    def _pending_full(self) -> bool:
+        # Bounded while Firestore is unreachable; new keys are dropped, known ones keep accumulating
+        return len(self._pending_users) + len(self._pending_sessions) >= settings.USAGE_MAX_PENDING
+
+    @staticmethod
+    def _increments(aggregate: dict) -> dict:
+        return {
+            **{counter: firestore.Increment(aggregate[counter]) for counter in COUNTERS},
+            "sections": {name: firestore.Increment(value) for name, value in aggregate["sections"].items()},
+            "sources": {name: firestore.Increment(value) for name, value in aggregate["sources"].items()},
+            "profiles": {name: firestore.Increment(value) for name, value in aggregate["profiles"].items()},
+            "updated_at": datetime.utcnow(),
+        }
+
+    def _flush(self, users: Dict[Tuple[str, str], dict], sessions: Dict[str, dict]):
+        """Write the deltas in batches; committed keys are removed from users and sessions as they land,
+        so after a failure both hold only the deltas that still have to be written"""
+        writes = []
+        for (day, user_id), aggregate in users.items():
+            writes.append((
+                users, (day, user_id),
+                self.db.collection("usage_daily").document(f"{day}_{user_id}"),
+                {"day": day, "user_id": user_id, **self._increments(aggregate)}
+            ))
+        for session_id, aggregate in sessions.items():
+            writes.append((
+                sessions, session_id,
+                self.db.collection("usage_sessions").document(session_id),
+                {"session_id": session_id, "user_id": aggregate["user_id"], **self._increments(aggregate)}
+            ))
+        # Stay under the 500-write batch cap
+        for start in range(0, len(writes), 400):
+            chunk = writes[start:start + 400]
+            batch = self.db.batch()
+            for _, _, ref, data in chunk:
+                batch.set(ref, data, merge=True)
+            batch.commit()
+            for pending, key, _, _ in chunk:
+                del pending[key]
+
+    @staticmethod
+    def _merge(target: dict, pending: dict):
+        for key, aggregate in pending.items():
+            current = target.get(key)
+            if current is None:
+                target[key] = aggregate
+                continue
+            for counter in COUNTERS:
+                current[counter] += aggregate[counter]
+            for group in ("sections", "sources", "profiles"):
+                for name, value in aggregate[group].items():
+                    current[group][name] = current[group].get(name, 0) + value
+
+    def _run(self):
+        while True:
+            with self._cond:
+                if not self._stopping:
+                    self._cond.wait(settings.USAGE_FLUSH_INTERVAL)
+                users, self._pending_users = self._pending_users, {}
+                sessions, self._pending_sessions = self._pending_sessions, {}
+                stopping = self._stopping
+            if users or sessions:
+                try:
+                    self._flush(users, sessions)
+                    self.flushes += 1
+                except Exception as e:
+                    self.failed_flushes += 1
+                    print(f"Error flushing token usage: {str(e)}")
+                    if not stopping:
+                        # Fold the uncommitted deltas back in; they go out with the next flush
+                        with self._cond:
+                            self._merge(self._pending_users, users)
+                            self._merge(self._pending_sessions, sessions)
+            if stopping:
+                return
+
+    def get_report(self, days: int = 7, limit: int = 50) -> UsageReport:
+        """Usage of the last days (UTC, including today) per user, highest cost first"""
+        since = (datetime.utcnow() - timedelta(days=days - 1)).strftime("%Y-%m-%d")
+        query = self.db.collection("usage_daily").where(filter=FieldFilter("day", ">=", since))
+        totals = _empty()
+        users: Dict[str, dict] = {}
+        for doc in query.stream():
+            data = doc.to_dict()
+            aggregate = users.setdefault(data["user_id"], _empty())
+            for target in (aggregate, totals):
+                for counter in COUNTERS:
+                    target[counter] += data.get(counter, 0)
+                for group in ("sections", "sources", "profiles"):
+                    for name, value in (data.get(group) or {}).items():
+                        target[group][name] = target[group].get(name, 0) + value
+        ranked = sorted(users.items(), key=lambda item: -item[1]["cost_usd"])
+        return UsageReport(
+            days=days,
+            since=since,
+            totals=UsageTotals(**totals),
+            users=[UserUsage(user_id=user_id, **aggregate) for user_id, aggregate in ranked[:limit]],
+            total_users=len(users),
+        )
+
+    def get_session_usage(self, session_id: str) -> Optional[SessionUsage]:
+        doc = self.db.collection("usage_sessions").document(session_id).get()
+        if not doc.exists:
+            return None
+        return SessionUsage(**doc.to_dict())
+
+    def stop(self, timeout: float = 10.0):
+        """Flush pending deltas and stop the background thread"""
+        with self._cond:
+            self._stopping = True
+            self._cond.notify_all()
+            thread = self._thread
+        if thread is not None:
+            thread.join(timeout)
+
+    def stats(self) -> dict:
+        with self._cond:
+            totals = self._totals
+            calls = totals["calls"]
+            return {
+                "calls": calls,
+                "prompt_tokens": totals["prompt_tokens"],
+                "output_tokens": totals["output_tokens"],
+                "cached_tokens": totals["cached_tokens"],
+                "cost_usd": round(totals["cost_usd"], 6),
+                "avg_prompt_tokens": round(totals["prompt_tokens"] / calls, 1) if calls else None,
+                "avg_latency_ms": round(totals["latency_ms"] / calls, 1) if calls else None,
+                "sections": dict(totals["sections"]),
+                "sources": dict(totals["sources"]),
+                "profiles": dict(totals["profiles"]),
+                "pending_users": len(self._pending_users),
+                "pending_sessions": len(self._pending_sessions),
+                "flushes": self.flushes,
+                "failed_flushes": self.failed_flushes,
+                "dropped": self.dropped,
+            }
+
+
+# Create singleton instance
+usage_tracker = UsageTracker()
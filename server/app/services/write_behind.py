@@ -0,0 +1,264 @@
+import threading
+import time
+from typing import Dict, List, Optional
+from firebase_admin import firestore
+from google.api_core.exceptions import NotFound
+from app.core.config import settings
+from app.services.message_format import blob_count, message_preview
+
+# user_id -> {"updated_at": time of the user's latest session-list change}, shared by all workers
+SESSION_LIST_VERSIONS = "session_list_versions"
+
+# Firestore rejects batches of more than 500 writes
+MAX_BATCH_WRITES = 499
+
+
+class WriteBehindQueue:
+    """In-process write-behind queue for chat messages and session metadata.
+
+    Message documents are buffered per session and metadata updates are
+    coalesced into a single update per session, then flushed in Firestore
+    batches by a background thread. A session with more pending writes than
+    fit in one batch is committed in chunks, with its metadata update in the
+    last one. When a batch fails, its sessions are
+    retried one batch each, so only the failing session is retried or
+    dropped (straight away when it has been deleted). Pending and in-flight
+    writes stay visible through pending_messages()/pending_metadata() until
+    they are committed, so reads of the same session see their own writes.
+    """
+
+    def __init__(self, db, blobs):
+        self.db = db
+        self.blobs = blobs
+        self._cond = threading.Condition()
+        self._messages: Dict[str, List[dict]] = {}
+        self._metadata: Dict[str, dict] = {}
+        self._inflight_messages: Dict[str, List[dict]] = {}
+        self._inflight_metadata: Dict[str, dict] = {}
+        self._discarded = set()
+        # Failed commits per session; a session is dropped after WRITE_BEHIND_MAX_RETRIES
+        self._attempts: Dict[str, int] = {}
+        self._thread: Optional[threading.Thread] = None
+        self._stopping = False
+
+    def _ensure_started(self):
+        if self._thread is None or not self._thread.is_alive():
+            self._stopping = False
+            self._thread = threading.Thread(target=self._run, name="firestore-write-behind", daemon=True)
+            self._thread.start()
+
+    def _pending_count(self) -> int:
+        return sum(len(msgs) for msgs in self._messages.values()) + len(self._metadata)
+
+    def has_pending(self, session_id: str) -> bool:
+        with self._cond:
+            return session_id in self._messages or session_id in self._metadata \
+                or session_id in self._inflight_messages or session_id in self._inflight_metadata
+
+    def enqueue_message(self, session_id: str, user_id: str, message_data: dict):
+        """Queue a message document and fold its metadata into the session's pending update"""
+        with self._cond:
+            self._messages.setdefault(session_id, []).append(message_data)
+            meta = self._metadata.setdefault(session_id, {"user_id": user_id, "message_count_delta": 0})
+            meta["message_count_delta"] += 1
+            meta["updated_at"] = message_data["timestamp"]
+            meta["last_message"] = message_preview(message_data["content"])
+            self._ensure_started()
+            if self._pending_count() >= settings.WRITE_BEHIND_BATCH_SIZE:
+                self._cond.notify_all()
+
+    def pending_messages(self, session_id: str) -> List[dict]:
+        """Messages not yet committed for a session, oldest first"""
+        with self._cond:
+            pending = list(self._inflight_messages.get(session_id, []))
+            pending.extend(self._messages.get(session_id, []))
+        return [dict(m) for m in pending]
+
+    def pending_metadata(self, session_id: str) -> Optional[dict]:
+        """Coalesced metadata not yet committed for a session"""
+        with self._cond:
+            inflight = self._inflight_metadata.get(session_id)
+            queued = self._metadata.get(session_id)
+            if inflight is None and queued is None:
+                return None
+            return self._merge_metadata(inflight, queued)
+
+    @staticmethod
+    def _merge_metadata(older: Optional[dict], newer: Optional[dict]) -> dict:
+        if older is None:
+            return dict(newer)
+        if newer is None:
+            return dict(older)
+        merged = dict(newer)
+        merged["message_count_delta"] = older["message_count_delta"] + newer["message_count_delta"]
+        return merged
+
+    def discard_session(self, session_id: str, timeout: float = 10.0):
+        """Drop queued writes for a deleted session and wait out any in-flight commit"""
+        deadline = time.monotonic() + timeout
+        with self._cond:
+            self._messages.pop(session_id, None)
+            self._metadata.pop(session_id, None)
+            if session_id in self._inflight_metadata:
+                # A failed in-flight batch must not resurrect the deleted session
+                self._discarded.add(session_id)
+            while session_id in self._inflight_metadata or session_id in self._inflight_messages:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                self._cond.wait(remaining)
+
+    def _take_batch(self):
+        """Move up to one Firestore batch worth of writes into the in-flight set"""
+        budget = min(settings.WRITE_BEHIND_BATCH_SIZE, MAX_BATCH_WRITES)
+        for session_id in list(self._metadata.keys()):
+            messages = self._messages.get(session_id, [])
+            # One write per message and shared code block, plus the coalesced session update
+            # and the user's session-list version
+            writes = sum(1 + blob_count(message) for message in messages) + 2
+            if budget < writes and self._inflight_metadata:
+                break
+            self._inflight_messages[session_id] = self._messages.pop(session_id, [])
+            self._inflight_metadata[session_id] = self._metadata.pop(session_id)
+            budget -= writes
+            if budget <= 0:
+                break
+
+    def _commit_overflow(self, session_id: str, session_ref) -> List[dict]:
+        """Commit a session's oldest in-flight messages in chunks until the rest fit in one batch.
+
+        Committed chunks leave the in-flight set, so a retry of the final batch
+        does not write them again. Returns the messages still to be written.
+        """
+        with self._cond:
+            messages = self._inflight_messages.get(session_id, [])
+        # The final batch also holds the session update and the session-list version
+        while sum(1 + blob_count(message) for message in messages) + 2 > MAX_BATCH_WRITES:
+            chunk, writes = [], 0
+            for message_data in messages:
+                needed = 1 + blob_count(message_data)
+                if chunk and writes + needed > MAX_BATCH_WRITES:
+                    break
+                chunk.append(message_data)
+                writes += needed
+            batch = self.db.batch()
+            for message_data in chunk:
+                batch.set(
+                    session_ref.collection("messages").document(message_data["message_id"]),
+                    self.blobs.write(batch, message_data)
+                )
+            batch.commit()
+            messages = messages[len(chunk):]
+            with self._cond:
+                self._inflight_messages[session_id] = messages
+        return messages
+
+    def _commit_sessions(self, session_ids: List[str]):
+        """Commit the in-flight writes of some sessions in one batch (chunked for an oversized session)"""
+        batch = self.db.batch()
+        versions: Dict[str, object] = {}
+        for session_id in session_ids:
+            meta = self._inflight_metadata[session_id]
+            user_id = meta["user_id"]
+            versions[user_id] = max(versions.get(user_id, meta["updated_at"]), meta["updated_at"])
+            session_ref = self.db.collection("chat_sessions").document(session_id)
+            for message_data in self._commit_overflow(session_id, session_ref):
+                batch.set(
+                    session_ref.collection("messages").document(message_data["message_id"]),
+                    self.blobs.write(batch, message_data)
+                )
+            batch.update(session_ref, {
+                "updated_at": meta["updated_at"],
+                "message_count": firestore.Increment(meta["message_count_delta"]),
+                "last_message": meta["last_message"]
+            })
+        for user_id, updated_at in versions.items():
+            batch.set(self.db.collection(SESSION_LIST_VERSIONS).document(user_id), {"updated_at": updated_at}, merge=True)
+        batch.commit()
+
+    def _commit_separately(self, session_ids: List[str]) -> Dict[str, Exception]:
+        """Retry a failed batch one session per batch, so one bad session cannot sink the others"""
+        failed = {}
+        for session_id in session_ids:
+            try:
+                self._commit_sessions([session_id])
+            except Exception as e:
+                failed[session_id] = e
+        return failed
+
+    def _release(self, session_id: str, requeue: bool):
+        """Take a session out of the in-flight set, putting its writes back in front of the queue on requeue"""
+        messages = self._inflight_messages.pop(session_id, [])
+        meta = self._inflight_metadata.pop(session_id, None)
+        if session_id in self._discarded:
+            # A failed in-flight batch must not resurrect the deleted session
+            self._discarded.discard(session_id)
+            return
+        if requeue:
+            if messages:
+                self._messages[session_id] = messages + self._messages.get(session_id, [])
+            if meta is not None:
+                self._metadata[session_id] = self._merge_metadata(meta, self._metadata.get(session_id))
+
+    def _settle(self, session_id: str, error: Optional[Exception]):
+        if error is None:
+            self._attempts.pop(session_id, None)
+            self._release(session_id, requeue=False)
+        elif isinstance(error, NotFound):
+            # Deleted through another worker: its writes have nowhere to go
+            print(f"Write-behind writes dropped for deleted session {session_id}")
+            self._attempts.pop(session_id, None)
+            self._release(session_id, requeue=False)
+        else:
+            attempts = self._attempts.get(session_id, 0) + 1
+            if attempts > settings.WRITE_BEHIND_MAX_RETRIES:
+                print(f"Write-behind writes for session {session_id} dropped after {attempts} attempts: {error}")
+                self._attempts.pop(session_id, None)
+                self._release(session_id, requeue=False)
+            else:
+                print(f"Write-behind writes for session {session_id} failed (attempt {attempts}), retrying: {error}")
+                self._attempts[session_id] = attempts
+                self._release(session_id, requeue=True)
+
+    def _flush_once(self) -> bool:
+        """Commit one batch; returns False when writes of some session failed"""
+        with self._cond:
+            self._take_batch()
+            session_ids = list(self._inflight_metadata)
+            if not session_ids:
+                return True
+        try:
+            self._commit_sessions(session_ids)
+            failed = {}
+        except Exception as e:
+            failed = {session_ids[0]: e} if len(session_ids) == 1 else self._commit_separately(session_ids)
+        with self._cond:
+            for session_id in session_ids:
+                self._settle(session_id, failed.get(session_id))
+            self._cond.notify_all()
+        return not failed
+
+    def _run(self):
+        while True:
+            with self._cond:
+                if not self._stopping and self._pending_count() < settings.WRITE_BEHIND_BATCH_SIZE:
+                    self._cond.wait(settings.WRITE_BEHIND_FLUSH_INTERVAL)
+                if self._stopping and not self._metadata:
+                    return
+            if not self._flush_once():
+                # Exponential backoff between retries of failed sessions
+                time.sleep(min(0.2 * (2 ** max(self._attempts.values(), default=1)), 10.0))
+
+    def stop(self, timeout: float = 10.0) -> bool:
+        """Drain pending writes and stop the background thread; True when fully drained"""
+        with self._cond:
+            self._stopping = True
+            self._cond.notify_all()
+            thread = self._thread
+        if thread is not None:
+            thread.join(timeout)
+        with self._cond:
+            remaining = self._pending_count()
+        if remaining:
+            print(f"Write-behind queue stopped with {remaining} pending writes")
+        return remaining == 0
@@ -0,0 +1,130 @@
+"""
+Response serialization benchmark.
+
+Compares FastAPI's default JSONResponse with ORJSONResponse, with and without
+GZipMiddleware, on the two heaviest payloads the API serves:
+
+    - a 100-message session history (GET /chat/sessions/{id}/messages)
+    - a 1,000-entry library dump (GET /library/entries)
+
+Run from the server directory:
+
+    python -m benchmarks.bench_responses [--iterations N]
+"""
+import argparse
+import json
+import time
+from datetime import datetime, timedelta
+from typing import List
+
+from fastapi import FastAPI
+from fastapi.middleware.gzip import GZipMiddleware
+from fastapi.responses import JSONResponse, ORJSONResponse
+from fastapi.testclient import TestClient
+
+from app.models.library import LibraryEntryResponse
+from app.models.session import SessionMessagesResponse
+
+
+def _assistant_payload(i: int) -> str:
+    """Stored assistant content: a JSON array with text, ladder and code items"""
+    return json.dumps([
+        {"type": "text", "content": f"Here is the implementation for step {i} with a start/stop latch and an on-delay timer."},
+        {
+            "type": "ladder",
+            "content": "|----] [----] [----[TON]----( )-------|\n|   Start   Stop  Timer1   Output    |\n" * 4,
+            "validation": {"status": "valid", "executable": True, "reason": "Standard TON usage"}
+        },
+        {
+            "type": "plc-code",
+            "content": "PROGRAM Timer_Example\nVAR\n  StartButton: BOOL;\n  StopButton: BOOL;\n"
+                       "  Timer1: TON;\n  Output: BOOL;\nEND_VAR\n\n"
+                       "Timer1(IN:=StartButton AND NOT StopButton, PT:=T#5s);\nOutput := Timer1.Q;\nEND_PROGRAM" * 3,
+            "validation": {"status": "valid", "executable": True, "reason": "Compiles on IEC ST"}
+        }
+    ])
+
+
+def build_session(messages: int = 100) -> dict:
+    start = datetime(2024, 1, 1)
+    items = []
+    for i in range(messages):
+        if i % 2 == 0:
+            items.append({
+                "role": "user",
+                "content": f"Show me a timer implementation for conveyor {i}",
+                "timestamp": start + timedelta(seconds=i),
+                "message_id": f"msg-{i}"
+            })
+        else:
+            items.append({
+                "role": "assistant",
+                "content": _assistant_payload(i),
+                "timestamp": start + timedelta(seconds=i),
+                "message_id": f"msg-{i}"
+            })
+    return {"session_id": "bench-session", "messages": items, "total": len(items)}
+
+
+def build_library(entries: int = 1000) -> List[dict]:
+    start = datetime(2024, 1, 1)
+    return [
+        {
+            "entry_id": f"entry-{i}",
+            "user_name": "Bench User",
+            "user_question": f"How do I implement alarm {i} with hysteresis?",
+            "assistant_response": _assistant_payload(i),
+            "session_id": f"session-{i % 50}",
+            "created_at": start + timedelta(minutes=i),
+            "tags": ["alarm", "hysteresis"],
+            "category": "Alarms"
+        }
+        for i in range(entries)
+    ]
+
+
+def build_app(session: dict, library: List[dict], response_class, gzip: bool) -> FastAPI:
+    app = FastAPI(default_response_class=response_class)
+    if gzip:
+        app.add_middleware(GZipMiddleware, minimum_size=1024)
+
+    @app.get("/messages", response_model=SessionMessagesResponse)
+    def messages():
+        return session
+
+    @app.get("/entries", response_model=List[LibraryEntryResponse])
+    def entries():
+        return library
+
+    return app
+
+
+def run(iterations: int):
+    session = build_session()
+    library = build_library()
+
+    variants = [
+        ("JSONResponse", JSONResponse, False),
+        ("JSONResponse + gzip", JSONResponse, True),
+        ("ORJSONResponse", ORJSONResponse, False),
+        ("ORJSONResponse + gzip", ORJSONResponse, True),
+    ]
+
+    print(f"{'variant':<24} {'route':<10} {'ms/req':>8} {'wire bytes':>12}")
+    for name, response_class, gzip in variants:
+        client = TestClient(build_app(session, library, response_class, gzip))
+        for route in ("/messages", "/entries"):
+            # Warm up route compilation and model validators
+            client.get(route)
+            start = time.perf_counter()
+            for _ in range(iterations):
+                response = client.get(route, headers={"Accept-Encoding": "gzip"})
+            elapsed = (time.perf_counter() - start) * 1000 / iterations
+            wire_bytes = int(response.headers.get("content-length", len(response.content)))
+            print(f"{name:<24} {route:<10} {elapsed:>8.2f} {wire_bytes:>12}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--iterations", type=int, default=50)
+    run(parser.parse_args().iterations)
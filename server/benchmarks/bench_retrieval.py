@@ -0,0 +1,296 @@
+"""
+KB retrieval quality and latency benchmark.
+
+Runs every retriever behind the same interface, ``retrieve(query, top_k)``
+returning KB passages, over the real ``kb/`` documents plus synthetic PLC
+documents so the corpus grows from 10 to 100,000 documents. For each
+retriever and corpus size it reports:
+
+    - index build time and peak Python memory (tracemalloc, separate pass)
+    - recall@1, recall@k and MRR on the golden set (retrieval_golden.json),
+      questions mapped to the kb/ documents that answer them
+    - recall@k and MRR on synthetic questions about synthetic documents
+    - p50/p99 latency per query
+
+Retrievers:
+
+    keyword        SimpleKBRetriever reading the kb/ files in-process
+    keyword-mmap   SimpleKBRetriever over a freshly built kb_index file
+    dense          DenseRetriever over the KB only (no library entries, gate bypassed)
+
+Run from the server directory:
+
+    python -m benchmarks.bench_retrieval [--sizes 10,1000] [--retrievers keyword,dense] [--k 3]
+"""
+import argparse
+import json
+import os
+import random
+import shutil
+import statistics
+import tempfile
+import time
+import tracemalloc
+from typing import Callable, Dict, List, Tuple
+
+from app.core.config import settings
+from app.services.dense_retriever import DenseRetriever, chunk_spans, np
+from app.services.gemini_service import SimpleKBRetriever
+from app.services.kb_index import DEFAULT_KB_PATH, build_from_kb, load_kb_documents
+
+GOLDEN_PATH = os.path.join(os.path.dirname(__file__), "retrieval_golden.json")
+
+AREAS = ["Boiler", "Kiln", "Mixer", "Press", "Silo", "Chiller", "Furnace", "Dryer", "Tank", "Line"]
+EQUIPMENT = [
+    ("FeedPump", "feed pump"), ("Conveyor", "conveyor"), ("Fan", "fan"), ("Valve", "valve"),
+    ("Agitator", "agitator"), ("Compressor", "compressor"), ("Heater", "heater"), ("Motor", "motor"),
+]
+
+# (title, body, question) per topic; questions paraphrase the document instead of copying it
+TOPICS = [
+    (
+        "On-delay start for {name}",
+        "VAR\n    {tag}_Start : BOOL; {tag}_Run : BOOL;\n    {tag}_Delay : TON;\nEND_VAR\n\n"
+        "{tag}_Delay(IN := {tag}_Start, PT := T#{n}s);\n{tag}_Run := {tag}_Delay.Q;",
+        "time delay before the {name} starts running",
+    ),
+    (
+        "Part counter for {name}",
+        "VAR\n    {tag}_Sensor : BOOL; {tag}_Reset : BOOL;\n    {tag}_Count : CTU;\nEND_VAR\n\n"
+        "{tag}_Count(CU := {tag}_Sensor, RESET := {tag}_Reset, PV := {n});",
+        "count parts passing the {name} with a CTU",
+    ),
+    (
+        "Start/stop seal-in for {name}",
+        "VAR\n    {tag}_StartPB : BOOL; {tag}_StopPB : BOOL; {tag}_Contactor : BOOL;\nEND_VAR\n\n"
+        "{tag}_Contactor := ({tag}_StartPB OR {tag}_Contactor) AND NOT {tag}_StopPB;",
+        "latching start stop circuit for the {name}",
+    ),
+    (
+        "PID loop for {name}",
+        "VAR\n    {tag}_SP : REAL; {tag}_PV : REAL; {tag}_CV : REAL;\n    {tag}_Loop : PID;\nEND_VAR\n\n"
+        "{tag}_Loop(SETPOINT := {tag}_SP, PV := {tag}_PV, KP := 1.{n}, TN := T#{n}s);\n{tag}_CV := {tag}_Loop.Y;",
+        "closed loop control of the {name} with proportional and integral gain",
+    ),
+    (
+        "High temperature alarm for {name}",
+        "VAR\n    {tag}_Temp : REAL; {tag}_TempHigh : REAL := {n}.0; {tag}_Alarm : BOOL;\nEND_VAR\n\n"
+        "{tag}_Alarm := {tag}_Temp > {tag}_TempHigh;",
+        "alert when the {name} gets too hot",
+    ),
+    (
+        "Level deadband for {name}",
+        "VAR\n    {tag}_Level : REAL; {tag}_On : REAL; {tag}_Off : REAL; {tag}_Cmd : BOOL;\nEND_VAR\n\n"
+        "IF {tag}_Level < {tag}_On THEN\n    {tag}_Cmd := TRUE;\nELSIF {tag}_Level > {tag}_Off THEN\n"
+        "    {tag}_Cmd := FALSE;\nEND_IF;",
+        "hysteresis on the level switching of the {name}",
+    ),
+    (
+        "Analog input scaling for {name}",
+        "VAR\n    {tag}_Raw : INT; {tag}_Eng : REAL;\nEND_VAR\n\n"
+        "{tag}_Eng := INT_TO_REAL({tag}_Raw) * {n}.0 / 27648.0;",
+        "convert the 4-20mA raw value of the {name} to engineering units",
+    ),
+    (
+        "Safety interlock for {name}",
+        "VAR\n    {tag}_DoorClosed : BOOL; {tag}_EStopOK : BOOL; {tag}_Permit : BOOL;\nEND_VAR\n\n"
+        "{tag}_Permit := {tag}_DoorClosed AND {tag}_EStopOK;",
+        "permissive so the {name} cannot run with the guard open",
+    ),
+    (
+        "Rising edge detection for {name}",
+        "VAR\n    {tag}_Button : BOOL; {tag}_Edge : R_TRIG; {tag}_Pulse : BOOL;\nEND_VAR\n\n"
+        "{tag}_Edge(CLK := {tag}_Button);\n{tag}_Pulse := {tag}_Edge.Q;",
+        "one shot pulse when the {name} button is pressed",
+    ),
+    (
+        "Modbus status word for {name}",
+        "VAR\n    {tag}_Status : WORD; {tag}_Running : BOOL; {tag}_Fault : BOOL;\nEND_VAR\n\n"
+        "{tag}_Running := {tag}_Status.0;\n{tag}_Fault := {tag}_Status.{n};",
+        "read the running and fault bits of the {name} over modbus",
+    ),
+]
+
+
+def synthetic_corpus(count: int, seed: int = 7) -> List[Tuple[str, str, str]]:
+    """(name, text, question) for count synthetic documents, one equipment item each"""
+    rng = random.Random(seed)
+    docs = []
+    for i in range(count):
+        area = rng.choice(AREAS)
+        tag_base, words = rng.choice(EQUIPMENT)
+        title, body, question = rng.choice(TOPICS)
+        unit = rng.randint(1, 9)
+        name = f"{words} {i} on {area.lower()} {unit}"
+        tag = f"{area}{unit}_{tag_base}{i}"
+        n = rng.randint(2, 60)
+        text = f"Title: {title.format(name=name)}\n\n{body.format(tag=tag, n=n)}\n"
+        docs.append((f"synthetic_{i:06d}.st", text, question.format(name=name)))
+    return docs
+
+
+def write_corpus(directory: str, size: int) -> Tuple[Dict[str, str], List[Tuple[str, List[str]]]]:
+    """Real KB files plus synthetic ones up to size documents; returns text->name and synthetic questions"""
+    real = load_kb_documents(DEFAULT_KB_PATH)
+    synthetic = synthetic_corpus(max(size - len(real), 0))
+    names = {}
+    for name, text in real:
+        shutil.copy(os.path.join(DEFAULT_KB_PATH, name), os.path.join(directory, name))
+        names[text] = name
+    for name, text, _ in synthetic:
+        with open(os.path.join(directory, name), "w", encoding="utf-8") as f:
+            f.write(text)
+        names[text] = name
+    # Dense retrieval returns the matching chunk of a document
+    for text, name in list(names.items()):
+        for start, end in chunk_spans(text, settings.DENSE_CHUNK_CHARS):
+            names.setdefault(text[start:end], name)
+    return names, [(question, [name]) for name, _, question in synthetic]
+
+
+class KBOnlyDenseRetriever(DenseRetriever):
+    """DenseRetriever with no library rows, so the benchmark never touches Firestore"""
+
+    def _library_rows(self, since=None):
+        return iter(())
+
+
+def _keyword(kb_path: str, workdir: str):
+    return SimpleKBRetriever(kb_path=kb_path, index_path="")
+
+
+def _keyword_mmap(kb_path: str, workdir: str):
+    index_path = os.path.join(workdir, "kb.idx")
+    build_from_kb(kb_path, index_path)
+    return SimpleKBRetriever(kb_path=kb_path, index_path=index_path)
+
+
+def _dense(kb_path: str, workdir: str):
+    retriever = KBOnlyDenseRetriever(SimpleKBRetriever(kb_path=kb_path, index_path=""))
+    # Measure the index itself, without the golden-set gate falling back to keyword retrieval
+    retriever.build(check_golden=False)
+    return retriever
+
+
+# name -> factory(kb_path, workdir) returning an object with retrieve(query, top_k) -> List[str]
+RETRIEVERS: Dict[str, Callable] = {
+    "keyword": _keyword,
+    "keyword-mmap": _keyword_mmap,
+    "dense": _dense,
+}
+
+
+def evaluate(retriever, names: Dict[str, str], queries: List[Tuple[str, List[str]]], k: int) -> Tuple[dict, List[float]]:
+    """recall@1, recall@k and MRR over queries, plus per-query latencies in ms"""
+    recall_1 = recall_k = reciprocal_rank = 0.0
+    latencies = []
+    for question, expected in queries:
+        start = time.perf_counter()
+        passages = retriever.retrieve(question, top_k=k)
+        latencies.append((time.perf_counter() - start) * 1000)
+        ranked = [names.get(passage) for passage in passages]
+        hits = [name for name in ranked if name in expected]
+        recall_1 += len(set(ranked[:1]) & set(expected)) / len(expected)
+        recall_k += len(set(hits)) / len(expected)
+        if hits:
+            reciprocal_rank += 1.0 / (ranked.index(hits[0]) + 1)
+    total = len(queries) or 1
+    return {
+        "recall@1": recall_1 / total,
+        "recall@k": recall_k / total,
+        "mrr": reciprocal_rank / total,
+    }, latencies
+
+
+def _percentile(values: List[float], pct: float) -> float:
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(round(pct / 100 * (len(ordered) - 1))))]
+
+
+def run(sizes: List[int], retrievers: List[str], k: int, queries: int, memory: bool) -> List[dict]:
+    with open(GOLDEN_PATH, "r", encoding="utf-8") as f:
+        golden = [(item["question"], item["expected"]) for item in json.load(f)]
+
+    results = []
+    print(f"{'retriever':<14} {'docs':>7} {'build s':>8} {'peak MB':>8} "
+          f"{'gold R@1':>9} {'gold R@k':>9} {'gold MRR':>9} {'syn R@k':>8} {'syn MRR':>8} "
+          f"{'p50 ms':>8} {'p99 ms':>8}")
+    for size in sizes:
+        workdir = tempfile.mkdtemp(prefix="bench_retrieval_")
+        try:
+            kb_path = os.path.join(workdir, "kb")
+            os.makedirs(kb_path)
+            names, synthetic = write_corpus(kb_path, size)
+            synthetic_queries = random.Random(size).sample(synthetic, min(queries, len(synthetic)))
+
+            for name in retrievers:
+                factory = RETRIEVERS[name]
+                if name == "dense" and np is None:
+                    print(f"{name:<14} {size:>7} skipped: NumPy not installed")
+                    continue
+
+                peak_mb = None
+                if memory:
+                    # Separate pass: tracing allocations slows the build it measures
+                    tracemalloc.start()
+                    factory(kb_path, workdir)
+                    peak_mb = tracemalloc.get_traced_memory()[1] / (1024 * 1024)
+                    tracemalloc.stop()
+
+                start = time.perf_counter()
+                retriever = factory(kb_path, workdir)
+                build_seconds = time.perf_counter() - start
+
+                # Warm up caches and lazily mapped pages
+                retriever.retrieve(golden[0][0], top_k=k)
+                gold, gold_latencies = evaluate(retriever, names, golden, k)
+                syn, syn_latencies = evaluate(retriever, names, synthetic_queries, k)
+                latencies = gold_latencies + syn_latencies
+
+                row = {
+                    "retriever": name,
+                    "documents": size,
+                    "k": k,
+                    "build_seconds": round(build_seconds, 4),
+                    "peak_memory_mb": round(peak_mb, 2) if peak_mb is not None else None,
+                    "golden": {key: round(value, 4) for key, value in gold.items()},
+                    "synthetic": {key: round(value, 4) for key, value in syn.items()},
+                    "synthetic_queries": len(synthetic_queries),
+                    "p50_ms": round(statistics.median(latencies), 4),
+                    "p99_ms": round(_percentile(latencies, 99), 4),
+                }
+                results.append(row)
+                peak = f"{peak_mb:>8.1f}" if peak_mb is not None else f"{'-':>8}"
+                syn_recall = f"{syn['recall@k']:>8.3f}" if synthetic_queries else f"{'-':>8}"
+                syn_mrr = f"{syn['mrr']:>8.3f}" if synthetic_queries else f"{'-':>8}"
+                print(f"{name:<14} {size:>7} {build_seconds:>8.3f} {peak} "
+                      f"{gold['recall@1']:>9.3f} {gold['recall@k']:>9.3f} {gold['mrr']:>9.3f} "
+                      f"{syn_recall} {syn_mrr} {row['p50_ms']:>8.3f} {row['p99_ms']:>8.3f}")
+        finally:
+            shutil.rmtree(workdir, ignore_errors=True)
+    return results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sizes", default="10,100,1000,10000,100000",
+                        help="comma-separated corpus sizes (documents, including the real kb/ files)")
+    parser.add_argument("--retrievers", default=",".join(RETRIEVERS),
+                        help=f"comma-separated subset of: {', '.join(RETRIEVERS)}")
+    parser.add_argument("--k", type=int, default=3, help="passages retrieved per query")
+    parser.add_argument("--queries", type=int, default=100, help="synthetic questions per corpus size")
+    parser.add_argument("--no-memory", action="store_true", help="skip the tracemalloc build pass")
+    parser.add_argument("--output", help="also write the results as JSON to this path")
+    args = parser.parse_args()
+
+    selected = [name.strip() for name in args.retrievers.split(",") if name.strip()]
+    unknown = [name for name in selected if name not in RETRIEVERS]
+    if unknown:
+        parser.error(f"unknown retrievers: {', '.join(unknown)}")
+
+    rows = run([int(size) for size in args.sizes.split(",")], selected, args.k, args.queries, not args.no_memory)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(rows, f, indent=2)
@@ -0,0 +1,66 @@
+"""
+Scope gate threshold benchmark.
+
+Scores the held-out questions in scope_holdout.json (none of them are in
+the classifier's training set) and reports, for each candidate threshold,
+how many in-scope questions would pass and how many off-topic ones would
+be blocked. The recommended SCOPE_GATE_THRESHOLD is the largest candidate
+that keeps every held-out in-scope question at least --margin times above
+it: wrongly blocking a PLC question costs more than letting an off-topic
+one through to Gemini, which rejects it anyway.
+
+Run from the server directory:
+
+    python -m benchmarks.bench_scope [--margin 2] [--show]
+"""
+import argparse
+import json
+import os
+from typing import List, Tuple
+
+from app.core.config import settings
+from app.services.gemini_service import SimpleKBRetriever
+from app.services.scope_classifier import ScopeClassifier
+
+HOLDOUT_PATH = os.path.join(os.path.dirname(__file__), "scope_holdout.json")
+THRESHOLDS = [0.005, 0.01, 0.015, 0.02, 0.025, 0.03, 0.04, 0.05, 0.1]
+
+
+def score_holdout(classifier: ScopeClassifier) -> List[Tuple[float, bool, str]]:
+    with open(HOLDOUT_PATH, "r", encoding="utf-8") as f:
+        examples = json.load(f)
+    return sorted((classifier.score(e["text"]), e["on_topic"], e["text"]) for e in examples)
+
+
+def run(margin: float, show: bool) -> float:
+    classifier = ScopeClassifier(SimpleKBRetriever().vocabulary())
+    scored = score_holdout(classifier)
+    on_topic = [score for score, label, _ in scored if label]
+    off_topic = [score for score, label, _ in scored if not label]
+
+    if show:
+        for score, label, text in scored:
+            print(f"{score:>8.4f}  {'in ' if label else 'off'}  {text}")
+        print()
+
+    print(f"{'threshold':>9} {'in-scope passed':>16} {'off-topic blocked':>18}")
+    for threshold in THRESHOLDS:
+        passed = sum(1 for score in on_topic if score >= threshold)
+        blocked = sum(1 for score in off_topic if score < threshold)
+        marker = "  (current)" if threshold == settings.SCOPE_GATE_THRESHOLD else ""
+        print(f"{threshold:>9.3f} {passed:>9}/{len(on_topic):<6} {blocked:>11}/{len(off_topic):<6}{marker}")
+
+    lowest = min(on_topic) if on_topic else 1.0
+    safe = [threshold for threshold in THRESHOLDS if threshold * margin <= lowest]
+    recommended = max(safe) if safe else min(THRESHOLDS)
+    print(f"\nLowest in-scope score {lowest:.4f}; recommended threshold at {margin}x margin: {recommended}")
+    return recommended
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--margin", type=float, default=2.0,
+                        help="lowest in-scope score must be at least this multiple of the threshold")
+    parser.add_argument("--show", action="store_true", help="print every held-out question with its score")
+    args = parser.parse_args()
+    run(args.margin, args.show)
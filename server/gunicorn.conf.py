@@ -0,0 +1,35 @@
+"""
+Production runner:
+
+    gunicorn -c gunicorn.conf.py
+
+WEB_CONCURRENCY uvicorn workers (uvloop + httptools) behind one gunicorn
+master. The master maps and warms the KB index before forking, so every
+worker shares it. The app itself is imported after the fork, because gRPC
+clients (Firestore) must not be created in a parent process. Workers drain
+on SIGTERM; see app/core/worker.py.
+"""
+import time
+from app.core.config import settings
+
+wsgi_app = "app.main:app"
+bind = f"{settings.HOST}:{settings.PORT}"
+workers = settings.WEB_CONCURRENCY
+worker_class = "app.core.worker.DrainingUvicornWorker"
+preload_app = False
+# Drain plus time for the write-behind, feedback and usage queues to flush
+graceful_timeout = int(settings.SHUTDOWN_DRAIN_TIMEOUT + settings.SHUTDOWN_FLUSH_TIMEOUT)
+timeout = 120
+keepalive = 5
+accesslog = "-"
+
+
+def on_starting(server):
+    from app.services.kb_index import preload
+    started_at = time.monotonic()
+    index = preload(settings.KB_INDEX_PATH)
+    if index is not None:
+        server.log.info(
+            "KB index preloaded: %d documents in %.2fs", len(index), time.monotonic() - started_at
+        )
+